@@ -1,283 +1,651 @@
-from .node import LndRestNode
-from .base import TokenData, WithdrawRequest, DepositRequest
-from .crud import PSQLClient
-from .helpers import decode_access_token, RateLimiter, random_k1
-from .lnurl import LnurlPayResponse, PayRequestMetadata, LnurlPayActionResponse, MessageAction, encode, LnurlErrorResponse, LnurlSuccessResponse, LnurlWithdrawResponse, CreateLnurlResponse
-from .db import create_tables
-from .tasks import create_permanent_task, process_invoice_notifications, process_payment_notifications, cancel_all_tasks
-from redis import Redis, ConnectionPool
-import asyncio
-from fastapi import FastAPI, Depends, HTTPException, Query, BackgroundTasks
-from typing import Annotated
-from datetime import datetime
-from contextlib import asynccontextmanager
-import os
-
-psql_coninf = os.getenv("POSTGRES_CONINFO")
-
-r_host = os.getenv("REDIS_HOST")
-r_port = os.getenv("REDIS_PORT")
-r_psq = os.getenv("REDIS_PSW")
-
-
-MIN_AVAIL = 50000
-FEE_LIMIT_SAT = 10000
-
-SCHEMA = "https://"
-DOMAIN = "fancy.domain"
-
-
-redis_pool = ConnectionPool(host=r_host,
-                            port=r_port,
-                            password=r_psw,
-                            db=0, decode_responses=True)
-
-async def get_redis_connection():
-    connection = Redis(connection_pool=redis_pool)
-    yield connection
-
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    create_tables()
-    create_permanent_task(process_invoice_notifications, node, psql)
-    create_permanent_task(process_payment_notifications, node, psql)
-    yield
-    cancel_all_tasks()
-
-node = LndRestNode()
-psql = PSQLClient(psql_coninf)
-app = FastAPI(lifespan=lifespan)
-limiter = RateLimiter(interval=60)
-
-
-@app.get("/withdraw/ln/request")
-async def ln_withdraw_request(
-    token_data:  Annotated[TokenData, Depends(decode_access_token)],
-    redis_conn: Redis = Depends(get_redis_connection)):
-    """
-    Create withdraw request - private lnurlw link.
-    Time limit user requests. Ensure single pending withdraw request exists per user.
-    """
-    if token_data is None:
-        raise HTTPException(status_code=400, detail="Invalid token")
-    
-    # one request per 5minutes for user
-    is_limited = await limiter.register(token_data.userid)
-    if is_limited:
-        raise HTTPException(status_code=400, detail="Please try in a few minutes")
-    
-    # verify balance
-    available = redis_conn.hget(f"{token_data.userid}::session", "balance")
-    if available is None:
-        raise HTTPException(status_code=400, detail="Invalid token")
-    available = int(available)
-    if available < MIN_AVAIL:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-
-    pending = await psql.get_pending_requests(token_data.userid)
-    if pending > 0:
-        # TODO: replace error
-        raise HTTPException(status_code=400, detail="User has pending requests")
-    
-    # create withdraw hash
-    random_k1_value = random_k1()
-    # create link from hash
-    PATH = "/withdraw/ln/cb?k1="
-    clearnet_url = SCHEMA+DOMAIN+PATH+random_k1_value
-    lnurl_legacy = "lightning:"+encode(clearnet_url)
-    lnurlw = "lnurlw://"+DOMAIN+PATH+random_k1_value
-
-    req = WithdrawRequest(
-        userid=token_data.userid,
-        k1=random_k1_value,
-        clearnet_url=clearnet_url,
-        lnurl=lnurl_legacy,
-        lnurlw=lnurlw,
-        status="CREATED",
-        ts_created=int(datetime.utcnow().timestamp()),
-    )
-
-    # register request
-    await psql.create_withdraw_request(req)
-    redis_conn.set(random_k1_value, value=token_data.userid, ex=600)
-
-    # decide if need extra verification
-    # and decide whether to return lnurl here or somewhere else
-    return CreateLnurlResponse(lnurl=lnurl_legacy, lnurlw=lnurlw)
-
-
-@app.get("/withdraw/ln/cb")
-async def lnurlw_callback(
-    k1: str,
-    redis_conn: Redis =Depends(get_redis_connection)
-    ) -> LnurlWithdrawResponse | LnurlErrorResponse:
-    """
-    Handle call to generated lnurlw
-    Broadcast min/max available amount
-    """
-    # request valid for 10 minutes
-    exists = redis_conn.exists(k1)
-    if exists == 0:
-        return LnurlErrorResponse(reason="Request expired")    
-    # get WithdrawRequest from db
-    # does not matter how many times respond to this
-    request = await psql.get_withdraw_request(k1)
-    if not (request is not None and request.status == "CREATED"):
-        return LnurlErrorResponse(reason="Invalid withdraw request")
-    request: WithdrawRequest
-
-    balance = redis_conn.hget(f"{request.userid}::session", "balance")
-    if balance is None:
-        return LnurlErrorResponse(reason="Session not found")
-    balance = int(balance)
-    if balance < MIN_AVAIL:
-        return LnurlErrorResponse(reason="Insufficient balance. Min amount: "+ MIN_AVAIL)
-    
-    PATH  = "/withdraw"
-    callback = SCHEMA + DOMAIN + PATH
-    descr = "Some withdraw description"
-
-    await psql.update_withdraw_status(k1=k1, status="VERIFIED")
-    
-    return LnurlWithdrawResponse(
-        callback=callback,
-        k1=k1,
-        maxWithdrawable=balance,
-        minWithdrawable=50000,
-        defaultDescription=descr,
-    )
-
-
-@app.get("/withdraw/ln")
-async def ln_withdraw(
-    k1: Annotated[str, Query(max_length=64, min_length=64)],
-    pr: str,
-    background_tasks: BackgroundTasks,
-    redis_conn: Redis = Depends(get_redis_connection),
-    ) -> LnurlSuccessResponse | LnurlErrorResponse:
-
-    userid = redis_conn.get(k1)
-    if userid is None:
-        return LnurlErrorResponse(reason="Request expired")
-    
-    # call node to decode invoice
-    decoded_invoice = await node.decode_invoice(pr)
-    if decoded_invoice is None:
-        return LnurlErrorResponse(reason="Invoice decode error")    
-
-    # lock from trading during processing
-    redis_conn.hset(f"{userid}::session", "status", "locked")
-    background_tasks.add_task(redis_conn.hset, f"{userid}::session", "status", "active")
-
-    available_balance = redis_conn.hget(f"{userid}::session", "balance")
-    if available_balance is None:
-        # register rejected invoice anyway
-        await psql.withdraw_bad_invoice(k1, decoded_invoice, "No session")
-        return LnurlErrorResponse(reason="Authentication error")
-    available_balance = int(available_balance)
-    if (decoded_invoice.num_satoshis > available_balance) | (decoded_invoice.num_satoshis < MIN_AVAIL):
-        # register rejected invoice anyway
-        await psql.withdraw_bad_invoice(k1, decoded_invoice, "Insufficient balance")
-        return LnurlErrorResponse(reason="Insufficient balance")
-    
-    # one chance to submit valid amount
-    request = await psql.withdraw_redeem_request(k1, decoded_invoice)
-    if request is None:
-        return LnurlErrorResponse(reason="Invalid request")
-    
-    # pay async
-    asyncio.create_task(node.pay_invoice(decoded_invoice.bolt11, FEE_LIMIT_SAT))
-
-    return LnurlSuccessResponse()
-
-@app.get("/deposit/ln/request")
-async def create_deposit_request(
-    token_data: Annotated[TokenData, Depends(decode_access_token)],
-    redis_conn: Redis = Depends(get_redis_connection)
-):
-    if token_data is None:
-        raise ValueError
-    
-    # create withdraw hash
-    random_k1_value = random_k1()
-    # create link from hash
-    PATH = "/deposit/ln?k1="
-    clearnet_url = SCHEMA+DOMAIN+PATH+random_k1_value
-    lnurl_legacy = encode(clearnet_url)
-    lnurlp = "lnurlp://"+DOMAIN+PATH+random_k1_value
-
-    req = DepositRequest(
-        userid=token_data.userid,
-        k1=random_k1_value,
-        clearnet_url=clearnet_url,
-        lnurl=lnurl_legacy,
-        lnurlp=lnurlp,
-        status="CREATED",
-        ts_created=datetime.utcnow().timestamp(),
-    )
-
-    # register request
-    await psql.create_withdraw_request(req)
-    redis_conn.set(random_k1_value, value=token_data.userid, ex=600)
-
-    # decide if need extra verification
-    # and decide whether to return lnurl here or somewhere else
-    return CreateLnurlResponse(lnurl=lnurl_legacy, lnurlw=lnurlp)
-
-@app.get("/deposit/ln/cb")
-async def lnurlp_callback(
-    k1: str,
-    ) -> LnurlWithdrawResponse | LnurlErrorResponse:
-    """
-    Handle call to generated lnurlw
-    Broadcast min/max available amount
-    """
-    # get maxSendable, minSendable
-    MIN_SENDABLE = 10000
-    MAX_SENDABLE = 100000000
-    # means user found q key in email
-    # send wallet a response with min and max withdawable
-    PATH = "/deposit?k1="
-    callback = SCHEMA + DOMAIN + PATH + k1
-    descr = "Some deposit description"
-
-    return LnurlPayResponse(
-        callback=callback,
-        minSendable=MIN_SENDABLE,
-        maxSendable=MAX_SENDABLE,
-        metadata=PayRequestMetadata(text_plain=descr)
-    )
-
-
-@app.get("/deposit/ln")
-async def ln_deposit(k1: str, amount: int = Query(gt=100000),
-                     redis_conn: Redis = Depends(get_redis_connection)):
-    
-    # create invoice and corresponding deposit request
-    # 
-
-    userid = await psql.get_user_by_k1(k1)
-    if userid is None:
-        raise ValueError
-    
-    descr = "Deposit to "
-    invoice = await node.create_invoice(amount, unhashed_description=descr)
-
-    if invoice is None:
-        return LnurlErrorResponse(reason="Error generating invoice")
-    
-    req = DepositRequest(
-        userid=userid,
-        payment_hash=invoice.payment_hash,
-        status="CREATED",
-        amount=amount,
-        ts_created=datetime.utcnow().timestamp(),
-    )
-
-    await psql.deposit_request_create(req, invoice)
-
-    return LnurlPayActionResponse(
-        pr=invoice.bolt11,
-        successAction=MessageAction(message="Thank you!"),
-    )
+import time
+IMPORT_STARTED = time.perf_counter()   # import-to-ready, see warm_up
+
+from .node import LndNodePool
+from .base import TokenData, WithdrawRequest, DepositRequest, LNDInvoice, PayoutItem, HistoryEntry, HistoryPage, DailyTotals
+from .crud import PSQLClient
+from .helpers import decode_access_token, gather_all, HistoryCache, IdempotentResponses, RateLimiter, PaymentHashIndex, ServiceUnavailableError, random_k1
+from .lnurl import LnurlPayResponse, PayRequestMetadata, LnurlPayActionResponse, MessageAction, encode, LnurlErrorResponse, LnurlSuccessResponse, LnurlWithdrawResponse, CreateLnurlResponse
+from .db import create_tables
+from .events import StatusBroker
+from .payouts import PAYOUT_MAX_ITEMS, bulk_payout
+from .outbox import OUTBOX_BATCH, OutboxRelay
+from . import payouts
+from .logs import setup_logging, stop_logging
+from .profiling import PROFILING_ENABLED
+from .recording import RECORDING_ENABLED, start_recording, stop_recording
+from . import recording
+from . import profiling
+from .metrics import METRICS_ENABLED, QUEUE_DEPTH, STARTUP_SECONDS, InstrumentedRedis, http_middleware, expose
+from .tracing import TRACING_ENABLED, current_span, remember_payment
+from . import tracing
+from .tasks import create_permanent_task, process_invoice_notifications, process_payment_notifications, refresh_deposit_index, refresh_liquidity, replenish_deposit_pool, relay_outbox, check_replicas, listen_status_events, create_task, cancel_all_tasks
+from redis import Redis, ConnectionPool
+import asyncio
+import hashlib
+import json
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Query, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import Annotated, Optional
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+import logging
+import os
+
+psql_coninf = os.getenv("POSTGRES_CONINFO")
+# read replicas, json list of conninfo strings
+psql_replicas = json.loads(os.getenv("POSTGRES_REPLICAS", "[]"))
+REPLICA_CHECK_INTERVAL = int(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+
+r_host = os.getenv("REDIS_HOST")
+r_port = os.getenv("REDIS_PORT")
+r_psw = os.getenv("REDIS_PSW")
+
+
+# drops and recreates all tables, development only
+CREATE_TABLES = os.getenv("CREATE_TABLES", "0") == "1"
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", 2))
+
+DEPOSIT_INDEX_REFRESH = int(os.getenv("DEPOSIT_INDEX_REFRESH", 60))
+LIQUIDITY_REFRESH = int(os.getenv("LIQUIDITY_REFRESH", 30))
+# parallel settlement workers per stream and node, and queued events per worker
+SETTLEMENT_LANES = int(os.getenv("SETTLEMENT_LANES", 8))
+SETTLEMENT_LANE_SIZE = int(os.getenv("SETTLEMENT_LANE_SIZE", 100))
+# primary pool connections, 0 sizes it for every settlement lane plus POSTGRES_POOL_BASE for the rest
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", 0))
+POSTGRES_POOL_BASE = int(os.getenv("POSTGRES_POOL_BASE", 10))
+OUTBOX_INTERVAL = int(os.getenv("OUTBOX_INTERVAL", 5))
+# pre-created invoices for common deposit amounts, comma separated, empty disables
+DEPOSIT_POOL_AMOUNTS = [int(a) for a in os.getenv("DEPOSIT_POOL_AMOUNTS", "").split(",") if a.strip()]
+DEPOSIT_POOL_SIZE = int(os.getenv("DEPOSIT_POOL_SIZE", 20))
+DEPOSIT_POOL_EXPIRY = int(os.getenv("DEPOSIT_POOL_EXPIRY", 86400))
+DEPOSIT_POOL_MIN_VALIDITY = int(os.getenv("DEPOSIT_POOL_MIN_VALIDITY", 600))
+DEPOSIT_POOL_REFRESH = int(os.getenv("DEPOSIT_POOL_REFRESH", 30))
+DEPOSIT_DESCRIPTION = "Deposit to "
+
+MIN_AVAIL = 50000
+# replayed /withdraw/ln responses, covers the 600s k1 lifetime
+WITHDRAW_IDEMPOTENCY_TTL = int(os.getenv("WITHDRAW_IDEMPOTENCY_TTL", 600))
+# withdraw answers a retry may change, e.g. decode fails while LND answers 5xx.
+# Unavailable nodes raise ServiceUnavailableError and are never stored either
+TEMPORARY_WITHDRAW_ERRORS = {"Invoice decode error"}
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", 300))
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", 100))
+# sats per UTC day a user can withdraw, 0 is unlimited
+DAILY_WITHDRAW_LIMIT = int(os.getenv("DAILY_WITHDRAW_LIMIT", 0))
+TOTALS_MAX_DAYS = int(os.getenv("TOTALS_MAX_DAYS", 366))
+
+SCHEMA = "https://"
+DOMAIN = "fancy.domain"
+
+
+logger = logging.getLogger(__name__)
+
+RedisClient = InstrumentedRedis if METRICS_ENABLED or TRACING_ENABLED else Redis
+
+# clients, created in lifespan
+nodes: LndNodePool = None
+psql: PSQLClient = None
+redis_pool: ConnectionPool = None
+outbox_relay: OutboxRelay = None
+
+limiter = RateLimiter(interval=60)
+withdraw_responses = IdempotentResponses("withdraw", ttl=WITHDRAW_IDEMPOTENCY_TTL)
+deposit_index = PaymentHashIndex()
+history_cache = HistoryCache(ttl=HISTORY_CACHE_TTL)
+status_broker = StatusBroker()
+deposit_pool_low = asyncio.Event()
+outbox_wake = asyncio.Event()
+# keep references to fire-and-forget payouts, named so task snapshots show them
+payout_tasks: set[asyncio.Task] = set()
+startup = {"ready": False, "seconds": None}
+
+router = APIRouter()
+
+
+async def get_redis_connection():
+    connection = RedisClient(connection_pool=redis_pool)
+    yield connection
+
+
+def drop_history(event: dict):
+    """
+    A new settled transaction makes the cached history pages of the user stale
+    """
+    if event.get("status") in ("PAID", "SETTLED"):
+        history_cache.invalidate(RedisClient(connection_pool=redis_pool), event["userid"])
+
+
+status_broker.listeners.append(drop_history)
+status_broker.listeners.append(lambda event: outbox_wake.set())
+
+
+async def readiness_checks() -> dict[str, bool]:
+    async def check(coro) -> bool:
+        try:
+            return bool(await asyncio.wait_for(coro, READY_TIMEOUT))
+        except Exception:
+            return False
+
+    redis_conn = RedisClient(connection_pool=redis_pool)
+    postgres, redis, lnd = await asyncio.gather(
+        check(psql.check()),
+        check(asyncio.to_thread(redis_conn.ping)),
+        check(nodes.check()),
+    )
+    return {"postgres": postgres, "redis": redis, "lnd": lnd}
+
+
+async def warm_up(interval: float = 1):
+    """
+    Open connections to every backend and mark the worker ready once all answer
+    """
+    while True:
+        checks = await readiness_checks()
+        if all(checks.values()):
+            break
+        logger.info("waiting for backends", extra={"checks": checks})
+        await asyncio.sleep(interval)
+    startup["seconds"] = time.perf_counter() - IMPORT_STARTED
+    startup["ready"] = True
+    STARTUP_SECONDS.set(startup["seconds"])
+    logger.info("ready", extra={"startup_seconds": round(startup["seconds"], 3)})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global nodes, psql, redis_pool, outbox_relay
+    # clients read macaroons and certs from disk, build them off the loop in parallel
+    nodes, redis_pool = await gather_all(
+        asyncio.to_thread(LndNodePool.from_env),
+        asyncio.to_thread(ConnectionPool, host=r_host, port=r_port, password=r_psw, db=0, decode_responses=True),
+    )
+    # payment and invoice lanes of every node can each hold a connection
+    pool_size = POSTGRES_POOL_SIZE or 2 * SETTLEMENT_LANES * len(nodes) + POSTGRES_POOL_BASE
+    psql = PSQLClient(psql_coninf, psql_replicas, pool_size)
+    if CREATE_TABLES:
+        await asyncio.to_thread(create_tables, psql_coninf)
+    await psql.open()
+    start_recording()
+    outbox_relay = OutboxRelay(redis_pool, RedisClient)
+
+    create_task(warm_up())
+    create_permanent_task(refresh_deposit_index, psql, deposit_index, DEPOSIT_INDEX_REFRESH)
+    if psql.replicas:
+        create_permanent_task(check_replicas, psql, REPLICA_CHECK_INTERVAL)
+    # one subscription consumer and liquidity refresh per node
+    for node in nodes:
+        create_permanent_task(
+            process_invoice_notifications, node, psql, deposit_index, SETTLEMENT_LANES, SETTLEMENT_LANE_SIZE,
+            name=f"process_invoice_notifications:{node.name}",
+        )
+        create_permanent_task(
+            process_payment_notifications, node, psql, SETTLEMENT_LANES, SETTLEMENT_LANE_SIZE,
+            name=f"process_payment_notifications:{node.name}",
+        )
+        create_permanent_task(refresh_liquidity, node, LIQUIDITY_REFRESH, name=f"refresh_liquidity:{node.name}")
+    create_permanent_task(listen_status_events, psql, status_broker)
+    create_permanent_task(relay_outbox, psql, outbox_relay, outbox_wake, OUTBOX_BATCH, OUTBOX_INTERVAL)
+    if DEPOSIT_POOL_AMOUNTS:
+        create_permanent_task(
+            replenish_deposit_pool, nodes, psql, DEPOSIT_POOL_AMOUNTS, DEPOSIT_POOL_SIZE, DEPOSIT_POOL_EXPIRY,
+            DEPOSIT_POOL_MIN_VALIDITY, DEPOSIT_DESCRIPTION.encode(), deposit_pool_low, DEPOSIT_POOL_REFRESH,
+        )
+    create_task(status_broker.ping())
+    if PROFILING_ENABLED:
+        profiling.monitor.start()
+    yield
+    profiling.monitor.stop()
+    cancel_all_tasks()
+    await gather_all(nodes.cleanup(), psql.close(), outbox_relay.close())
+    redis_pool.disconnect()
+    stop_recording()
+    stop_logging()
+
+
+def create_app() -> FastAPI:
+    setup_logging()
+    app = FastAPI(lifespan=lifespan)
+
+    if TRACING_ENABLED:
+        app.middleware("http")(tracing.http_middleware)
+
+    if PROFILING_ENABLED:
+        app.include_router(profiling.router)
+
+    if METRICS_ENABLED:
+        app.middleware("http")(http_middleware)
+        QUEUE_DEPTH.set_function(
+            lambda: sum(q.qsize() for node in nodes or () for q in node._invoice_subscribers), queue="invoices"
+        )
+
+        @app.get("/metrics", include_in_schema=False)
+        async def metrics():
+            return PlainTextResponse(expose(), media_type="text/plain; version=0.0.4")
+
+    if RECORDING_ENABLED:
+        app.middleware("http")(recording.http_middleware)
+
+    app.exception_handler(ServiceUnavailableError)(service_unavailable_handler)
+    app.include_router(router)
+    return app
+
+
+async def service_unavailable_handler(request: Request, exc: ServiceUnavailableError):
+    # node unhealthy or saturated, fail fast with a wallet readable error
+    return JSONResponse(LnurlErrorResponse(reason="Service temporarily unavailable").model_dump())
+
+
+@router.get("/ready", include_in_schema=False)
+async def ready():
+    """
+    200 once warm-up finished and Postgres, Redis and LND answer, 503 otherwise
+    """
+    checks = await readiness_checks()
+    ok = startup["ready"] and all(checks.values())
+    body = {"ready": ok, "checks": checks, "startup_seconds": startup["seconds"]}
+    return JSONResponse(body, status_code=200 if ok else 503)
+
+
+async def daily_withdraw_left(userid: str) -> int:
+    """
+    Sats the user may still withdraw today under DAILY_WITHDRAW_LIMIT
+    """
+    return max(0, DAILY_WITHDRAW_LIMIT - await psql.get_withdrawn_today(userid))
+
+
+@router.get("/withdraw/ln/request")
+async def ln_withdraw_request(
+    token_data:  Annotated[TokenData, Depends(decode_access_token)],
+    redis_conn: Redis = Depends(get_redis_connection)):
+    """
+    Create withdraw request - private lnurlw link.
+    Time limit user requests. Ensure single pending withdraw request exists per user.
+    """
+    if token_data is None:
+        raise HTTPException(status_code=400, detail="Invalid token")
+    
+    # one request per 5minutes for user
+    is_limited = await limiter.register(token_data.userid)
+    if is_limited:
+        raise HTTPException(status_code=400, detail="Please try in a few minutes")
+    
+    # session balance and pending requests are independent, fetch both at once
+    available, pending = await gather_all(
+        asyncio.to_thread(redis_conn.hget, f"{token_data.userid}::session", "balance"),
+        psql.get_pending_requests(token_data.userid),
+    )
+
+    # verify balance
+    if available is None:
+        raise HTTPException(status_code=400, detail="Invalid token")
+    available = int(available)
+    if available < MIN_AVAIL:
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+
+    if pending > 0:
+        # TODO: replace error
+        raise HTTPException(status_code=400, detail="User has pending requests")
+
+    if DAILY_WITHDRAW_LIMIT and await daily_withdraw_left(token_data.userid) < MIN_AVAIL:
+        raise HTTPException(status_code=400, detail="Daily withdraw limit reached")
+    
+    # create withdraw hash
+    random_k1_value = random_k1()
+    # create link from hash
+    PATH = "/withdraw/ln/cb?k1="
+    clearnet_url = SCHEMA+DOMAIN+PATH+random_k1_value
+    lnurl_legacy = "lightning:"+encode(clearnet_url)
+    lnurlw = "lnurlw://"+DOMAIN+PATH+random_k1_value
+
+    req = WithdrawRequest(
+        userid=token_data.userid,
+        k1=random_k1_value,
+        clearnet_url=clearnet_url,
+        lnurl=lnurl_legacy,
+        lnurlw=lnurlw,
+        status="CREATED",
+        ts_created=int(datetime.utcnow().timestamp()),
+    )
+
+    # register request
+    await psql.create_withdraw_request(req)
+    redis_conn.set(random_k1_value, value=token_data.userid, ex=600)
+
+    # decide if need extra verification
+    # and decide whether to return lnurl here or somewhere else
+    return CreateLnurlResponse(lnurl=lnurl_legacy, lnurlw=lnurlw)
+
+
+@router.get("/withdraw/ln/cb")
+async def lnurlw_callback(
+    k1: str,
+    redis_conn: Redis =Depends(get_redis_connection)
+    ) -> LnurlWithdrawResponse | LnurlErrorResponse:
+    """
+    Handle call to generated lnurlw
+    Broadcast min/max available amount
+    """
+    # request valid for 10 minutes
+    exists = redis_conn.exists(k1)
+    if exists == 0:
+        return LnurlErrorResponse(reason="Request expired")    
+    # get WithdrawRequest from db
+    # does not matter how many times respond to this
+    request = await psql.get_withdraw_request(k1)
+    if not (request is not None and request.status == "CREATED"):
+        return LnurlErrorResponse(reason="Invalid withdraw request")
+    request: WithdrawRequest
+
+    balance = redis_conn.hget(f"{request.userid}::session", "balance")
+    if balance is None:
+        return LnurlErrorResponse(reason="Session not found")
+    balance = int(balance)
+    if balance < MIN_AVAIL:
+        return LnurlErrorResponse(reason="Insufficient balance. Min amount: "+ str(MIN_AVAIL))
+
+    # do not promise more than any node can currently send
+    spendable = nodes.spendable()
+    if spendable is not None and spendable < balance:
+        if spendable < MIN_AVAIL:
+            return LnurlErrorResponse(reason="Withdrawals temporarily unavailable")
+        balance = spendable
+
+    if DAILY_WITHDRAW_LIMIT:
+        left = await daily_withdraw_left(request.userid)
+        if left < MIN_AVAIL:
+            return LnurlErrorResponse(reason="Daily withdraw limit reached")
+        balance = min(balance, left)
+    
+    PATH  = "/withdraw/ln"
+    callback = SCHEMA + DOMAIN + PATH
+    descr = "Some withdraw description"
+
+    await psql.update_withdraw_status(k1=k1, status="VERIFIED")
+    
+    return LnurlWithdrawResponse(
+        callback=callback,
+        k1=k1,
+        maxWithdrawable=balance,
+        minWithdrawable=50000,
+        defaultDescription=descr,
+    )
+
+
+@router.get("/withdraw/ln")
+async def ln_withdraw(
+    k1: Annotated[str, Query(max_length=64, min_length=64)],
+    pr: str,
+    background_tasks: BackgroundTasks,
+    redis_conn: Redis = Depends(get_redis_connection),
+    ) -> LnurlSuccessResponse | LnurlErrorResponse:
+    """
+    Wallets retry this call when it is slow, answer every retry of the
+    same k1 and invoice with the first response
+    """
+    key = k1 + ":" + hashlib.sha256(pr.encode()).hexdigest()
+    return await withdraw_responses.run(
+        redis_conn, key, lambda: redeem_withdraw(k1, pr, background_tasks, redis_conn),
+        cacheable=lambda result: result.get("reason") not in TEMPORARY_WITHDRAW_ERRORS,
+    )
+
+
+async def redeem_withdraw(
+    k1: str,
+    pr: str,
+    background_tasks: BackgroundTasks,
+    redis_conn: Redis,
+    ) -> LnurlSuccessResponse | LnurlErrorResponse:
+
+    userid = redis_conn.get(k1)
+    if userid is None:
+        return LnurlErrorResponse(reason="Request expired")
+    
+    # call node to decode invoice
+    decoded_invoice = await nodes.decode_invoice(pr)
+    if decoded_invoice is None:
+        return LnurlErrorResponse(reason="Invoice decode error")    
+    current_span().set_attribute("payment_hash", decoded_invoice.payment_hash)
+
+    # lock from trading during processing. A redeemed request is unlocked by
+    # the outbox relay once the debited balance is in the session
+    redis_conn.hset(f"{userid}::session", "status", "locked")
+    response = await redeem_locked(userid, k1, decoded_invoice, redis_conn)
+    if not isinstance(response, LnurlSuccessResponse):
+        background_tasks.add_task(redis_conn.hset, f"{userid}::session", "status", "active")
+    return response
+
+
+async def redeem_locked(
+    userid: str,
+    k1: str,
+    decoded_invoice: LNDInvoice,
+    redis_conn: Redis,
+    ) -> LnurlSuccessResponse | LnurlErrorResponse:
+
+    available_balance = redis_conn.hget(f"{userid}::session", "balance")
+    if available_balance is None:
+        # register rejected invoice anyway
+        await psql.withdraw_bad_invoice(k1, decoded_invoice, "No session")
+        return LnurlErrorResponse(reason="Authentication error")
+    available_balance = int(available_balance)
+    if (decoded_invoice.num_satoshis > available_balance) | (decoded_invoice.num_satoshis < MIN_AVAIL):
+        # register rejected invoice anyway
+        await psql.withdraw_bad_invoice(k1, decoded_invoice, "Insufficient balance")
+        return LnurlErrorResponse(reason="Insufficient balance")
+    if DAILY_WITHDRAW_LIMIT and decoded_invoice.num_satoshis > await daily_withdraw_left(userid):
+        await psql.withdraw_bad_invoice(k1, decoded_invoice, "Daily withdraw limit")
+        return LnurlErrorResponse(reason="Amount exceeds daily withdraw limit")
+    node = nodes.for_payout(decoded_invoice.num_satoshis)
+    if node is None:
+        await psql.withdraw_bad_invoice(k1, decoded_invoice, "Insufficient liquidity")
+        return LnurlErrorResponse(reason="Amount exceeds available liquidity")
+    
+    # one chance to submit valid amount
+    request = await psql.withdraw_redeem_request(k1, decoded_invoice, node.name)
+    if request is None:
+        return LnurlErrorResponse(reason="Invalid request")
+    
+    # pay async, hold the amount until the payment stream reports back
+    node.liquidity.reserve(decoded_invoice.payment_hash, decoded_invoice.num_satoshis)
+    remember_payment(decoded_invoice.payment_hash)
+    task = asyncio.create_task(node.pay(decoded_invoice), name=f"pay_invoice:{decoded_invoice.payment_hash}")
+    payout_tasks.add(task)
+    task.add_done_callback(payout_tasks.discard)
+
+    return LnurlSuccessResponse()
+
+@router.post("/payouts", dependencies=[Depends(payouts.require_token)])
+async def create_payouts(items: list[PayoutItem]):
+    """
+    Pay a batch of (userid, bolt11), streams one JSON result per line
+    """
+    if not items or len(items) > PAYOUT_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Expected 1 to {PAYOUT_MAX_ITEMS} items")
+
+    async def report():
+        async for result in bulk_payout(nodes, psql, items, payout_tasks):
+            yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(report(), media_type="application/x-ndjson")
+
+@router.get("/deposit/ln/request")
+async def create_deposit_request(
+    token_data: Annotated[TokenData, Depends(decode_access_token)],
+    redis_conn: Redis = Depends(get_redis_connection)
+):
+    if token_data is None:
+        raise ValueError
+    
+    # create withdraw hash
+    random_k1_value = random_k1()
+    # create link from hash
+    PATH = "/deposit/ln?k1="
+    clearnet_url = SCHEMA+DOMAIN+PATH+random_k1_value
+    lnurl_legacy = encode(clearnet_url)
+    lnurlp = "lnurlp://"+DOMAIN+PATH+random_k1_value
+
+    req = DepositRequest(
+        userid=token_data.userid,
+        k1=random_k1_value,
+        clearnet_url=clearnet_url,
+        lnurl=lnurl_legacy,
+        lnurlp=lnurlp,
+        status="CREATED",
+        ts_created=datetime.utcnow().timestamp(),
+    )
+
+    # register request
+    await psql.create_withdraw_request(req)
+    redis_conn.set(random_k1_value, value=token_data.userid, ex=600)
+
+    # decide if need extra verification
+    # and decide whether to return lnurl here or somewhere else
+    return CreateLnurlResponse(lnurl=lnurl_legacy, lnurlw=lnurlp)
+
+@router.get("/deposit/ln/cb")
+async def lnurlp_callback(
+    k1: str,
+    ) -> LnurlPayResponse | LnurlErrorResponse:
+    """
+    Handle call to generated lnurlw
+    Broadcast min/max available amount
+    """
+    # get maxSendable, minSendable
+    MIN_SENDABLE = 10000
+    MAX_SENDABLE = 100000000
+    # means user found q key in email
+    # send wallet a response with min and max withdawable
+    PATH = "/deposit/ln?k1="
+    callback = SCHEMA + DOMAIN + PATH + k1
+    descr = "Some deposit description"
+
+    return LnurlPayResponse(
+        callback=callback,
+        minSendable=MIN_SENDABLE,
+        maxSendable=MAX_SENDABLE,
+        metadata=PayRequestMetadata(text_plain=descr)
+    )
+
+
+@router.get("/deposit/ln")
+async def ln_deposit(k1: str, amount: int = Query(gt=100000),
+                     redis_conn: Redis = Depends(get_redis_connection)):
+    
+    # common amounts: bind a pre-created invoice in one round trip
+    if amount in DEPOSIT_POOL_AMOUNTS:
+        min_expiry = int(datetime.utcnow().timestamp()) + DEPOSIT_POOL_MIN_VALIDITY
+        claimed = await psql.claim_deposit_invoice(k1, amount, min_expiry)
+        deposit_pool_low.set()
+        if claimed is not None:
+            deposit_index.add(claimed["payment_hash"])
+            return LnurlPayActionResponse(
+                pr=claimed["bolt11"],
+                successAction=MessageAction(message="Thank you!"),
+            )
+
+    # create invoice and corresponding deposit request
+    userid = await psql.get_user_by_k1(k1)
+    if userid is None:
+        raise ValueError
+    
+    node = nodes.for_deposit()
+    invoice = await node.create_invoice(amount, unhashed_description=DEPOSIT_DESCRIPTION.encode())
+
+    if invoice is None:
+        return LnurlErrorResponse(reason="Error generating invoice")
+    invoice.state = "OPEN"
+    
+    req = DepositRequest(
+        userid=userid,
+        payment_hash=invoice.payment_hash,
+        status="CREATED",
+        amount=amount,
+        ts_created=int(datetime.utcnow().timestamp()),
+    )
+
+    await psql.deposit_request_create(req, invoice, node.name)
+    deposit_index.add(invoice.payment_hash)
+
+    return LnurlPayActionResponse(
+        pr=invoice.bolt11,
+        successAction=MessageAction(message="Thank you!"),
+    )
+
+
+
+@router.get("/events")
+async def status_events(
+    token_data: Annotated[TokenData, Depends(decode_access_token)],
+    payment_hash: Optional[str] = None,
+):
+    """
+    Server-sent events with withdraw/deposit status changes of the user,
+    optionally limited to one payment_hash
+    """
+    if token_data is None:
+        raise HTTPException(status_code=400, detail="Invalid token")
+    return StreamingResponse(
+        status_broker.stream(token_data.userid, payment_hash),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/history")
+async def history(
+    token_data: Annotated[TokenData, Depends(decode_access_token)],
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=HISTORY_MAX_LIMIT),
+    redis_conn: Redis = Depends(get_redis_connection),
+) -> HistoryPage:
+    """
+    Settled withdrawals and deposits of the user, newest first.
+    `cursor` is the next_cursor of the previous page
+    """
+    if token_data is None:
+        raise HTTPException(status_code=400, detail="Invalid token")
+    before = None
+    if cursor is not None:
+        ts_create, _, payment_hash = cursor.partition(":")
+        if not ts_create.isdigit() or len(payment_hash) != 64:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        before = (int(ts_create), payment_hash)
+
+    field = f"{limit}:{cursor or ''}"
+    version, cached = history_cache.get(redis_conn, token_data.userid, field)
+    if cached is not None:
+        return HistoryPage(**cached)
+
+    rows = await psql.get_history(token_data.userid, limit + 1, before)
+    items = [HistoryEntry(**row) for row in rows[:limit]]
+    next_cursor = f"{items[-1].ts_create}:{items[-1].payment_hash}" if len(rows) > limit else None
+    page = HistoryPage(items=items, next_cursor=next_cursor)
+    history_cache.set(redis_conn, token_data.userid, version, field, page.model_dump())
+    return page
+
+
+@router.get("/totals")
+async def user_totals(
+    token_data: Annotated[TokenData, Depends(decode_access_token)],
+    days: int = Query(30, ge=1, le=TOTALS_MAX_DAYS),
+) -> list[DailyTotals]:
+    """
+    Settled volume, counts and fees of the user per UTC day
+    """
+    if token_data is None:
+        raise HTTPException(status_code=400, detail="Invalid token")
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    return await psql.get_daily_totals(since, token_data.userid)
+
+
+@router.get("/totals/all", dependencies=[Depends(payouts.require_token)])
+async def global_totals(days: int = Query(30, ge=1, le=TOTALS_MAX_DAYS)) -> list[DailyTotals]:
+    """
+    Settled volume, counts and fees of all users per UTC day, for dashboards
+    """
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    return await psql.get_daily_totals(since)
+
+
+app = create_app()
@@ -0,0 +1,169 @@
+"""
+Load test driver for the LNURL withdraw and pay flows.
+
+    python -m <package>.bench.loadtest --base-url http://127.0.0.1:8000 --wallets 200 --concurrency 50
+
+Every simulated wallet runs the full flow against a running app.py:
+
+withdraw:  /withdraw/ln/request -> lnurlw callback -> /withdraw/ln?k1=&pr=
+deposit:   /deposit/ln/request -> lnurlp callback -> /deposit/ln?k1=&amount=
+
+Run the app against local Postgres/Redis and bench/mock_lnd.py. Tokens are
+signed with SECRET_KEY/ALGORITHM from the environment, same as helpers.py,
+and --seed-redis creates the `<userid>::session` balances the withdraw flow
+expects. Reports throughput and latency percentiles per endpoint.
+"""
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
+import os
+import secrets
+import time
+import httpx
+import jwt
+
+
+BOLT11_PREFIX = "lnmock"   # synthetic invoices understood by mock_lnd
+
+
+class Recorder:
+    """
+    Latencies and outcomes per endpoint
+    """
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    async def call(self, client: httpx.AsyncClient, name: str, url: str, **kwargs) -> httpx.Response | None:
+        started = time.perf_counter()
+        try:
+            r = await client.get(url, **kwargs)
+        except httpx.HTTPError:
+            r = None
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        failed = r is None or r.is_error
+        if not failed:
+            try:
+                failed = r.json().get("status") == "ERROR"
+            except (ValueError, AttributeError):
+                pass
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return r
+
+    def report(self, elapsed: float) -> str:
+        lines = [f"{'endpoint':<22}{'count':>8}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            lines.append(
+                f"{name:<22}{len(values):>8}{self.errors.get(name, 0):>8}{len(values) / elapsed:>10.1f}"
+                f"{percentile(values, 50):>10.1f}{percentile(values, 90):>10.1f}"
+                f"{percentile(values, 99):>10.1f}{values[-1] * 1000:>10.1f}"
+            )
+        return "\n".join(lines)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index] * 1000
+
+
+def local_url(base_url: str, url: str) -> str:
+    """
+    Lnurl links point at the public domain, send them to the app under test
+    """
+    parts = urlsplit(url.replace("lnurlw://", "https://").replace("lnurlp://", "https://"))
+    return base_url + parts.path + ("?" + parts.query if parts.query else "")
+
+
+def make_token(userid: str) -> str:
+    return jwt.encode({"sub": userid}, os.getenv("SECRET_KEY"), algorithm=os.getenv("ALGORITHM"))
+
+
+async def withdraw_flow(client: httpx.AsyncClient, rec: Recorder, base_url: str, userid: str, amount: int):
+    headers = {"Authorization": "Bearer " + make_token(userid)}
+    r = await rec.call(client, "withdraw_request", base_url + "/withdraw/ln/request", headers=headers)
+    if r is None or r.is_error:
+        return
+    r = await rec.call(client, "withdraw_callback", local_url(base_url, r.json()["lnurlw"]))
+    if r is None or r.is_error or r.json().get("status") == "ERROR":
+        return
+    offer = r.json()
+    amount = max(offer["minWithdrawable"], min(amount, offer["maxWithdrawable"]))
+    pr = f"{BOLT11_PREFIX}{amount}1{secrets.token_hex(32)}"
+    await rec.call(client, "withdraw_redeem", local_url(base_url, offer["callback"]),
+                   params={"k1": offer["k1"], "pr": pr})
+
+
+async def deposit_flow(client: httpx.AsyncClient, rec: Recorder, base_url: str, userid: str, amount: int):
+    headers = {"Authorization": "Bearer " + make_token(userid)}
+    r = await rec.call(client, "deposit_request", base_url + "/deposit/ln/request", headers=headers)
+    if r is None or r.is_error:
+        return
+    link = local_url(base_url, r.json()["lnurlw"])
+    k1 = parse_qs(urlsplit(link).query)["k1"][0]
+    r = await rec.call(client, "deposit_callback", base_url + "/deposit/ln/cb", params={"k1": k1})
+    if r is None or r.is_error or r.json().get("status") == "ERROR":
+        return
+    callback = local_url(base_url, r.json()["callback"])
+    await rec.call(client, "deposit_invoice", callback, params={"amount": amount})
+
+
+def seed_redis(userids: list[str], balance: int):
+    from redis import Redis
+
+    redis_conn = Redis(host=os.getenv("REDIS_HOST"), port=os.getenv("REDIS_PORT"),
+                       password=os.getenv("REDIS_PSW"), decode_responses=True)
+    pipe = redis_conn.pipeline()
+    for userid in userids:
+        pipe.hset(f"{userid}::session", mapping={"balance": balance, "status": "active"})
+    pipe.execute()
+
+
+async def run(args) -> str:
+    userids = [f"{args.user_prefix}{i:06d}" for i in range(args.wallets)]
+    if args.seed_redis:
+        seed_redis(userids, args.balance)
+
+    flows = []
+    if args.flow in ("withdraw", "both"):
+        flows.append((withdraw_flow, args.withdraw_amount))
+    if args.flow in ("deposit", "both"):
+        flows.append((deposit_flow, args.deposit_amount))
+
+    rec = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        async def wallet(userid: str):
+            async with semaphore:
+                for flow, amount in flows:
+                    await flow(client, rec, args.base_url, userid, amount)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(wallet(userid) for userid in userids))
+        elapsed = time.perf_counter() - started
+
+    return f"{args.wallets} wallets in {elapsed:.2f}s\n" + rec.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--wallets", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--flow", choices=("withdraw", "deposit", "both"), default="both")
+    parser.add_argument("--withdraw-amount", type=int, default=60000)
+    parser.add_argument("--deposit-amount", type=int, default=200000)
+    parser.add_argument("--balance", type=int, default=1000000)
+    parser.add_argument("--user-prefix", default="loadtest-")
+    parser.add_argument("--seed-redis", action="store_true")
+    parser.add_argument("--timeout", type=float, default=30)
+    print(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""
+Fake LND REST node for load tests and local runs, no bitcoin or lnd needed.
+
+    python -m <package>.bench.mock_lnd --port 8080 --latency 0.02 --failure-rate 0.01
+
+Point the service at it with LND_HOST=http://127.0.0.1:8080 and any
+MACAROON_PATH file. Invoices created with /v1/invoices settle after
+--settle-after seconds, payments made through /v1/channels/transactions or
+/v2/router/send are published on /v2/router/payments. Stream events can be
+held back and released in bursts with --burst-size / --burst-interval.
+With --replay the subscription streams play a recording made with
+RECORD_DIR (see recording.py) instead, --speed 10 plays it 10x faster.
+
+Bolt11 strings are synthetic, `lnmock<sat>1<payment hash hex>`, so wallets
+(see loadtest.py) can build invoices without talking to this server.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from typing import Optional
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import secrets
+import time
+
+
+BOLT11_RE = re.compile(r"^lnmock(\d+)1([0-9a-f]{64})$")
+
+
+class MockConfig(BaseModel):
+    latency: float = 0.0            # mean added latency per unary call, seconds
+    jitter: float = 0.0             # +- uniform jitter on latency
+    failure_rate: float = 0.0       # share of unary calls answered with 500
+    payment_failure_rate: float = 0.0
+    payment_latency: float = 0.05   # time a payment stays in flight
+    settle_after: float = 1.0       # negative keeps created invoices open
+    burst_size: int = 1             # stream events released per burst
+    burst_interval: float = 0.0     # max hold time of a partial burst
+    channels: int = 4
+    channel_capacity: int = 10_000_000
+    replay: str = ""                # recording to play on the streams
+    speed: float = 1.0              # replay speed factor
+
+
+def make_bolt11(amount: int, payment_hash: Optional[str] = None) -> str:
+    return f"lnmock{amount}1{payment_hash or secrets.token_hex(32)}"
+
+
+def b64(hex_str: str) -> str:
+    return base64.b64encode(bytes.fromhex(hex_str)).decode()
+
+
+class Broadcaster:
+    """
+    Fan out stream events to subscribers, optionally in bursts
+    """
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.subscribers: list[asyncio.Queue] = []
+        self.pending: list[dict] = []
+        self.flusher: Optional[asyncio.Task] = None
+
+    def publish(self, event: dict):
+        if self.config.burst_size <= 1:
+            self._deliver([event])
+            return
+        self.pending.append(event)
+        if len(self.pending) >= self.config.burst_size:
+            self._flush()
+        elif self.flusher is None and self.config.burst_interval > 0:
+            self.flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.config.burst_interval)
+        self.flusher = None
+        self._flush()
+
+    def _flush(self):
+        events, self.pending = self.pending, []
+        self._deliver(events)
+
+    def _deliver(self, events: list[dict]):
+        for queue in self.subscribers:
+            for event in events:
+                queue.put_nowait(event)
+
+    async def stream(self):
+        queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                yield json.dumps({"result": event}) + "\n"
+        finally:
+            self.subscribers.remove(queue)
+
+
+class Replay:
+    """
+    Recorded stream lines played back per stream with the recorded spacing
+    divided by `speed`. The clock starts with the first subscription and is
+    shared, so streams keep their timing relative to each other.
+    """
+    def __init__(self, path: str, speed: float):
+        self.speed = speed
+        self.lines: dict[str, list[tuple[float, str]]] = {}
+        with open(path) as f:
+            for raw in f:
+                record = json.loads(raw)
+                if record.get("kind") == "lnd":
+                    self.lines.setdefault(record["stream"], []).append((record["t"], record["line"]))
+        self.t0 = min((lines[0][0] for lines in self.lines.values()), default=0)
+        self.started: Optional[float] = None
+
+    async def stream(self, name: str):
+        if self.started is None:
+            self.started = time.monotonic()
+        for t, line in self.lines.get(name, ()):
+            delay = self.started + (t - self.t0) / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield line + "\n"
+        # LND keeps subscriptions open
+        while True:
+            await asyncio.sleep(3600)
+            yield ""
+
+
+class MockLnd:
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.invoices: dict[str, dict] = {}
+        self.payments: dict[str, dict] = {}
+        self.invoice_events = Broadcaster(config)
+        self.payment_events = Broadcaster(config)
+        self.pubkey = "02" + hashlib.sha256(b"mock-lnd").hexdigest()
+        self.replay = Replay(config.replay, config.speed) if config.replay else None
+        self.stats = {"unary": 0, "failed": 0, "invoices": 0, "payments": 0}
+
+    async def unary(self) -> Optional[JSONResponse]:
+        """
+        Simulated latency and failures, returns an error response or None
+        """
+        self.stats["unary"] += 1
+        delay = self.config.latency + random.uniform(-self.config.jitter, self.config.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if random.random() < self.config.failure_rate:
+            self.stats["failed"] += 1
+            return JSONResponse({"code": 2, "message": "mock failure"}, status_code=500)
+        return None
+
+    def decode(self, bolt11: str) -> Optional[dict]:
+        match = BOLT11_RE.match(bolt11)
+        if match is None:
+            return None
+        amount, payment_hash = int(match.group(1)), match.group(2)
+        return {
+            "destination": "03" + hashlib.sha256(payment_hash.encode()).hexdigest(),
+            "payment_hash": payment_hash,
+            "num_satoshis": amount,
+            "timestamp": str(int(time.time())),
+            "expiry": "3600",
+            "description": "",
+            "description_hash": "",
+            "fallback_addr": "",
+            "cltv_expiry": "40",
+            "route_hints": [],
+            "payment_addr": b64(secrets.token_hex(32)),
+            "features": {},
+        }
+
+    def add_invoice(self, data: dict) -> dict:
+        preimage = secrets.token_hex(32)
+        payment_hash = hashlib.sha256(bytes.fromhex(preimage)).hexdigest()
+        amount = int(data.get("value", 0))
+        invoice = {
+            "r_hash": b64(payment_hash),
+            "r_preimage": b64(preimage),
+            "payment_request": make_bolt11(amount, payment_hash),
+            "add_index": str(len(self.invoices) + 1),
+            "payment_addr": b64(secrets.token_hex(32)),
+            "value": amount,
+            "creation_date": str(int(time.time())),
+            "expiry": str(data.get("expiry", 3600)),
+            "memo": data.get("memo", ""),
+            "description_hash": data.get("description_hash", ""),
+            "fallback_addr": "",
+            "cltv_expiry": "40",
+            "route_hints": [],
+            "features": {},
+            "state": "OPEN",
+        }
+        self.invoices[payment_hash] = invoice
+        self.stats["invoices"] += 1
+        self.invoice_events.publish(invoice)
+        if self.config.settle_after >= 0:
+            asyncio.get_running_loop().call_later(self.config.settle_after, self.settle, payment_hash)
+        return invoice
+
+    def settle(self, payment_hash: str):
+        invoice = self.invoices.get(payment_hash)
+        if invoice is None or invoice["state"] != "OPEN":
+            return
+        invoice["state"] = "SETTLED"
+        invoice["settle_date"] = str(int(time.time()))
+        self.invoice_events.publish(dict(invoice))
+
+    async def pay(self, bolt11: str, fee_limit_sat: int) -> dict:
+        decoded = self.decode(bolt11)
+        if decoded is None:
+            return {"payment_error": "invalid payment request"}
+        payment_hash = decoded["payment_hash"]
+        amount = decoded["num_satoshis"]
+        payment = {
+            "payment_hash": payment_hash,
+            "value_sat": str(amount),
+            "fee_sat": "0",
+            "payment_preimage": "",
+            "status": "IN_FLIGHT",
+            "creation_date": str(int(time.time())),
+        }
+        self.payments[payment_hash] = payment
+        self.stats["payments"] += 1
+        self.payment_events.publish(dict(payment))
+        await asyncio.sleep(self.config.payment_latency)
+
+        if random.random() < self.config.payment_failure_rate:
+            payment.update(status="FAILED", failure_reason="FAILURE_REASON_NO_ROUTE")
+            self.payment_events.publish(dict(payment))
+            return {"payment_error": "unable to find a path to destination", "payment_hash": b64(payment_hash)}
+
+        fee = min(fee_limit_sat, max(1, amount // 100_000))
+        payment.update(status="SUCCEEDED", fee_sat=str(fee), payment_preimage=secrets.token_hex(32))
+        self.payment_events.publish(dict(payment))
+        return {
+            "payment_error": "",
+            "payment_hash": b64(payment_hash),
+            "payment_preimage": b64(payment["payment_preimage"]),
+            "payment_route": {"total_fees_msat": str(fee * 1000), "total_amt": str(amount + fee)},
+        }
+
+    def channels(self) -> list[dict]:
+        capacity = self.config.channel_capacity
+        return [
+            {
+                "active": True,
+                "remote_pubkey": "03" + hashlib.sha256(str(i).encode()).hexdigest(),
+                "chan_id": str(1000 + i),
+                "capacity": str(capacity),
+                "local_balance": str(capacity // 2),
+                "remote_balance": str(capacity // 2),
+                "local_chan_reserve_sat": str(capacity // 100),
+                "remote_chan_reserve_sat": str(capacity // 100),
+                "pending_htlcs": [],
+            }
+            for i in range(self.config.channels)
+        ]
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI()
+    lnd = MockLnd(config)
+    app.state.lnd = lnd
+
+    @app.get("/v1/payreq/{pay_req}")
+    async def decode_payreq(pay_req: str):
+        if (error := await lnd.unary()) is not None:
+            return error
+        decoded = lnd.decode(pay_req)
+        if decoded is None:
+            return JSONResponse({"code": 2, "message": "invalid index", "payment_error": "invalid index"}, status_code=400)
+        return decoded
+
+    @app.post("/v1/invoices")
+    async def add_invoice(request: Request):
+        if (error := await lnd.unary()) is not None:
+            return error
+        return lnd.add_invoice(await request.json())
+
+    @app.get("/v1/invoice/{payment_hash}")
+    async def lookup_invoice(payment_hash: str):
+        if (error := await lnd.unary()) is not None:
+            return error
+        invoice = lnd.invoices.get(payment_hash)
+        if invoice is None:
+            return JSONResponse({"code": 5, "message": "unable to locate invoice"}, status_code=404)
+        return {**invoice, "settled": invoice["state"] == "SETTLED"}
+
+    @app.get("/v1/invoices/subscribe")
+    async def subscribe_invoices():
+        if lnd.replay is not None:
+            return StreamingResponse(lnd.replay.stream("invoices"), media_type="application/json")
+        return StreamingResponse(lnd.invoice_events.stream(), media_type="application/json")
+
+    @app.post("/v1/channels/transactions")
+    async def send_payment_sync(request: Request):
+        if (error := await lnd.unary()) is not None:
+            return error
+        data = await request.json()
+        fee_limit = int((data.get("fee_limit") or {}).get("fixed", 10**9))
+        return await lnd.pay(data.get("payment_request", ""), fee_limit)
+
+    @app.post("/v2/router/send")
+    async def send_payment_v2(request: Request):
+        data = await request.json()
+
+        async def updates():
+            decoded = lnd.decode(data.get("payment_request", ""))
+            if decoded is None:
+                yield json.dumps({"error": {"message": "invalid payment request"}}) + "\n"
+                return
+            yield json.dumps({"result": {"payment_hash": decoded["payment_hash"], "status": "IN_FLIGHT"}}) + "\n"
+            await lnd.pay(data["payment_request"], int(data.get("fee_limit_sat", 10**9)))
+            yield json.dumps({"result": lnd.payments[decoded["payment_hash"]]}) + "\n"
+
+        return StreamingResponse(updates(), media_type="application/json")
+
+    @app.get("/v2/router/payments")
+    async def track_payments():
+        if lnd.replay is not None:
+            return StreamingResponse(lnd.replay.stream("payments"), media_type="application/json")
+        return StreamingResponse(lnd.payment_events.stream(), media_type="application/json")
+
+    @app.get("/v1/channels")
+    async def list_channels():
+        if (error := await lnd.unary()) is not None:
+            return error
+        return {"channels": lnd.channels()}
+
+    @app.get("/v1/channels/subscribe")
+    async def subscribe_channels():
+        if lnd.replay is not None:
+            return StreamingResponse(lnd.replay.stream("channels"), media_type="application/json")
+
+        async def idle():
+            while True:
+                await asyncio.sleep(3600)
+                yield ""
+        return StreamingResponse(idle(), media_type="application/json")
+
+    @app.get("/v1/balance/channels")
+    async def channel_balance():
+        if (error := await lnd.unary()) is not None:
+            return error
+        return {"balance": str(sum(int(c["local_balance"]) for c in lnd.channels()))}
+
+    @app.get("/v1/graph/routes/{pub_key}/{amount}")
+    async def query_routes(pub_key: str, amount: int):
+        if (error := await lnd.unary()) is not None:
+            return error
+        return {"routes": [{"total_fees_msat": str(max(1000, amount)), "total_amt": str(amount)}]}
+
+    @app.get("/v1/peers")
+    async def list_peers():
+        if (error := await lnd.unary()) is not None:
+            return error
+        return {"peers": [{"pub_key": c["remote_pubkey"]} for c in lnd.channels()]}
+
+    @app.get("/mock/stats")
+    async def stats():
+        return lnd.stats
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    for name, field in MockConfig.model_fields.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=field.annotation, default=field.default)
+    args = parser.parse_args()
+    config = MockConfig(**{name: getattr(args, name) for name in MockConfig.model_fields})
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Throughput and peak memory of PSQLClient read paths over a large result.
+
+    python -m <package>.bench.psql_stream postgresql://... --rows 10000000
+
+Rows come from generate_series so no table is needed. Every mode runs in its
+own process so the reported peak RSS belongs to that mode alone:
+
+    fetchmany        whole result materialised as a list of dicts
+    stream-dict      server-side cursor, dict rows
+    stream-tuple     server-side cursor, tuple rows
+    stream-namedtuple
+    copy-binary      COPY TO STDOUT (FORMAT BINARY) blocks
+"""
+from ..crud import PSQLClient
+import multiprocessing
+import argparse
+import resource
+import asyncio
+import time
+
+
+QUERY = """
+SELECT g AS id, md5(g::text) AS payment_hash, g %% 100000 AS num_satoshis, now() AS timestamp
+FROM generate_series(1, %s) g
+"""
+MODES = ("fetchmany", "stream-dict", "stream-tuple", "stream-namedtuple", "copy-binary")
+
+
+async def consume(conninfo: str, mode: str, rows: int, itersize: int) -> int:
+    psql = PSQLClient(conninfo)
+    await psql.open()
+    try:
+        if mode == "fetchmany":
+            return len(await psql.fetchmany(QUERY, rows))
+        if mode == "copy-binary":
+            size = 0
+            async for block in psql.copy_out(QUERY, rows):
+                size += len(block)
+            return size
+        count = 0
+        async for _ in psql.stream(QUERY, rows, itersize=itersize, rows=mode.split("-")[1]):
+            count += 1
+        return count
+    finally:
+        await psql.close()
+
+
+def run(conninfo: str, mode: str, rows: int, itersize: int, results):
+    start = time.perf_counter()
+    count = asyncio.run(consume(conninfo, mode, rows, itersize))
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is KiB on linux
+    results.put((mode, count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("conninfo")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--itersize", type=int, default=2000)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    print(f"{'mode':18} {'rows/s':>12} {'seconds':>9} {'peak MiB':>9}")
+    for mode in args.modes:
+        process = context.Process(target=run, args=(args.conninfo, mode, args.rows, args.itersize, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"{mode:18} failed with exit code {process.exitcode}")
+            continue
+        mode, count, elapsed, peak = results.get()
+        rate = f"{args.rows / elapsed:12.0f}" if mode != "copy-binary" else f"{count / elapsed / 2**20:8.1f}MiB/s"
+        print(f"{mode:18} {rate:>12} {elapsed:9.2f} {peak:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Replay recordings made with RECORD_DIR (see recording.py).
+
+    python -m <package>.bench.replay http recording.jsonl --base-url http://127.0.0.1:8000 --speed 5
+    python -m <package>.bench.replay streams recording.jsonl --speed 50 [--conninfo postgresql://...]
+
+http     sends the recorded requests to a running app at their recorded
+         offsets divided by --speed, then compares latency per route with
+         the recording. Run the app against mock_lnd.py --replay with the
+         same file to get the LND stream shapes as well.
+streams  feeds the recorded LND stream lines through
+         process_payment_notifications / process_invoice_notifications in
+         this process, no LND and no HTTP. Settlements go to --conninfo, or
+         nowhere to measure the consumers alone. Reports events/s and how
+         far the consumers fell behind the recorded timing.
+
+Settlements only touch rows when the database is restored from the same
+point the recording started at.
+"""
+from ..base import LNDInvoice, PaymentStatus
+from ..crud import PSQLClient
+from ..helpers import PaymentHashIndex
+from ..node import LndRestNode
+from ..tasks import process_invoice_notifications, process_payment_notifications
+from .loadtest import percentile
+import argparse
+import asyncio
+import tempfile
+import json
+import time
+import httpx
+
+STREAM_PATHS = {
+    "/v2/router/payments": "payments",
+    "/v1/invoices/subscribe": "invoices",
+    "/v1/channels/subscribe": "channels",
+}
+
+
+def load(path: str, kind: str) -> list[dict]:
+    with open(path) as f:
+        records = [record for record in map(json.loads, f) if record.get("kind") == kind]
+    return sorted(records, key=lambda record: record["t"])
+
+
+async def paced(records: list[dict], speed: float, started: float):
+    """
+    Records as their recorded offset, divided by `speed`, comes due
+    """
+    t0 = records[0]["t"] if records else 0
+    for record in records:
+        delay = started + (record["t"] - t0) / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield record
+
+
+async def replay_http(args):
+    records = load(args.recording, "http")
+    replayed: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    pending = set()
+
+    async def send(client: httpx.AsyncClient, record: dict):
+        route = record["method"] + " " + record["path"]
+        started = time.perf_counter()
+        try:
+            r = await client.request(
+                record["method"], args.base_url + record["path"] + ("?" + record["query"] if record["query"] else ""),
+                headers=record["headers"], content=record["body"] or None,
+            )
+            failed = r.status_code != record["status"]
+        except httpx.HTTPError:
+            failed = True
+        replayed.setdefault(route, []).append(time.perf_counter() - started)
+        if failed:
+            errors[route] = errors.get(route, 0) + 1
+
+    started = time.monotonic()
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        async for record in paced(records, args.speed, started):
+            task = asyncio.create_task(send(client, record))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+    elapsed = time.monotonic() - started
+
+    recorded: dict[str, list[float]] = {}
+    for record in records:
+        recorded.setdefault(record["method"] + " " + record["path"], []).append(record["seconds"])
+    print(f"{len(records)} requests in {elapsed:.1f}s at {args.speed}x")
+    print(f"{'route':<32}{'count':>7}{'status !=':>10}{'rec p50':>9}{'p50 ms':>9}{'rec p99':>9}{'p99 ms':>9}")
+    for route, values in sorted(replayed.items()):
+        values, before = sorted(values), sorted(recorded[route])
+        print(f"{route:<32}{len(values):>7}{errors.get(route, 0):>10}{percentile(before, 50):>9.1f}"
+              f"{percentile(values, 50):>9.1f}{percentile(before, 99):>9.1f}{percentile(values, 99):>9.1f}")
+
+
+class NullPSQL:
+    """
+    Settlement sink for measuring the consumers alone
+    """
+    async def finalize_payment(self, payment: PaymentStatus):
+        pass
+
+    async def failed_payment(self, payment: PaymentStatus):
+        pass
+
+    async def deposit_finalize(self, invoice: LNDInvoice):
+        pass
+
+
+class CountingPSQL:
+    """
+    Counts settlements to tell when the replay is done
+    """
+    def __init__(self, psql):
+        self.psql = psql
+        self.settled = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def count(self):
+        self.settled += 1
+        if self.settled >= self.expected:
+            self.done.set()
+
+    async def finalize_payment(self, payment: PaymentStatus):
+        await self.psql.finalize_payment(payment)
+        self.count()
+
+    async def failed_payment(self, payment: PaymentStatus):
+        await self.psql.failed_payment(payment)
+        self.count()
+
+    async def deposit_finalize(self, invoice: LNDInvoice):
+        await self.psql.deposit_finalize(invoice)
+        self.count()
+
+
+def settlements(records: list[dict]) -> int:
+    """
+    Recorded lines the consumers turn into a settlement call
+    """
+    count = 0
+    for record in records:
+        try:
+            result = json.loads(record["line"]).get("result") or {}
+        except ValueError:
+            continue
+        if record["stream"] == "payments" and result.get("status") in ("SUCCEEDED", "FAILED"):
+            count += 1
+        elif record["stream"] == "invoices" and result.get("state") == "SETTLED":
+            count += 1
+    return count
+
+
+def replay_transport(records: list[dict], speed: float, started: float) -> httpx.MockTransport:
+    """
+    Serves each stream once from the recording, later subscriptions stay idle
+    """
+    served = set()
+
+    async def idle():
+        await asyncio.Event().wait()
+        yield b""
+
+    async def lines(stream: str):
+        async for record in paced(records, speed, started):
+            if record["stream"] == stream:
+                yield (record["line"] + "\n").encode()
+        await asyncio.Event().wait()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        stream = STREAM_PATHS.get(request.url.path)
+        if stream is None:
+            return httpx.Response(404)
+        if stream in served:
+            return httpx.Response(200, content=idle())
+        served.add(stream)
+        return httpx.Response(200, content=lines(stream))
+
+    return httpx.MockTransport(handler)
+
+
+async def replay_streams(args):
+    records = load(args.recording, "lnd")
+    if args.node:
+        records = [record for record in records if record["node"] == args.node]
+    if not records:
+        raise SystemExit("no LND stream lines in the recording")
+
+    psql = None
+    if args.conninfo:
+        # payment and invoice lanes can each hold a connection
+        psql = PSQLClient(args.conninfo, max_size=2 * args.lanes + 1)
+        await psql.open()
+    sink = CountingPSQL(psql or NullPSQL())
+    sink.expected = settlements(records)
+
+    with tempfile.NamedTemporaryFile() as macaroon:
+        macaroon.write(b"replay")
+        macaroon.flush()
+        node = LndRestNode(name="replay", endpoint="http://replay", macaroon_path=macaroon.name)
+    await node.stream_client.aclose()
+    started = time.monotonic()
+    node.stream_client = httpx.AsyncClient(base_url=node.endpoint, transport=replay_transport(records, args.speed, started))
+    consumers = [
+        asyncio.create_task(process_payment_notifications(node, sink, args.lanes, args.lane_size)),
+        asyncio.create_task(process_invoice_notifications(node, sink, PaymentHashIndex(), args.lanes, args.lane_size)),
+    ]
+    try:
+        await asyncio.wait_for(sink.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"timed out after {args.timeout}s")
+    elapsed = time.monotonic() - started
+    for task in consumers:
+        task.cancel()
+    await asyncio.gather(*consumers, return_exceptions=True)
+    await node.cleanup()
+    if psql is not None:
+        await psql.close()
+
+    duration = (records[-1]["t"] - records[0]["t"]) / args.speed
+    print(f"{len(records)} stream lines, {sink.settled}/{sink.expected} settlements in {elapsed:.2f}s "
+          f"({sink.settled / elapsed:.0f}/s), recording plays in {duration:.2f}s at {args.speed}x, "
+          f"finished {max(0.0, elapsed - duration):.2f}s after the last line")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=("http", "streams"))
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--conninfo", help="settle into this database, streams mode")
+    parser.add_argument("--node", help="only this node's streams, streams mode")
+    parser.add_argument("--lanes", type=int, default=8)
+    parser.add_argument("--lane-size", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(replay_http(args) if args.mode == "http" else replay_streams(args))
+
+
+if __name__ == "__main__":
+    main()
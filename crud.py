@@ -1,321 +1,950 @@
-from .base import LNDInvoice, WithdrawRequest, LNPayment, PaymentStatus, DepositRequest
-from datetime import datetime
-import asyncio
-import psycopg_pool
-import psycopg
-from psycopg.rows import dict_row
-
-
-def lock_function(func):
-    async def wrapper(*args, **kwargs):
-        async with asyncio.Lock():
-            return await func(*args, **kwargs)
-    return wrapper
-
-
-class PSQLClient:
-
-    def __init__(self, conninfo):
-        self.pool = psycopg_pool.AsyncConnectionPool(conninfo=conninfo)
-
-    async def execute(self, q: str, *args):
-        async with self.pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(q, args)
-
-    async def fetchone(self, q: str, *args) -> dict:
-        async with self.pool.connection() as conn:
-            async with conn.cursor(row_factory=dict_row) as cur:
-                print("ARGS", args)
-                await cur.execute(q, args)
-                row = await cur.fetchone()
-                return row
-    
-    async def fetchmany(self, q: str, *args) -> list[dict]:
-        async with self.pool.connection() as conn:
-            async with conn.cursor(row_factory=dict_row) as cur:
-                await cur.execute(q, args)
-                rows = await cur.fetchall()
-                return rows
-
-    """
-    WITHDRAW
-    """
-
-    async def create_withdraw_request(self, request: WithdrawRequest) -> None:
-        q = """
-        INSERT INTO withdraw_requests 
-            (
-                userid, k1, clearnet_url, lnurlw, lnurl, status, ts_created
-            )
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """
-        return await self.execute(q, *request.model_dump(exclude_none=True, exclude={"redeemed"}).values())
-
-
-    async def get_withdraw_request(self, k1) -> WithdrawRequest:
-        q = """
-        SELECT * 
-        FROM withdraw_requests
-        WHERE k1 = %s
-        """
-        row = await self.fetchone(q, k1)
-        if row is not None:
-            return WithdrawRequest(**row)
-
-
-    async def get_pending_requests(self, userid: str) -> int:
-        q = """
-        SELECT COUNT(k1) as pending
-        FROM withdraw_requests
-        WHERE userid = %s
-        AND status NOT IN ('PAID', 'SETTLED', 'REJECTED', 'PAYMENT_FAILED')
-        AND ts_created > %s
-        """
-        ts = int(datetime.utcnow().timestamp() - 60*5)
-        count_requests = await self.fetchone(q, userid, ts)
-        return count_requests.get("pending", 0)
-
-    async def withdraw_bad_invoice(self, k1: str, invoice: LNDInvoice, reason: str = ""):
-        q = """
-        UPDATE withdraw_requests
-        SET redeemed = %s,
-        payment_hash = %s,
-        ts_invoice = %s,
-        amount = %s,
-        destination = %s,
-        status = 'REJECTED',
-        reason = %s
-        WHERE k1 = %s
-        """
-        current_time = int(datetime.utcnow().timestamp())
-        return await self.execute(q, True, invoice.payment_hash, current_time, invoice.num_satoshis, invoice.destination, reason, k1)
-
-
-    @lock_function
-    async def withdraw_redeem_request(self, k1: str, invoice: LNDInvoice):
-        q1 = """
-        SELECT *
-        FROM withdraw_requests
-        WHERE k1 = %s
-        AND status = 'VERIFIED'
-        """
-        q2 = f"""
-        UPDATE withdraw_requests
-        SET redeemed = {True},
-        payment_hash = %s,
-        bolt11 = %s,
-        ts_invoice = %s,
-        amount = %s,
-        destination = %s,
-        status = 'QUEUED'
-        WHERE k1 = %s
-        """
-        q3 = """
-        UPDATE balances
-        SET amount = balances.amount -%s
-        FROM withdraw_requests
-        WHERE balances.userid = withdraw_requests.userid
-        AND withdraw_requests.k1 = %s
-        """
-        q4 = """
-        INSERT INTO locked_balances(payment_hash, amount)
-        VALUES (%s, %s)
-        ON CONFLICT DO NOTHING
-        """
-        current_time = int(datetime.utcnow().timestamp())
-        async with self.pool.connection() as conn:
-            await conn.set_autocommit(True)
-            async with conn.cursor(row_factory=dict_row) as cur:
-                cur: psycopg.Cursor
-                await cur.execute(q1, (k1, ))
-                request = await cur.fetchone()
-                if request is None:
-                    return None
-                async with conn.transaction():
-                    await cur.execute(q2, (invoice.payment_hash, invoice.bolt11, current_time, invoice.num_satoshis, invoice.destination, k1))
-                    await cur.execute(q3, (invoice.num_satoshis, k1))
-                    await cur.execute(q4, (invoice.payment_hash, invoice.num_satoshis))
-                await self.register_invoice(invoice)
-                await self.create_payment(request, invoice)                
-        # asyncio.create_task(self.register_invoice(invoice))
-        # asyncio.create_task(self.create_payment(request, invoice))
-        return WithdrawRequest(**request)
-
-
-    async def register_invoice(self, invoice: LNDInvoice) -> None:
-        q = """
-        INSERT INTO withdraw_invoices
-            (
-                payment_hash, bolt11, state, destination, num_satoshis, timestamp, expiry, description,
-                description_hash, fallback_addr, cltv_expiry, route_hints, payment_addr, features
-            )
-        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        print("MODEL DUMP", invoice.model_dump(exclude={"preimage"}))
-        return await self.execute(q, *invoice.model_dump(exclude={"preimage"}).values())
-
-
-    async def update_withdraw_status(self, status: str, k1: str = None, hash: str = None, reason: str = "") -> None:
-        if hash is not None:
-            q = f"""
-            UPDATE withdraw_requests
-            SET status = %s,
-            reason = %s
-            WHERE payment_hash = '{hash}'
-            """
-        elif k1 is not None:
-            q = f"""
-            UPDATE withdraw_requests
-            SET status = %s,
-            reason = %s
-            WHERE k1 = '{k1}'
-            """
-        return await self.execute(q, status, reason)
-    
-    async def create_withdraw_transaction(self, request: WithdrawRequest):
-        q = """
-        INSERT INTO withdraw_transactions (userid, payment_hash, amount)
-        VALUES (%s, %s, %s)
-        ON CONFLICT DO NOTHING
-        """
-        return await self.execute(request.userid, request.payment_hash, request.invoice_amt)
-
-    async def create_payment(self, request: dict, invoice: LNDInvoice):
-        q = """
-        INSERT INTO withdraw_payments (payment_hash, userid, value_sat, ts_create)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT DO NOTHING
-        """
-        current_time = int(datetime.utcnow().timestamp())
-        return await self.execute(q, invoice.payment_hash, request["userid"], invoice.num_satoshis, current_time)
-
-
-    async def remove_from_lock(self, payment_hash: str):
-        q = """
-        DELETE FROM locked_balances
-        WHERE payment_hash = %s
-        """
-        return await self.execute(q, payment_hash)
-    
-
-    async def finalize_payment(self, payment: LNPayment):
-        q = """
-        UPDATE withdraw_payments
-        SET preimage = %s,
-        fee_sat = %s,
-        status = %s
-        WHERE payment_hash = %s
-        """
-        q2 = """
-        DELETE FROM locked_balances
-        WHERE payment_hash = %s
-        """
-        q3 = """
-        INSERT INTO withdraw_transactions (payment_hash, userid, amount, ts_create)
-        SELECT %s, userid, %s, %s
-        FROM withdraw_requests
-        WHERE payment_hash = %s
-        """
-        q4 = """
-        UPDATE withdraw_requests
-        SET status = 'PAID'
-        WHERE payment_hash = %s
-        """
-        q5 = """
-        UPDATE withdraw_invoices
-        SET preimage = %s
-        WHERE payment_hash = %s
-        """
-        current_time = int(datetime.utcnow().timestamp())
-        async with self.pool.connection() as conn:
-            await conn.set_autocommit(True)
-            async with conn.cursor(row_factory=dict_row) as cur:
-                async with conn.transaction():
-                    await cur.execute(q, (payment.payment_preimage, payment.fee_sat, payment.status, payment.payment_hash))
-                    await cur.execute(q2, (payment.payment_hash, ))
-                    await cur.execute(q3, (payment.payment_hash, payment.value_sat, current_time, payment.payment_hash))
-                await cur.execute(q4, (payment.payment_hash, ))
-                await cur.execute(q5, (payment.payment_preimage, payment.payment_hash))
-                return
-
-    async def failed_payment(self, payment: PaymentStatus):
-        q = """
-        UPDATE withdraw_payments
-        SET status = "FAILED"
-        WHERE payment_hash = %s
-        """
-        self.update_withdraw_status(hash=payment.payment_hash, status="PAYMENT_FAILED")
-        return await self.execute(q, payment.payment_hash)
-    
-    """
-    DEPOSIT
-    """
-
-    async def get_user_by_k1(self, k1: str):
-        q = """
-        SELECT userid
-        FROM users
-        WHERE k1 = %s
-        """
-        return await self.execute(q, k1)
-    
-    async def deposit_request_create(self, request: DepositRequest, invoice: LNDInvoice):
-        q = """
-        INSERT INTO deposit_requests(userid, payment_hash, status, ts_created)
-        VALUES (%s, %s, %s, %s)
-        """
-        await self.deposit_invoice_create(invoice)
-        return await self.execute(q, request.userid, request.payment_hash, request.status, request.ts_created)
-
-    async def deposit_invoice_create(self, invoice: LNDInvoice):
-        q = """
-        INSERT INTO deposit_invoices
-        (
-            payment_hash, bolt11, destination, num_satoshis, timestamp, expiry, description,
-            description_hash, fallback_addr, cltv_expiry, route_hints, payment_addr, features
-        )
-        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        return await self.execute(q, invoice.model_dump().values())
-    
-    async def deposit_create_transaction(self, invoice: LNDInvoice):
-        q = """
-        INSERT INTO deposit_transactions(userid, payment_hash, amount, ts_create)
-        VALUES (%s, %s, %s, %s)
-        """
-        return await self.execute(q, invoice)
-    
-    async def deposit_finalize(self, invoice: LNDInvoice):
-        q = """
-        UPDATE deposit_invoices
-        SET state = %s
-        WHERE payment_hash = %s
-        """
-        q2 = """
-        INSERT INTO deposit_transactions(userid, payment_hash, amount, ts_create)
-        SELECT userid, %s, %s, %s
-        FROM deposit_requests
-        WHERE payment_hash = %s
-        """
-        q3 = """
-        UPDATE balances
-        SET amount = balances.amount + %s
-        FROM deposit_requests
-        WHERE balances.userid = deposit_requests.userid
-        AND deposit_requests.payment_hash = %s;
-        """
-        q4 = """
-        UPDATE deposit_requests
-        SET status = "SETTLED"
-        WHERE payment_hash = %s
-        """
-        current_time = int(datetime.utcnow().timestamp())
-        async with self.pool.connection() as conn:
-            async with conn.cursor(row_factory=dict_row) as cur:
-                async with conn.transaction():
-                    await cur.execute(q, (invoice.state, invoice.payment_hash))
-                    await cur.execute(q2, (invoice.payment_hash, invoice.num_satoshis, current_time, invoice.payment_hash))
-                    await cur.execute(q3, (invoice.num_satoshis, invoice.payment_hash))
-                    await cur.execute(q3, (invoice.num_satoshis, invoice.payment_hash,))
-                return
\ No newline at end of file
+from .base import LNDInvoice, WithdrawRequest, LNPayment, PaymentStatus, DepositRequest
+from datetime import date, datetime
+from typing import AsyncIterator, Awaitable, Callable, Literal, Optional
+import asyncio
+import psycopg_pool
+import psycopg
+from psycopg.rows import dict_row, tuple_row, namedtuple_row
+from psycopg.types.json import Jsonb
+from .metrics import instrument, DB_SECONDS, WITHDRAW_STATUS, DEPOSIT_STATUS
+from .tracing import trace_methods
+from .events import STATUS_CHANNEL
+from .helpers import random_k1, gather_all
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# read replicas, see PSQLClient.read_pool
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_TIMEOUT = float(os.getenv("REPLICA_TIMEOUT", 1))
+
+# rows fetched per round trip by PSQLClient.stream
+STREAM_ITERSIZE = int(os.getenv("STREAM_ITERSIZE", 2000))
+ROW_FACTORIES = {"dict": dict_row, "tuple": tuple_row, "namedtuple": namedtuple_row}
+
+# keyset start of the first history page, above any ts_create
+HISTORY_START = 2**63 - 1
+
+
+# status change notifications, see events.py
+WITHDRAW_NOTIFY = f"""
+SELECT pg_notify('{STATUS_CHANNEL}', json_build_object(
+    'kind', 'withdraw', 'userid', userid, 'payment_hash', payment_hash, 'status', status
+)::text)
+FROM withdraw_requests
+WHERE payment_hash = %s
+"""
+DEPOSIT_NOTIFY = f"""
+SELECT pg_notify('{STATUS_CHANNEL}', json_build_object(
+    'kind', 'deposit', 'userid', userid, 'payment_hash', payment_hash, 'status', status
+)::text)
+FROM deposit_requests
+WHERE payment_hash = %s
+"""
+# daily rollups, see db.create_rollup_tables. Rows of a preceding `tx` CTE
+# (userid, amount, ts_create) are added to the day of the user and to one of
+# ROLLUP_SHARDS rows of the global day, so settlements don't queue on one row.
+# Parameters: fee_sat, shard, fee_sat
+ROLLUP_SHARDS = int(os.getenv("ROLLUP_SHARDS", 16))
+UTC_DAY = "(to_timestamp(ts_create) AT TIME ZONE 'UTC')::date"
+
+
+def rollup(kind: str) -> str:
+    return f"""
+, user_day AS (
+    INSERT INTO daily_user_totals AS t (userid, day, {kind}_sat, {kind}_count, fee_sat)
+    SELECT userid, {UTC_DAY}, amount, 1, %s
+    FROM tx
+    ON CONFLICT (userid, day) DO UPDATE
+    SET {kind}_sat = t.{kind}_sat + EXCLUDED.{kind}_sat,
+        {kind}_count = t.{kind}_count + 1,
+        fee_sat = t.fee_sat + EXCLUDED.fee_sat
+)
+INSERT INTO daily_totals AS t (day, shard, {kind}_sat, {kind}_count, fee_sat)
+SELECT {UTC_DAY}, %s, amount, 1, %s
+FROM tx
+ON CONFLICT (day, shard) DO UPDATE
+SET {kind}_sat = t.{kind}_sat + EXCLUDED.{kind}_sat,
+    {kind}_count = t.{kind}_count + 1,
+    fee_sat = t.fee_sat + EXCLUDED.fee_sat
+"""
+
+
+def rollup_shard(payment_hash: str) -> int:
+    return int(payment_hash[:8], 16) % ROLLUP_SHARDS
+
+
+# side effects of a status change, written in the same transaction and
+# delivered by the outbox relay, see outbox.py. Callers only add it when their
+# update changed the status, delivered events are deleted so the key alone
+# does not stop a repeated settlement. Parameter: payment_hash
+OUTBOX_INSERT = """
+INSERT INTO outbox (event_key, userid, payload, ts_created)
+SELECT '{kind}:' || payment_hash || ':' || status, userid, json_build_object(
+    'kind', '{kind}', 'userid', userid, 'payment_hash', payment_hash, 'status', status
+), extract(epoch FROM now())::bigint
+FROM {kind}_requests
+WHERE payment_hash = %s
+ON CONFLICT (event_key) DO NOTHING
+"""
+WITHDRAW_OUTBOX = OUTBOX_INSERT.format(kind="withdraw")
+DEPOSIT_OUTBOX = OUTBOX_INSERT.format(kind="deposit")
+
+
+REGISTER_INVOICE = """
+INSERT INTO withdraw_invoices
+    (
+        payment_hash, bolt11, state, destination, num_satoshis, timestamp, expiry, description,
+        description_hash, fallback_addr, cltv_expiry, route_hints, payment_addr, features, node
+    )
+VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (payment_hash) DO NOTHING
+"""
+
+
+def lock_function(func):
+    async def wrapper(*args, **kwargs):
+        async with asyncio.Lock():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+@trace_methods("db")
+@instrument(DB_SECONDS, "db")
+class PSQLClient:
+
+    def __init__(self, conninfo, replicas: Optional[list[str]] = None, max_size: Optional[int] = None):
+        self.conninfo = conninfo
+        # max_size defaults to the pool's min_size of 4
+        self.pool = psycopg_pool.AsyncConnectionPool(conninfo=conninfo, open=False, max_size=max_size)
+        # read-only queries passing replica=True, round-robin over healthy ones
+        self.replicas = [
+            psycopg_pool.AsyncConnectionPool(conninfo=replica, open=False, timeout=REPLICA_TIMEOUT)
+            for replica in replicas or ()
+        ]
+        self.replica_healthy = [True] * len(self.replicas)
+        self.replica_index = 0
+
+    async def open(self):
+        # connections are made in the background, requests wait for the first one
+        await self.pool.open(wait=False)
+        for replica in self.replicas:
+            await replica.open(wait=False)
+
+    async def close(self):
+        await gather_all(self.pool.close(), *(replica.close() for replica in self.replicas))
+
+    async def check(self) -> bool:
+        return await self.fetchone("SELECT 1 AS ok") is not None
+
+    def read_pool(self) -> Optional[psycopg_pool.AsyncConnectionPool]:
+        """
+        Next healthy replica, None when there is none
+        """
+        for _ in self.replicas:
+            self.replica_index = (self.replica_index + 1) % len(self.replicas)
+            if self.replica_healthy[self.replica_index]:
+                return self.replicas[self.replica_index]
+        return None
+
+    def set_replica_health(self, index: int, healthy: bool):
+        if self.replica_healthy[index] != healthy:
+            logger.warning("replica %s", "up" if healthy else "down", extra={"replica": index})
+        self.replica_healthy[index] = healthy
+
+    async def check_replicas(self):
+        """
+        Mark replicas down when unreachable or lagging more than REPLICA_MAX_LAG
+        """
+        q = """
+        SELECT CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END AS lag
+        """
+        for index, replica in enumerate(self.replicas):
+            try:
+                row = await self._fetch(replica, q, (), single=True)
+                self.set_replica_health(index, float(row["lag"]) <= REPLICA_MAX_LAG)
+            except (psycopg.Error, psycopg_pool.PoolTimeout):
+                self.set_replica_health(index, False)
+
+    async def _fetch(self, pool: psycopg_pool.AsyncConnectionPool, q: str, args: tuple, single: bool):
+        async with pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(q, args)
+                if single:
+                    return await cur.fetchone()
+                return await cur.fetchall()
+
+    async def _read(self, q: str, args: tuple, single: bool, replica: bool):
+        pool = self.read_pool() if replica else None
+        if pool is not None:
+            try:
+                result = await self._fetch(pool, q, args, single)
+                # a missing row may not be replicated yet, read your writes from the primary
+                if result is not None:
+                    return result
+            except (psycopg.OperationalError, psycopg_pool.PoolTimeout):
+                self.set_replica_health(self.replicas.index(pool), False)
+        return await self._fetch(self.pool, q, args, single)
+
+    async def execute(self, q: str, *args):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(q, args)
+
+    async def fetchone(self, q: str, *args, replica: bool = False) -> dict:
+        return await self._read(q, args, single=True, replica=replica)
+    
+    async def fetchmany(self, q: str, *args, replica: bool = False) -> list[dict]:
+        return await self._read(q, args, single=False, replica=replica)
+
+    async def stream(
+        self,
+        q: str,
+        *args,
+        itersize: int = STREAM_ITERSIZE,
+        rows: Literal["dict", "tuple", "namedtuple"] = "dict",
+        replica: bool = False,
+    ) -> AsyncIterator:
+        """
+        Iterate a large result through a server-side cursor, `itersize` rows
+        in memory at a time. tuple/namedtuple rows skip the per-row dict.
+        Holds a pool connection until the iteration ends or is closed
+        """
+        pool = (self.read_pool() if replica else None) or self.pool
+        async with pool.connection() as conn:
+            # named cursors need a transaction block, pooled connections may come back in autocommit
+            async with conn.transaction():
+                async with conn.cursor(name=f"stream_{random_k1()[:16]}", row_factory=ROW_FACTORIES[rows]) as cur:
+                    cur.itersize = itersize
+                    await cur.execute(q, args)
+                    async for row in cur:
+                        yield row
+
+    async def copy_out(
+        self,
+        q: str,
+        *args,
+        format: Literal["binary", "csv"] = "binary",
+        replica: bool = False,
+    ) -> AsyncIterator[bytes]:
+        """
+        Raw COPY TO STDOUT blocks of a query for bulk exports,
+        parameters are bound client side
+        """
+        options = "FORMAT BINARY" if format == "binary" else "FORMAT CSV, HEADER"
+        pool = (self.read_pool() if replica else None) or self.pool
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(f"COPY ({q}) TO STDOUT ({options})", args or None) as copy:
+                    async for block in copy:
+                        yield block
+
+    """
+    WITHDRAW
+    """
+
+    async def create_withdraw_request(self, request: WithdrawRequest) -> None:
+        q = """
+        INSERT INTO withdraw_requests 
+            (
+                userid, k1, clearnet_url, lnurlw, lnurl, status, ts_created
+            )
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+        await self.execute(q, *request.model_dump(exclude_none=True, exclude={"redeemed"}).values())
+        WITHDRAW_STATUS.inc(status=request.status)
+
+
+    async def get_withdraw_request(self, k1) -> WithdrawRequest:
+        q = """
+        SELECT * 
+        FROM withdraw_requests
+        WHERE k1 = %s
+        """
+        row = await self.fetchone(q, k1, replica=True)
+        if row is not None:
+            return WithdrawRequest(**row)
+
+
+    async def get_pending_requests(self, userid: str) -> int:
+        q = """
+        SELECT COUNT(k1) as pending
+        FROM withdraw_requests
+        WHERE userid = %s
+        AND status NOT IN ('PAID', 'SETTLED', 'REJECTED', 'PAYMENT_FAILED')
+        AND ts_created > %s
+        """
+        ts = int(datetime.utcnow().timestamp() - 60*5)
+        # gates new withdrawals, a lagging replica would miss the latest request
+        count_requests = await self.fetchone(q, userid, ts)
+        return count_requests.get("pending", 0)
+
+    async def withdraw_bad_invoice(self, k1: str, invoice: LNDInvoice, reason: str = ""):
+        q = """
+        UPDATE withdraw_requests
+        SET redeemed = %s,
+        payment_hash = %s,
+        ts_invoice = %s,
+        amount = %s,
+        destination = %s,
+        status = 'REJECTED',
+        reason = %s
+        WHERE k1 = %s
+        """
+        current_time = int(datetime.utcnow().timestamp())
+        await self.execute(q, True, invoice.payment_hash, current_time, invoice.num_satoshis, invoice.destination, reason, k1)
+        WITHDRAW_STATUS.inc(status="REJECTED")
+
+
+    @lock_function
+    async def withdraw_redeem_request(self, k1: str, invoice: LNDInvoice, node: str):
+        q1 = """
+        SELECT *
+        FROM withdraw_requests
+        WHERE k1 = %s
+        AND status = 'VERIFIED'
+        """
+        q2 = f"""
+        UPDATE withdraw_requests
+        SET redeemed = {True},
+        payment_hash = %s,
+        bolt11 = %s,
+        ts_invoice = %s,
+        amount = %s,
+        destination = %s,
+        status = 'QUEUED'
+        WHERE k1 = %s
+        """
+        q3 = """
+        UPDATE balances
+        SET amount = balances.amount -%s
+        FROM withdraw_requests
+        WHERE balances.userid = withdraw_requests.userid
+        AND withdraw_requests.k1 = %s
+        """
+        q4 = """
+        INSERT INTO locked_balances(payment_hash, amount)
+        VALUES (%s, %s)
+        ON CONFLICT DO NOTHING
+        """
+        q5 = """
+        INSERT INTO withdraw_payments (payment_hash, userid, value_sat, ts_create, node)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING payment_hash
+        """
+        current_time = int(datetime.utcnow().timestamp())
+        async with self.pool.connection() as conn:
+            await conn.set_autocommit(True)
+            async with conn.cursor(row_factory=dict_row) as cur:
+                cur: psycopg.Cursor
+                await cur.execute(q1, (k1, ))
+                request = await cur.fetchone()
+                if request is None:
+                    return None
+                async with conn.transaction():
+                    # the payment row comes first, an invoice already queued elsewhere debits nothing
+                    await cur.execute(q5, (invoice.payment_hash, request["userid"], invoice.num_satoshis, current_time, node))
+                    if await cur.fetchone() is None:
+                        return None
+                    await cur.execute(q2, (invoice.payment_hash, invoice.bolt11, current_time, invoice.num_satoshis, invoice.destination, k1))
+                    await cur.execute(q3, (invoice.num_satoshis, k1))
+                    await cur.execute(q4, (invoice.payment_hash, invoice.num_satoshis))
+                    await cur.execute(REGISTER_INVOICE, (*invoice.model_dump(exclude={"preimage"}).values(), node))
+                    await cur.execute(WITHDRAW_OUTBOX, (invoice.payment_hash, ))
+                    await cur.execute(WITHDRAW_NOTIFY, (invoice.payment_hash, ))
+                WITHDRAW_STATUS.inc(status="QUEUED")
+        return WithdrawRequest(**request)
+
+
+    async def register_invoice(self, invoice: LNDInvoice, node: str) -> None:
+        return await self.execute(REGISTER_INVOICE, *invoice.model_dump(exclude={"preimage"}).values(), node)
+
+
+    async def update_withdraw_status(self, status: str, k1: str = None, hash: str = None, reason: str = "") -> None:
+        if hash is not None:
+            q = f"""
+            UPDATE withdraw_requests
+            SET status = %s,
+            reason = %s
+            WHERE payment_hash = '{hash}'
+            """
+        elif k1 is not None:
+            q = f"""
+            UPDATE withdraw_requests
+            SET status = %s,
+            reason = %s
+            WHERE k1 = '{k1}'
+            """
+        await self.execute(q, status, reason)
+        WITHDRAW_STATUS.inc(status=status)
+    
+    async def create_withdraw_transaction(self, request: WithdrawRequest):
+        q = """
+        INSERT INTO withdraw_transactions (userid, payment_hash, amount)
+        VALUES (%s, %s, %s)
+        ON CONFLICT DO NOTHING
+        """
+        return await self.execute(request.userid, request.payment_hash, request.invoice_amt)
+
+    async def create_payment(self, request: dict, invoice: LNDInvoice, node: str):
+        q = """
+        INSERT INTO withdraw_payments (payment_hash, userid, value_sat, ts_create, node)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT DO NOTHING
+        """
+        current_time = int(datetime.utcnow().timestamp())
+        return await self.execute(q, invoice.payment_hash, request["userid"], invoice.num_satoshis, current_time, node)
+
+
+    async def create_bulk_payments(self, items: list[tuple[str, LNDInvoice, str]]) -> dict[str, str]:
+        """
+        Debit, lock and queue a batch of (userid, invoice, node) payouts in one transaction.
+        The payment rows are claimed first, so an invoice queued concurrently by
+        /withdraw/ln or another batch comes back as a duplicate. A user's payouts
+        are accepted together only if the balance covers their sum, the claims of
+        the others are released again.
+        Returns payment_hash -> QUEUED | DUPLICATE | INSUFFICIENT_BALANCE
+        """
+        batch = """
+        WITH batch AS (
+            SELECT *
+            FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[], %s::bigint[], %s::text[])
+                AS b(userid, k1, payment_hash, bolt11, destination, amount, node)
+        ),"""
+        q = batch + """
+        claimed AS (
+            INSERT INTO withdraw_payments (payment_hash, userid, value_sat, ts_create, node)
+            SELECT payment_hash, userid, amount, %s, node
+            FROM batch
+            ON CONFLICT (payment_hash) DO NOTHING
+            RETURNING payment_hash
+        )
+        SELECT payment_hash FROM claimed
+        """
+        q2 = batch + """
+        fresh AS (
+            SELECT batch.*
+            FROM batch
+            WHERE batch.payment_hash = ANY(%s::text[])
+        ),
+        totals AS (
+            SELECT userid, SUM(amount) AS amount
+            FROM fresh
+            GROUP BY userid
+        ),
+        debited AS (
+            UPDATE balances
+            SET amount = balances.amount - totals.amount
+            FROM totals
+            WHERE balances.userid = totals.userid
+            AND balances.amount >= totals.amount
+            RETURNING balances.userid
+        ),
+        accepted AS (
+            SELECT fresh.*
+            FROM fresh
+            WHERE fresh.userid IN (SELECT userid FROM debited)
+        ),
+        requests AS (
+            INSERT INTO withdraw_requests
+                (userid, k1, clearnet_url, lnurlw, lnurl, redeemed, status, payment_hash,
+                 bolt11, amount, destination, ts_created, ts_invoice)
+            SELECT userid, k1, '', '', '', TRUE, 'QUEUED', payment_hash,
+                 bolt11, amount, destination, %s, %s
+            FROM accepted
+        ),
+        locked AS (
+            INSERT INTO locked_balances (payment_hash, amount)
+            SELECT payment_hash, amount
+            FROM accepted
+            ON CONFLICT DO NOTHING
+        ),
+        released AS (
+            DELETE FROM withdraw_payments p
+            USING fresh
+            WHERE p.payment_hash = fresh.payment_hash
+            AND fresh.userid NOT IN (SELECT userid FROM debited)
+        )
+        SELECT batch.payment_hash,
+            CASE
+                WHEN accepted.payment_hash IS NOT NULL THEN 'QUEUED'
+                WHEN fresh.payment_hash IS NULL THEN 'DUPLICATE'
+                ELSE 'INSUFFICIENT_BALANCE'
+            END AS status
+        FROM batch
+        LEFT JOIN fresh ON fresh.payment_hash = batch.payment_hash
+        LEFT JOIN accepted ON accepted.payment_hash = batch.payment_hash
+        """
+        columns = (
+            [userid for userid, _, _ in items],
+            [random_k1() for _ in items],
+            [invoice.payment_hash for _, invoice, _ in items],
+            [invoice.bolt11 for _, invoice, _ in items],
+            [invoice.destination for _, invoice, _ in items],
+            [invoice.num_satoshis for _, invoice, _ in items],
+            [node for _, _, node in items],
+        )
+        current_time = int(datetime.utcnow().timestamp())
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                async with conn.transaction():
+                    await cur.execute(q, (*columns, current_time))
+                    claimed = [row["payment_hash"] for row in await cur.fetchall()]
+                    await cur.execute(q2, (*columns, claimed, current_time, current_time))
+                    statuses = {row["payment_hash"]: row["status"] for row in await cur.fetchall()}
+                    queued = [(invoice, node) for _, invoice, node in items if statuses.get(invoice.payment_hash) == "QUEUED"]
+                    if queued:
+                        await cur.executemany(REGISTER_INVOICE, [
+                            (*invoice.model_dump(exclude={"preimage"}).values(), node) for invoice, node in queued
+                        ])
+                        hashes = [(invoice.payment_hash, ) for invoice, _ in queued]
+                        await cur.executemany(WITHDRAW_OUTBOX, hashes)
+                        await cur.executemany(WITHDRAW_NOTIFY, hashes)
+        WITHDRAW_STATUS.inc(len(queued), status="QUEUED")
+        return statuses
+
+    async def remove_from_lock(self, payment_hash: str):
+        q = """
+        DELETE FROM locked_balances
+        WHERE payment_hash = %s
+        """
+        return await self.execute(q, payment_hash)
+    
+
+    async def finalize_payment(self, payment: LNPayment):
+        q = """
+        UPDATE withdraw_payments
+        SET preimage = %s,
+        fee_sat = %s,
+        status = %s
+        WHERE payment_hash = %s
+        """
+        q2 = """
+        DELETE FROM locked_balances
+        WHERE payment_hash = %s
+        """
+        q3 = """
+        WITH tx AS (
+            INSERT INTO withdraw_transactions (payment_hash, userid, amount, ts_create)
+            SELECT %s, userid, %s, %s
+            FROM withdraw_requests
+            WHERE payment_hash = %s
+            ON CONFLICT (payment_hash) DO NOTHING
+            RETURNING userid, amount, ts_create
+        )
+        """ + rollup("withdraw")
+        # only the first settlement moves the status, repeats add no outbox event
+        q4 = """
+        UPDATE withdraw_requests
+        SET status = 'PAID'
+        WHERE payment_hash = %s
+        AND status <> 'PAID'
+        """
+        q5 = """
+        UPDATE withdraw_invoices
+        SET preimage = %s
+        WHERE payment_hash = %s
+        """
+        current_time = int(datetime.utcnow().timestamp())
+        async with self.pool.connection() as conn:
+            await conn.set_autocommit(True)
+            async with conn.cursor(row_factory=dict_row) as cur:
+                async with conn.transaction():
+                    await cur.execute(q, (payment.payment_preimage, payment.fee_sat, payment.status, payment.payment_hash))
+                    await cur.execute(q2, (payment.payment_hash, ))
+                    await cur.execute(q3, (payment.payment_hash, payment.value_sat, current_time, payment.payment_hash,
+                                           payment.fee_sat, rollup_shard(payment.payment_hash), payment.fee_sat))
+                    await cur.execute(q4, (payment.payment_hash, ))
+                    changed = cur.rowcount > 0
+                    if changed:
+                        await cur.execute(WITHDRAW_OUTBOX, (payment.payment_hash, ))
+                await cur.execute(q5, (payment.payment_preimage, payment.payment_hash))
+                await cur.execute(WITHDRAW_NOTIFY, (payment.payment_hash, ))
+                if changed:
+                    WITHDRAW_STATUS.inc(status="PAID")
+                return
+
+    async def failed_payment(self, payment: PaymentStatus):
+        q = """
+        UPDATE withdraw_requests
+        SET status = 'PAYMENT_FAILED',
+        reason = ''
+        WHERE payment_hash = %s
+        AND status <> 'PAYMENT_FAILED'
+        """
+        q2 = """
+        UPDATE withdraw_payments
+        SET status = 'FAILED'
+        WHERE payment_hash = %s
+        """
+        async with self.pool.connection() as conn:
+            await conn.set_autocommit(True)
+            async with conn.cursor() as cur:
+                async with conn.transaction():
+                    await cur.execute(q, (payment.payment_hash, ))
+                    changed = cur.rowcount > 0
+                    await cur.execute(q2, (payment.payment_hash, ))
+                    if changed:
+                        await cur.execute(WITHDRAW_OUTBOX, (payment.payment_hash, ))
+                await cur.execute(WITHDRAW_NOTIFY, (payment.payment_hash, ))
+        if changed:
+            WITHDRAW_STATUS.inc(status="PAYMENT_FAILED")
+    
+    """
+    DEPOSIT
+    """
+
+    async def get_user_by_k1(self, k1: str):
+        q = """
+        SELECT userid
+        FROM users
+        WHERE k1 = %s
+        """
+        row = await self.fetchone(q, k1, replica=True)
+        if row is not None:
+            return row["userid"]
+    
+    async def get_open_deposit_hashes(self) -> list[str]:
+        q = """
+        SELECT payment_hash
+        FROM deposit_requests
+        WHERE status = 'CREATED'
+        """
+        rows = await self.fetchmany(q, replica=True)
+        return [row["payment_hash"] for row in rows]
+
+    async def deposit_request_create(self, request: DepositRequest, invoice: LNDInvoice, node: str):
+        q = """
+        INSERT INTO deposit_requests(userid, payment_hash, status, amount, ts_created)
+        VALUES (%s, %s, %s, %s, %s)
+        """
+        await gather_all(
+            self.deposit_invoice_create(invoice, node),
+            self.execute(q, request.userid, request.payment_hash, request.status, request.amount, request.ts_created),
+        )
+        DEPOSIT_STATUS.inc(status=request.status)
+
+    async def deposit_invoice_create(self, invoice: LNDInvoice, node: str):
+        q = """
+        INSERT INTO deposit_invoices
+        (
+            payment_hash, bolt11, preimage, state, destination, num_satoshis, timestamp, expiry, description,
+            description_hash, fallback_addr, cltv_expiry, route_hints, payment_addr, features, node
+        )
+        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        return await self.execute(q, *invoice.model_dump().values(), node)
+
+    """
+    DEPOSIT INVOICE POOL
+    Pre-created invoices in deposit_invoices with state POOL, bound to a user on claim
+    """
+
+    async def claim_deposit_invoice(self, k1: str, amount: int, min_expiry: int) -> dict | None:
+        """
+        Bind a pooled invoice of `amount` valid until at least `min_expiry`
+        to the user of `k1`, returns userid, payment_hash and bolt11
+        """
+        q = """
+        WITH claimed AS (
+            SELECT deposit_invoices.payment_hash, users.userid
+            FROM deposit_invoices, users
+            WHERE users.k1 = %s
+            AND deposit_invoices.state = 'POOL'
+            AND deposit_invoices.num_satoshis = %s
+            AND deposit_invoices.timestamp + deposit_invoices.expiry > %s
+            ORDER BY deposit_invoices.timestamp
+            LIMIT 1
+            FOR UPDATE OF deposit_invoices SKIP LOCKED
+        ),
+        invoice AS (
+            UPDATE deposit_invoices
+            SET state = 'OPEN'
+            FROM claimed
+            WHERE deposit_invoices.payment_hash = claimed.payment_hash
+            RETURNING claimed.userid, deposit_invoices.payment_hash, deposit_invoices.bolt11, deposit_invoices.num_satoshis
+        ),
+        request AS (
+            INSERT INTO deposit_requests(userid, payment_hash, status, amount, ts_created)
+            SELECT userid, payment_hash, 'CREATED', num_satoshis, %s
+            FROM invoice
+        )
+        SELECT userid, payment_hash, bolt11
+        FROM invoice
+        """
+        current_time = int(datetime.utcnow().timestamp())
+        row = await self.fetchone(q, k1, amount, min_expiry, current_time)
+        if row is not None:
+            DEPOSIT_STATUS.inc(status="CREATED")
+        return row
+
+    async def get_deposit_pool_counts(self, min_expiry: int) -> dict[int, int]:
+        q = """
+        SELECT num_satoshis, COUNT(*) AS available
+        FROM deposit_invoices
+        WHERE state = 'POOL'
+        AND timestamp + expiry > %s
+        GROUP BY num_satoshis
+        """
+        rows = await self.fetchmany(q, min_expiry)
+        return {row["num_satoshis"]: row["available"] for row in rows}
+
+    async def deposit_pool_add(self, invoices: list[tuple[LNDInvoice, str]]):
+        """
+        Add (invoice, node) pairs to the pool
+        """
+        q = """
+        INSERT INTO deposit_invoices
+        (
+            payment_hash, bolt11, preimage, state, destination, num_satoshis, timestamp, expiry, description,
+            description_hash, fallback_addr, cltv_expiry, route_hints, payment_addr, features, node
+        )
+        VALUES(%s, %s, %s, 'POOL', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT DO NOTHING
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(q, [
+                    (*invoice.model_dump(exclude={"state"}).values(), node) for invoice, node in invoices
+                ])
+
+    async def prune_deposit_pool(self, min_expiry: int) -> int:
+        """
+        Drop pooled invoices too close to expiry to hand out
+        """
+        q = """
+        DELETE FROM deposit_invoices
+        WHERE state = 'POOL'
+        AND timestamp + expiry <= %s
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(q, (min_expiry, ))
+                return cur.rowcount
+    
+    async def deposit_create_transaction(self, invoice: LNDInvoice):
+        q = """
+        INSERT INTO deposit_transactions(userid, payment_hash, amount, ts_create)
+        VALUES (%s, %s, %s, %s)
+        """
+        return await self.execute(q, invoice)
+    
+    async def deposit_finalize(self, invoice: LNDInvoice):
+        q = """
+        UPDATE deposit_invoices
+        SET state = %s
+        WHERE payment_hash = %s
+        """
+        # balance and rollups only move when this call inserted the transaction,
+        # a repeated settlement of the same invoice changes nothing
+        q2 = """
+        WITH tx AS (
+            INSERT INTO deposit_transactions(userid, payment_hash, amount, ts_create)
+            SELECT userid, %s, %s, %s
+            FROM deposit_requests
+            WHERE payment_hash = %s
+            ON CONFLICT (payment_hash) DO NOTHING
+            RETURNING userid, amount, ts_create
+        ), credited AS (
+            UPDATE balances
+            SET amount = balances.amount + tx.amount
+            FROM tx
+            WHERE balances.userid = tx.userid
+        )
+        """ + rollup("deposit")
+        q4 = """
+        UPDATE deposit_requests
+        SET status = 'SETTLED'
+        WHERE payment_hash = %s
+        AND status <> 'SETTLED'
+        """
+        current_time = int(datetime.utcnow().timestamp())
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                async with conn.transaction():
+                    await cur.execute(q, (invoice.state, invoice.payment_hash))
+                    await cur.execute(q2, (invoice.payment_hash, invoice.num_satoshis, current_time, invoice.payment_hash,
+                                           0, rollup_shard(invoice.payment_hash), 0))
+                    await cur.execute(q4, (invoice.payment_hash,))
+                    changed = cur.rowcount > 0
+                    if changed:
+                        await cur.execute(DEPOSIT_OUTBOX, (invoice.payment_hash, ))
+                    await cur.execute(DEPOSIT_NOTIFY, (invoice.payment_hash,))
+                if changed:
+                    DEPOSIT_STATUS.inc(status="SETTLED")
+                return
+
+    """
+    HISTORY
+    """
+
+    async def get_history(self, userid: str, limit: int, before: Optional[tuple[int, str]] = None) -> list[dict]:
+        """
+        Settled withdrawals and deposits newest first, keyset paginated on
+        (ts_create, payment_hash) so every page is an index range scan.
+        Reads the primary, a page served right after a settlement must show it
+        """
+        q = """
+        (
+            SELECT 'withdraw' AS kind, payment_hash, amount, ts_create
+            FROM withdraw_transactions
+            WHERE userid = %s AND (ts_create, payment_hash) < (%s, %s)
+            ORDER BY ts_create DESC, payment_hash DESC
+            LIMIT %s
+        )
+        UNION ALL
+        (
+            SELECT 'deposit' AS kind, payment_hash, amount, ts_create
+            FROM deposit_transactions
+            WHERE userid = %s AND (ts_create, payment_hash) < (%s, %s)
+            ORDER BY ts_create DESC, payment_hash DESC
+            LIMIT %s
+        )
+        ORDER BY ts_create DESC, payment_hash DESC
+        LIMIT %s
+        """
+        ts_create, payment_hash = before or (HISTORY_START, "")
+        args = (userid, ts_create, payment_hash, limit)
+        return await self.fetchmany(q, *args, *args, limit)
+
+    """
+    ROLLUPS
+    Daily totals kept by finalize_payment and deposit_finalize, O(days) to read
+    """
+
+    async def get_daily_totals(self, since: date, userid: Optional[str] = None) -> list[dict]:
+        """
+        Totals per UTC day from `since`, of one user or of everyone
+        """
+        if userid is not None:
+            q = """
+            SELECT day, withdraw_sat, withdraw_count, deposit_sat, deposit_count, fee_sat
+            FROM daily_user_totals
+            WHERE userid = %s AND day >= %s
+            ORDER BY day
+            """
+            return await self.fetchmany(q, userid, since, replica=True)
+        q = """
+        SELECT day, sum(withdraw_sat)::bigint AS withdraw_sat, sum(withdraw_count)::bigint AS withdraw_count,
+            sum(deposit_sat)::bigint AS deposit_sat, sum(deposit_count)::bigint AS deposit_count,
+            sum(fee_sat)::bigint AS fee_sat
+        FROM daily_totals
+        WHERE day >= %s
+        GROUP BY day
+        ORDER BY day
+        """
+        return await self.fetchmany(q, since, replica=True)
+
+    async def get_withdrawn_today(self, userid: str) -> int:
+        """
+        Withdrawals of the user settled in the current UTC day plus the ones
+        still in flight, for limit checks
+        """
+        q = """
+        SELECT coalesce((
+            SELECT withdraw_sat
+            FROM daily_user_totals
+            WHERE userid = %s AND day = (now() AT TIME ZONE 'UTC')::date
+        ), 0) + (
+            SELECT coalesce(sum(amount), 0)
+            FROM withdraw_requests
+            WHERE userid = %s AND status = 'QUEUED'
+        ) AS withdrawn
+        """
+        row = await self.fetchone(q, userid, userid)
+        return int(row["withdrawn"])
+
+    """
+    OUTBOX
+    """
+
+    async def drain_outbox(
+        self,
+        batch: int,
+        dispatch: Callable[[list[dict]], Awaitable[set[int]]],
+        retry_after: Callable[[int], int],
+        lease: int = 60,
+    ) -> int:
+        """
+        Claim up to `batch` due outbox events for `lease` seconds and pass them
+        to `dispatch`, which returns the delivered ids. Those are deleted, the
+        rest are due again after retry_after(attempts) seconds. No transaction
+        is open while dispatching, a relay that dies leaves its claim to expire
+        so delivery is at least once.
+
+        An event is only claimed while no earlier event of its user waits for
+        a retry or sits in another relay's claim, so a user's events are
+        delivered in order across batches too. Claims take a transaction level
+        advisory lock, the next claim sees the previous one's leases
+        """
+        q = """
+        SELECT pg_advisory_xact_lock(hashtext('outbox_claim'))
+        """
+        q2 = """
+        UPDATE outbox o
+        SET next_attempt = %s
+        FROM (
+            SELECT c.id
+            FROM outbox c
+            WHERE c.next_attempt <= %s
+            AND NOT EXISTS (
+                SELECT 1
+                FROM outbox p
+                WHERE p.userid = c.userid AND p.id < c.id AND p.next_attempt > %s
+            )
+            ORDER BY c.id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ) due
+        WHERE o.id = due.id
+        RETURNING o.id, o.event_key, o.payload, o.attempts,
+            (SELECT coalesce(sum(amount), 0) FROM balances b WHERE b.userid = o.userid) AS balance
+        """
+        q3 = """
+        DELETE FROM outbox
+        WHERE id = ANY(%s)
+        """
+        q4 = """
+        UPDATE outbox
+        SET attempts = attempts + 1,
+        next_attempt = %s
+        WHERE id = %s
+        """
+        now = int(datetime.utcnow().timestamp())
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                async with conn.transaction():
+                    await cur.execute(q)
+                    await cur.execute(q2, (now + lease, now, now, batch))
+                    events = sorted(await cur.fetchall(), key=lambda e: e["id"])
+        if not events:
+            return 0
+        delivered = await dispatch(events)
+        now = int(datetime.utcnow().timestamp())
+        failed = [(now + retry_after(e["attempts"]), e["id"]) for e in events if e["id"] not in delivered]
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async with conn.transaction():
+                    await cur.execute(q3, (list(delivered), ))
+                    if failed:
+                        await cur.executemany(q4, failed)
+        return len(events)
+
+    """
+    DEAD LETTERS
+    """
+
+    async def add_dead_letter(self, stream: str, payload: dict, error: str):
+        """
+        Keep a stream event whose settlement failed every retry, for replay by hand
+        """
+        q = """
+        INSERT INTO dead_letters (stream, payload, error, ts_created)
+        VALUES (%s, %s, %s, %s)
+        """
+        await self.execute(q, stream, Jsonb(payload), error, int(datetime.utcnow().timestamp()))
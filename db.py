@@ -1,204 +1,350 @@
-import psycopg
-
-
-def create_tables(conninfo: str):
-    conn = psycopg.connect(conninfo=conninfo,
-                           autocommit=True)
-    cursor = conn.cursor()
-    create_users_table(cursor)
-    create_balances_table(cursor)
-    create_withdraw_requests_table(cursor)
-    create_withdraw_invoices_table(cursor)
-    create_withdraw_payments_table(cursor)
-    create_withdraw_locked_table(cursor)
-    create_withdraw_txs_table(cursor)
-    create_deposit_requests_table(cursor)
-    create_deposit_invoice_table(cursor)
-    create_deposit_transactions_table(cursor)
-    cursor.close()
-    conn.close()
-
-
-def create_withdraw_requests_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS withdraw_requests;
-
-    CREATE TABLE IF NOT EXISTS withdraw_requests
-    (
-        userid character varying(100) NOT NULL,
-        k1 character(64) NOT NULL PRIMARY KEY,
-        clearnet_url character varying(300) NOT NULL,
-        lnurlw character varying(300) NOT NULL,
-        lnurl character varying(300) NOT NULL,
-        redeemed boolean DEFAULT FALSE,
-        status character varying(20) NOT NULL, 
-        reason character varying(300),
-        max_withdrawable bigint,
-        min_withdrawable bigint,
-
-        payment_hash character(64),
-
-        bolt11 character varying(1023),
-        amount bigint,
-        destination character(100),
-        ts_created bigint,
-        ts_invoice bigint,
-        ts_paid bigint
-
-    )
-    """
-    cursor.execute(q)
-
-def create_withdraw_invoices_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS withdraw_invoices;
-
-    CREATE TABLE IF NOT EXISTS withdraw_invoices
-    (
-        payment_hash character(64) NOT NULL PRIMARY KEY,
-        bolt11 character varying(1023) NOT NULL,
-        state character varying(20) NOT NULL,
-        preimage character (64),
-        destination character varying (100) NOT NULL,
-        num_satoshis bigint NOT NULL,
-        timestamp bigint NOT NULL,
-        expiry bigint NOT NULL,
-        description character varying (1023),
-        description_hash character varying (1023),
-        fallback_addr character varying (100),
-        cltv_expiry bigint,
-        route_hints text,
-        payment_addr character (44),
-        features text
-    )
-    """
-    cursor.execute(q)
-
-def create_withdraw_payments_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS withdraw_payments;
-
-    CREATE TABLE IF NOT EXISTS withdraw_payments
-    (
-        payment_hash character(64) PRIMARY KEY NOT NULL,
-        userid character varying (100) NOT NULL,
-        preimage character (64),
-        value_sat bigint,
-        status character varying (20),
-        fee_sat bigint,
-        ts_create bigint NOT NULL,
-        failure_reason text
-    )
-    """
-    cursor.execute(q)
-
-def create_deposit_requests_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS deposit_requests;
-
-    CREATE TABLE IF NOT EXISTS deposit_requests
-    (
-        userid character varying (100) NOT NULL,
-        payment_hash character (64) PRIMARY KEY NOT NULL,
-        status character varying (20),
-        amount bigint,
-        ts_created bigint NOT NULL
-    )
-    """
-    cursor.execute(q)
-
-def create_deposit_invoice_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS deposit_invoices;
-
-    CREATE TABLE IF NOT EXISTS deposit_invoices
-    (
-        payment_hash character(64) NOT NULL PRIMARY KEY,
-        bolt11 character varying(1023) NOT NULL,
-        state character varying(20) NOT NULL,
-        preimage character (64),
-        destination character varying (100) NOT NULL,
-        num_satoshis bigint NOT NULL,
-        timestamp bigint NOT NULL,
-        expiry bigint NOT NULL,
-        description character varying (1023),
-        description_hash character varying (1023),
-        fallback_addr character varying (100),
-        cltv_expiry bigint,
-        route_hints text,
-        payment_addr character (44),
-        features text
-    )
-    """
-    cursor.execute(q)
-
-
-def create_withdraw_txs_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS withdraw_transactions;
-
-    CREATE TABLE IF NOT EXISTS withdraw_transactions
-    (
-        userid character varying(100) NOT NULL,
-        payment_hash character(64) NOT NULL PRIMARY KEY,
-        amount bigint NOT NULL,
-        ts_create bigint NOT NULL
-    )
-    """
-    cursor.execute(q)
-
-def create_withdraw_locked_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS locked_balances;
-
-    CREATE TABLE IF NOT EXISTS locked_balances
-    (
-        payment_hash character(64) NOT NULL PRIMARY KEY,
-        amount bigint NOT NULL
-    )
-    """
-    cursor.execute(q)
-
-def create_users_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS users;
-
-    CREATE TABLE IF NOT EXISTS users
-    (
-        userid character varying(100) NOT NULL,
-        k1 character(64) NOT NULL PRIMARY KEY,
-        lnurlp character varying(300) NOT NULL,
-        lnurl character varying(300) NOT NULL
-    )
-    """
-    cursor.execute(q)        
-
-def create_balances_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS balances;
-
-    CREATE TABLE IF NOT EXISTS balances
-    (
-        userid character varying (100) NOT NULL,
-        k1 character(64) NOT NULL PRIMARY KEY,
-        amount bigint DEFAULT 0
-    );
-
-    INSERT INTO balances
-    VALUES ('user01', 'random_hash_key', 1000000);
-    """
-    cursor.execute(q)
-
-def create_deposit_transactions_table(cursor):
-    q = """
-    DROP TABLE IF EXISTS deposit_transactions;
-
-    CREATE TABLE IF NOT EXISTS deposit_transactions
-    (
-        userid character varying (100) NOT NULL,
-        payment_hash character (64) NOT NULL PRIMARY KEY,
-        amount bigint NOT NULL,
-        ts_create bigint NOT NULL
-    )
-    """
-    cursor.execute(q)
+from datetime import date
+from typing import Optional
+import argparse
+import psycopg
+
+
+def create_tables(conninfo: str):
+    conn = psycopg.connect(conninfo=conninfo,
+                           autocommit=True)
+    cursor = conn.cursor()
+    create_users_table(cursor)
+    create_balances_table(cursor)
+    create_withdraw_requests_table(cursor)
+    create_withdraw_invoices_table(cursor)
+    create_withdraw_payments_table(cursor)
+    create_withdraw_locked_table(cursor)
+    create_withdraw_txs_table(cursor)
+    create_deposit_requests_table(cursor)
+    create_deposit_invoice_table(cursor)
+    create_deposit_transactions_table(cursor)
+    create_rollup_tables(cursor)
+    create_outbox_table(cursor)
+    create_dead_letters_table(cursor)
+    cursor.close()
+    conn.close()
+
+
+def create_withdraw_requests_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS withdraw_requests;
+
+    CREATE TABLE IF NOT EXISTS withdraw_requests
+    (
+        userid character varying(100) NOT NULL,
+        k1 character(64) NOT NULL PRIMARY KEY,
+        clearnet_url character varying(300) NOT NULL,
+        lnurlw character varying(300) NOT NULL,
+        lnurl character varying(300) NOT NULL,
+        redeemed boolean DEFAULT FALSE,
+        status character varying(20) NOT NULL, 
+        reason character varying(300),
+        max_withdrawable bigint,
+        min_withdrawable bigint,
+
+        payment_hash character(64),
+
+        bolt11 character varying(1023),
+        amount bigint,
+        destination character(100),
+        ts_created bigint,
+        ts_invoice bigint,
+        ts_paid bigint
+
+    )
+    """
+    cursor.execute(q)
+
+def create_withdraw_invoices_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS withdraw_invoices;
+
+    CREATE TABLE IF NOT EXISTS withdraw_invoices
+    (
+        payment_hash character(64) NOT NULL PRIMARY KEY,
+        bolt11 character varying(1023) NOT NULL,
+        state character varying(20) NOT NULL,
+        preimage character (64),
+        destination character varying (100) NOT NULL,
+        num_satoshis bigint NOT NULL,
+        timestamp bigint NOT NULL,
+        expiry bigint NOT NULL,
+        description character varying (1023),
+        description_hash character varying (1023),
+        fallback_addr character varying (100),
+        cltv_expiry bigint,
+        route_hints text,
+        payment_addr character (44),
+        features text,
+        node character varying (100)
+    )
+    """
+    cursor.execute(q)
+
+def create_withdraw_payments_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS withdraw_payments;
+
+    CREATE TABLE IF NOT EXISTS withdraw_payments
+    (
+        payment_hash character(64) PRIMARY KEY NOT NULL,
+        userid character varying (100) NOT NULL,
+        preimage character (64),
+        value_sat bigint,
+        status character varying (20),
+        fee_sat bigint,
+        ts_create bigint NOT NULL,
+        failure_reason text,
+        node character varying (100)
+    )
+    """
+    cursor.execute(q)
+
+def create_deposit_requests_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS deposit_requests;
+
+    CREATE TABLE IF NOT EXISTS deposit_requests
+    (
+        userid character varying (100) NOT NULL,
+        payment_hash character (64) PRIMARY KEY NOT NULL,
+        status character varying (20),
+        amount bigint,
+        ts_created bigint NOT NULL
+    )
+    """
+    cursor.execute(q)
+
+def create_deposit_invoice_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS deposit_invoices;
+
+    CREATE TABLE IF NOT EXISTS deposit_invoices
+    (
+        payment_hash character(64) NOT NULL PRIMARY KEY,
+        bolt11 character varying(1023) NOT NULL,
+        state character varying(20) NOT NULL,
+        preimage character (64),
+        destination character varying (100) NOT NULL,
+        num_satoshis bigint NOT NULL,
+        timestamp bigint NOT NULL,
+        expiry bigint NOT NULL,
+        description character varying (1023),
+        description_hash character varying (1023),
+        fallback_addr character varying (100),
+        cltv_expiry bigint,
+        route_hints text,
+        payment_addr character (44),
+        features text,
+        node character varying (100)
+    );
+
+    CREATE INDEX IF NOT EXISTS deposit_invoices_pool
+    ON deposit_invoices (num_satoshis, timestamp)
+    WHERE state = 'POOL';
+    """
+    cursor.execute(q)
+
+
+def create_withdraw_txs_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS withdraw_transactions;
+
+    CREATE TABLE IF NOT EXISTS withdraw_transactions
+    (
+        userid character varying(100) NOT NULL,
+        payment_hash character(64) NOT NULL PRIMARY KEY,
+        amount bigint NOT NULL,
+        ts_create bigint NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS withdraw_transactions_history
+    ON withdraw_transactions (userid, ts_create DESC, payment_hash DESC)
+    INCLUDE (amount);
+    """
+    cursor.execute(q)
+
+def create_withdraw_locked_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS locked_balances;
+
+    CREATE TABLE IF NOT EXISTS locked_balances
+    (
+        payment_hash character(64) NOT NULL PRIMARY KEY,
+        amount bigint NOT NULL
+    )
+    """
+    cursor.execute(q)
+
+def create_users_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS users;
+
+    CREATE TABLE IF NOT EXISTS users
+    (
+        userid character varying(100) NOT NULL,
+        k1 character(64) NOT NULL PRIMARY KEY,
+        lnurlp character varying(300) NOT NULL,
+        lnurl character varying(300) NOT NULL
+    )
+    """
+    cursor.execute(q)        
+
+def create_balances_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS balances;
+
+    CREATE TABLE IF NOT EXISTS balances
+    (
+        userid character varying (100) NOT NULL,
+        k1 character(64) NOT NULL PRIMARY KEY,
+        amount bigint DEFAULT 0
+    );
+
+    INSERT INTO balances
+    VALUES ('user01', 'random_hash_key', 1000000);
+    """
+    cursor.execute(q)
+
+def create_deposit_transactions_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS deposit_transactions;
+
+    CREATE TABLE IF NOT EXISTS deposit_transactions
+    (
+        userid character varying (100) NOT NULL,
+        payment_hash character (64) NOT NULL PRIMARY KEY,
+        amount bigint NOT NULL,
+        ts_create bigint NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS deposit_transactions_history
+    ON deposit_transactions (userid, ts_create DESC, payment_hash DESC)
+    INCLUDE (amount);
+    """
+    cursor.execute(q)
+
+
+def create_rollup_tables(cursor):
+    """
+    Daily totals per user and global, the global day is split over shards
+    that are summed on read
+    """
+    q = """
+    DROP TABLE IF EXISTS daily_user_totals;
+    DROP TABLE IF EXISTS daily_totals;
+
+    CREATE TABLE IF NOT EXISTS daily_user_totals
+    (
+        userid character varying (100) NOT NULL,
+        day date NOT NULL,
+        withdraw_sat bigint NOT NULL DEFAULT 0,
+        withdraw_count bigint NOT NULL DEFAULT 0,
+        deposit_sat bigint NOT NULL DEFAULT 0,
+        deposit_count bigint NOT NULL DEFAULT 0,
+        fee_sat bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (userid, day)
+    );
+
+    CREATE TABLE IF NOT EXISTS daily_totals
+    (
+        day date NOT NULL,
+        shard smallint NOT NULL,
+        withdraw_sat bigint NOT NULL DEFAULT 0,
+        withdraw_count bigint NOT NULL DEFAULT 0,
+        deposit_sat bigint NOT NULL DEFAULT 0,
+        deposit_count bigint NOT NULL DEFAULT 0,
+        fee_sat bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, shard)
+    )
+    """
+    cursor.execute(q)
+
+
+def create_outbox_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS outbox;
+
+    CREATE TABLE IF NOT EXISTS outbox
+    (
+        id bigserial PRIMARY KEY,
+        event_key character varying (200) NOT NULL UNIQUE,
+        userid character varying (100) NOT NULL,
+        payload jsonb NOT NULL,
+        attempts integer NOT NULL DEFAULT 0,
+        next_attempt bigint NOT NULL DEFAULT 0,
+        ts_created bigint NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS outbox_due
+    ON outbox (next_attempt, id);
+
+    -- earlier events of the same user, see PSQLClient.drain_outbox
+    CREATE INDEX IF NOT EXISTS outbox_user
+    ON outbox (userid, id);
+    """
+    cursor.execute(q)
+
+
+def create_dead_letters_table(cursor):
+    q = """
+    DROP TABLE IF EXISTS dead_letters;
+
+    CREATE TABLE IF NOT EXISTS dead_letters
+    (
+        id bigserial PRIMARY KEY,
+        stream character varying (200) NOT NULL,
+        payload jsonb NOT NULL,
+        error text NOT NULL,
+        ts_created bigint NOT NULL
+    );
+    """
+    cursor.execute(q)
+
+
+def rebuild_rollups(conninfo: str, since: Optional[date] = None):
+    """
+    Recompute daily totals from the transaction tables, all days or from `since`.
+    Settlements wait on the table lock meanwhile and add on top once it commits
+    """
+    since = since or date.min
+    statements = (
+        "DELETE FROM daily_user_totals WHERE day >= %(since)s",
+        "DELETE FROM daily_totals WHERE day >= %(since)s",
+        """
+        INSERT INTO daily_user_totals (userid, day, withdraw_sat, withdraw_count, deposit_sat, deposit_count, fee_sat)
+        SELECT userid, day, sum(withdraw_sat), sum(withdraw_count), sum(deposit_sat), sum(deposit_count), sum(fee_sat)
+        FROM (
+            SELECT t.userid, (to_timestamp(t.ts_create) AT TIME ZONE 'UTC')::date AS day,
+                t.amount AS withdraw_sat, 1 AS withdraw_count, 0 AS deposit_sat, 0 AS deposit_count,
+                coalesce(p.fee_sat, 0) AS fee_sat
+            FROM withdraw_transactions t
+            LEFT JOIN withdraw_payments p ON p.payment_hash = t.payment_hash
+            UNION ALL
+            SELECT userid, (to_timestamp(ts_create) AT TIME ZONE 'UTC')::date, 0, 0, amount, 1, 0
+            FROM deposit_transactions
+        ) settled
+        WHERE day >= %(since)s
+        GROUP BY userid, day
+        """,
+        """
+        INSERT INTO daily_totals (day, shard, withdraw_sat, withdraw_count, deposit_sat, deposit_count, fee_sat)
+        SELECT day, 0, sum(withdraw_sat), sum(withdraw_count), sum(deposit_sat), sum(deposit_count), sum(fee_sat)
+        FROM daily_user_totals
+        WHERE day >= %(since)s
+        GROUP BY day
+        """,
+    )
+    with psycopg.connect(conninfo=conninfo) as conn:
+        with conn.transaction():
+            conn.execute("LOCK TABLE daily_user_totals, daily_totals IN EXCLUSIVE MODE")
+            for q in statements:
+                conn.execute(q, {"since": since})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the daily rollup tables from the transaction tables")
+    parser.add_argument("conninfo")
+    parser.add_argument("--since", type=date.fromisoformat, help="first day to rebuild, YYYY-MM-DD, default all")
+    args = parser.parse_args()
+    rebuild_rollups(args.conninfo, args.since)
@@ -0,0 +1,86 @@
+"""
+Push withdraw/deposit status changes to clients over server-sent events.
+Settlement code in crud.py publishes with pg_notify inside its transaction,
+every worker LISTENs on one connection and fans out to its in-process
+subscribers, so no client polling touches the database.
+"""
+from typing import AsyncGenerator, Callable, Optional
+import psycopg
+import asyncio
+import logging
+import json
+
+STATUS_CHANNEL = "lnurl_status"
+
+logger = logging.getLogger(__name__)
+
+
+class StatusBroker:
+    """
+    Userid keyed subscriptions, each one is a small bounded queue.
+    A single heartbeat task pings all of them so idle streams cost no timers.
+    """
+    def __init__(self, queue_size: int = 16, heartbeat: float = 15):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.subscribers: dict[str, set[asyncio.Queue]] = {}
+        # called with every event, e.g. to drop caches of the user
+        self.listeners: list[Callable[[dict], None]] = []
+
+    def __len__(self) -> int:
+        return sum(len(queues) for queues in self.subscribers.values())
+
+    def publish(self, event: dict):
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as exc:
+                logger.warning("status listener failed", extra={"error": str(exc)})
+        for queue in self.subscribers.get(event.get("userid"), ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # slow client, it will catch up from the next event
+                continue
+
+    async def listen(self, conninfo: str):
+        async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+            await conn.execute(f"LISTEN {STATUS_CHANNEL}")
+            async for notify in conn.notifies():
+                try:
+                    event = json.loads(notify.payload)
+                except ValueError:
+                    logger.warning("bad status notification", extra={"payload": notify.payload[:200]})
+                    continue
+                self.publish(event)
+
+    async def ping(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            for queues in self.subscribers.values():
+                for queue in queues:
+                    if queue.empty():
+                        queue.put_nowait(None)
+
+    async def stream(self, userid: str, payment_hash: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """
+        SSE stream of status events for `userid`, optionally one payment only
+        """
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(userid, set()).add(queue)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                event = await queue.get()
+                if event is None:
+                    yield ": ping\n\n"
+                    continue
+                if payment_hash is not None and event.get("payment_hash") != payment_hash:
+                    continue
+                yield f"event: {event.get('kind', 'status')}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            queues = self.subscribers.get(userid)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    self.subscribers.pop(userid, None)
@@ -1,65 +1,422 @@
-
-import jwt
-import asyncio
-from datetime import timedelta, datetime
-from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2AuthorizationCodeBearer
-from fastapi import Depends, Header
-from typing import Annotated
-from .base import TokenData
-from .lnurl import encode
-import secrets
-import binascii
-import os
-
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-
-
-def random_k1():
-    random_bytes = secrets.token_bytes(32)  # Generates 32 random bytes
-    random_hex = binascii.hexlify(random_bytes).decode()  # Convert bytes to a hexadecimal string
-    return random_hex
-
-# Decode access token
-def decode_access_token(authorization: str = Header(None)):
-    if authorization is None:
-        return None
-    try:
-        token = authorization.split()[1]
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        token_data = TokenData(userid=payload.get("sub"), token=token)
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-        return None
-    return token_data
-
-class RateLimiter:
-    """
-    Limit requests to 1 per interval seconds
-    """
-    def __init__(self, interval: int):
-        self.interval = interval
-        self.request_cache: dict[str, float] = {}
-
-    async def register(self, key: str) -> bool:
-        # return is_limited
-        current_time = datetime.utcnow().timestamp()
-        async with asyncio.Lock():
-            last_access_time = self.request_cache.get(key, 0)
-            if current_time - last_access_time < self.interval:
-                self.request_cache[key] = current_time
-                return True
-            else:
-                self.request_cache[key] = current_time
-                return False
-
-    async def cleanup(self):
-        while True:
-            asyncio.sleep(180)
-            current_time = datetime.utcnow().timestamp()
-            to_rem = []
-            for key, last_accessed_time in self.request_cache.items():
-                if (last_accessed_time + self.interval) < current_time:
-                    to_rem.append(key)
-            for k in to_rem:
-                self.request_cache.pop(k)
-
+
+import jwt
+import asyncio
+from datetime import timedelta, datetime
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2AuthorizationCodeBearer
+from fastapi import Depends, Header
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, Optional
+from pydantic import BaseModel
+from collections import deque
+from contextlib import asynccontextmanager
+from .base import TokenData
+from .lnurl import encode
+from .metrics import LANE_DEAD_LETTERS, LANE_ERRORS, LANE_LAG_SECONDS, QUEUE_DEPTH
+import functools
+import logging
+import secrets
+import json
+import binascii
+import time
+import os
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM")
+
+logger = logging.getLogger(__name__)
+
+
+def random_k1():
+    random_bytes = secrets.token_bytes(32)  # Generates 32 random bytes
+    random_hex = binascii.hexlify(random_bytes).decode()  # Convert bytes to a hexadecimal string
+    return random_hex
+
+# Decode access token
+def decode_access_token(authorization: str = Header(None)):
+    if authorization is None:
+        return None
+    try:
+        token = authorization.split()[1]
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_data = TokenData(userid=payload.get("sub"), token=token)
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None
+    return token_data
+
+class RateLimiter:
+    """
+    Limit requests to 1 per interval seconds
+    """
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.request_cache: dict[str, float] = {}
+
+    async def register(self, key: str) -> bool:
+        # return is_limited
+        current_time = datetime.utcnow().timestamp()
+        async with asyncio.Lock():
+            last_access_time = self.request_cache.get(key, 0)
+            if current_time - last_access_time < self.interval:
+                self.request_cache[key] = current_time
+                return True
+            else:
+                self.request_cache[key] = current_time
+                return False
+
+    async def cleanup(self):
+        while True:
+            asyncio.sleep(180)
+            current_time = datetime.utcnow().timestamp()
+            to_rem = []
+            for key, last_accessed_time in self.request_cache.items():
+                if (last_accessed_time + self.interval) < current_time:
+                    to_rem.append(key)
+            for k in to_rem:
+                self.request_cache.pop(k)
+
+
+
+class PaymentHashIndex:
+    """
+    In-memory set of outstanding deposit payment hashes.
+    Used to drop invoice events we did not issue before decoding them.
+    """
+    def __init__(self, grace: int = 60):
+        # hashes added locally within `grace` seconds survive a refresh,
+        # their insert may not have been visible to the refresh query yet
+        self.grace = grace
+        self.hashes: dict[str, float] = {}
+        self.loaded = False
+
+    def __contains__(self, payment_hash: str) -> bool:
+        return payment_hash in self.hashes
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def accepts(self, payment_hash: str) -> bool:
+        # let everything through until the first refresh has completed
+        return not self.loaded or payment_hash in self.hashes
+
+    def add(self, payment_hash: str):
+        self.hashes[payment_hash] = datetime.utcnow().timestamp()
+
+    def discard(self, payment_hash: str):
+        self.hashes.pop(payment_hash, None)
+
+    def replace(self, payment_hashes: list[str], started: float):
+        # keep anything added after the refresh query started
+        recent = {k: v for k, v in self.hashes.items() if v >= started - self.grace}
+        self.hashes = dict.fromkeys(payment_hashes, started)
+        self.hashes.update(recent)
+        self.loaded = True
+
+
+class IdempotentResponses:
+    """
+    Replay the first response for a key. Results are kept in Redis for `ttl`
+    seconds, concurrent duplicates wait for the first call in this process,
+    or poll for its result when it runs in another worker. Results that
+    fail `cacheable` (temporary errors) are not kept, a retry runs again.
+    """
+    def __init__(self, prefix: str, ttl: int = 600, lock_ttl: int = 30, poll: float = 0.05):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll = poll
+        self.inflight: dict[str, asyncio.Future] = {}
+
+    async def run(
+        self,
+        redis_conn,
+        key: str,
+        func: Callable[[], Awaitable[BaseModel]],
+        cacheable: Callable[[dict], bool] = lambda result: True,
+    ) -> dict:
+        """
+        Response of func as a dict, the stored one for repeated keys
+        """
+        key = f"{self.prefix}:{key}"
+        while True:
+            cached = redis_conn.get(key)
+            if cached is not None:
+                return json.loads(cached)
+            inflight = self.inflight.get(key)
+            if inflight is not None:
+                return await asyncio.shield(inflight)
+            if redis_conn.set(f"{key}:lock", 1, nx=True, ex=self.lock_ttl):
+                break
+            # another worker has it, wait for its result or for the lock to go away
+            await self.wait(redis_conn, key)
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            result = (await func()).model_dump()
+            if cacheable(result):
+                redis_conn.set(key, json.dumps(result), ex=self.ttl)
+            future.set_result(result)
+            return result
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # waiters re-raise it, don't log it as unretrieved
+            raise
+        finally:
+            self.inflight.pop(key, None)
+            redis_conn.delete(f"{key}:lock")
+
+    async def wait(self, redis_conn, key: str):
+        while redis_conn.exists(f"{key}:lock") and not redis_conn.exists(key):
+            await asyncio.sleep(self.poll)
+
+
+class HistoryCache:
+    """
+    History pages of a user in one Redis hash, field per limit and cursor,
+    next to a `version` field. A settlement bumps the version and drops the
+    pages, a page is only stored if the version is still the one read before
+    its query, so a page read before a settlement can't land after it.
+    """
+    # KEYS[1] hash, ARGV version, field, page, ttl
+    SET_SCRIPT = """
+    if (redis.call('HGET', KEYS[1], 'version') or '') == ARGV[1] then
+        redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    end
+    """
+    # KEYS[1] hash, ARGV ttl
+    INVALIDATE_SCRIPT = """
+    local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'version', version)
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    """
+
+    def __init__(self, prefix: str = "history", ttl: int = 300):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, userid: str) -> str:
+        return f"{userid}::{self.prefix}"
+
+    def get(self, redis_conn, userid: str, field: str) -> tuple[str, Optional[dict]]:
+        """
+        Current version and the cached page, if any
+        """
+        version, cached = redis_conn.hmget(self.key(userid), "version", field)
+        return version or "", json.loads(cached) if cached is not None else None
+
+    def set(self, redis_conn, userid: str, version: str, field: str, page: dict):
+        redis_conn.eval(self.SET_SCRIPT, 1, self.key(userid), version, field, json.dumps(page), self.ttl)
+
+    def invalidate(self, redis_conn, userid: str):
+        redis_conn.eval(self.INVALIDATE_SCRIPT, 1, self.key(userid), self.ttl)
+
+
+async def gather_all(*aws):
+    """
+    Run independent awaitables concurrently, results in argument order.
+    The first failure cancels the others and is raised unwrapped
+    """
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(aw) for aw in aws]
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0] from None
+    return [task.result() for task in tasks]
+
+
+class ServiceUnavailableError(Exception):
+    """
+    Raised instead of queueing when a backend is unhealthy or saturated
+    """
+
+
+class CircuitBreaker:
+    """
+    Open after too many failed or slow calls in the last `window` calls.
+    While open calls are rejected, after `reset_timeout` seconds a few
+    probe calls are let through (half-open) to decide whether to close.
+    """
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, window: int = 50, min_calls: int = 10, failure_rate: float = 0.5,
+                 slow_call: float = 2.0, reset_timeout: float = 15, half_open_calls: int = 2):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+
+        self.state = self.CLOSED
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_successes = 0
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probes = 0
+            self.probe_successes = 0
+        if self.state == self.HALF_OPEN:
+            if self.probes >= self.half_open_calls:
+                return False
+            self.probes += 1
+        return True
+
+    def available(self) -> bool:
+        """
+        Whether allow() would let a call through, without counting it
+        """
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        if self.state == self.HALF_OPEN:
+            return self.probes < self.half_open_calls
+        return True
+
+    def record(self, ok: bool, duration: float):
+        failed = not ok or duration >= self.slow_call
+        if self.state == self.HALF_OPEN:
+            if failed:
+                self._open()
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= self.half_open_calls:
+                self.state = self.CLOSED
+                self.outcomes.clear()
+                self.failures = 0
+            return
+
+        if len(self.outcomes) == self.outcomes.maxlen:
+            self.failures -= self.outcomes[0]
+        self.outcomes.append(failed)
+        self.failures += failed
+        if len(self.outcomes) >= self.min_calls and self.failures / len(self.outcomes) >= self.failure_rate:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+
+class AdmissionGate:
+    """
+    Limit concurrent calls. Callers wait at most `max_wait` seconds
+    for a slot, then get ServiceUnavailableError instead of piling up.
+    """
+    def __init__(self, limit: int, max_wait: float = 0.5):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+
+    @asynccontextmanager
+    async def enter(self):
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            raise ServiceUnavailableError("too many concurrent requests")
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+
+class Lanes:
+    """
+    Keyed parallel consumers: `lanes` workers with a bounded queue each.
+    Items with the same key always go to the same lane so they're handled
+    in order, other keys don't wait behind them. A full lane blocks `put`,
+    which pushes back on the producer.
+
+    A failing item is retried `retries` times with exponential backoff,
+    holding up its lane meanwhile, so handlers must be idempotent. After the
+    last attempt it goes to `dead_letter` and the lane moves on.
+    """
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[None]],
+        lanes: int = 8,
+        size: int = 100,
+        retries: int = 8,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+        dead_letter: Optional[Callable[[Any, Exception], Awaitable[None]]] = None,
+    ):
+        self.name = name
+        self.handler = handler
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+        self.queues = [asyncio.Queue(size) for _ in range(lanes)]
+        # enqueue time of the item each lane is handling, it is the oldest one in the lane
+        self.current: list[Optional[float]] = [None] * lanes
+        for lane, queue in enumerate(self.queues):
+            QUEUE_DEPTH.set_function(queue.qsize, queue=f"{name}:{lane}")
+            LANE_LAG_SECONDS.set_function(functools.partial(self.lag, lane), stream=name, lane=lane)
+
+    def lag(self, lane: int) -> float:
+        started = self.current[lane]
+        return time.monotonic() - started if started is not None else 0
+
+    async def put(self, key: str, item):
+        await self.queues[hash(key) % len(self.queues)].put((time.monotonic(), item))
+
+    async def worker(self, lane: int):
+        queue = self.queues[lane]
+        while True:
+            self.current[lane], item = await queue.get()
+            try:
+                await self.handle(item)
+            finally:
+                self.current[lane] = None
+                queue.task_done()
+
+    async def handle(self, item):
+        for attempt in range(self.retries):
+            try:
+                return await self.handler(item)
+            except Exception as exc:
+                error = exc
+                LANE_ERRORS.inc(stream=self.name)
+                logger.warning("lane handler failed", extra={"stream": self.name, "attempt": attempt, "error": str(exc)})
+            if attempt + 1 < self.retries:
+                await asyncio.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+        LANE_DEAD_LETTERS.inc(stream=self.name)
+        try:
+            if self.dead_letter is None:
+                raise error
+            await self.dead_letter(item, error)
+        except Exception:
+            # nowhere left to keep it, the log line is the only record
+            logger.exception("lane item dropped", extra={"stream": self.name, "item": repr(item)[:1000]})
+
+    async def run(self, items: AsyncIterator, key: Callable[[Any], str]):
+        """
+        Feed `items` into the lanes until the iterator ends, then wait for
+        the queued items. An error of the iterator still drains the lanes
+        before it is raised
+        """
+        error = None
+        async with asyncio.TaskGroup() as tg:
+            workers = [tg.create_task(self.worker(lane)) for lane in range(len(self.queues))]
+            try:
+                async for item in items:
+                    await self.put(key(item), item)
+            except Exception as exc:
+                error = exc
+            for queue in self.queues:
+                await queue.join()
+            for task in workers:
+                task.cancel()
+        if error is not None:
+            raise error
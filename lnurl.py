@@ -1,129 +1,194 @@
-from bech32 import bech32_decode, bech32_encode, convertbits
-from fastapi.datastructures import URL
-import json
-import math
-from typing import List, Literal, Union, Optional
-from pydantic import BaseModel, Field, validator, PositiveInt, HttpUrl
-
-
-def decode(lnurl: str) -> str:
-    hrp, data = bech32_decode(lnurl)
-    assert hrp
-    assert data
-    bech32_data = convertbits(data, 5, 8, False)
-    assert bech32_data
-    return bytes(bech32_data).decode()
-
-
-def encode(url: Union[str, URL]) -> str:
-    bech32_data = convertbits(str(url).encode(), 8, 5, True)
-    assert bech32_data
-    lnurl = bech32_encode("lnurl", bech32_data)
-    return lnurl.upper()
-
-
-class CreateLnurlResponse(BaseModel):
-    lnurl: str
-    lnurlw: str
-
-
-class LnurlSuccessResponse(BaseModel):
-    status: Literal["OK"] = "OK"
-
-
-class LnurlErrorResponse(BaseModel):
-    status: Literal["ERROR"] = "ERROR"
-    reason: str
-
-    @property
-    def error_msg(self) -> str:
-        return self.reason
-
-    @property
-    def ok(self) -> bool:
-        return False
-
-
-class PayRequestMetadata(BaseModel):
-    text_plain: str
-    text_long_desc: Optional[str] = None
-    image_png_base64: Optional[str] = None
-    image_jpeg_base64: Optional[str] = None
-
-    def create_json(self):
-        return json.dumps([[k, v] for k, v in self.model_dump().items() if v is not None])
-    
-
-class LnurlPayResponse(BaseModel):
-    tag: Literal["payRequest"] = "payRequest"
-    callback: HttpUrl
-    min_sendable: PositiveInt = Field(..., alias="minSendable")
-    max_sendable: PositiveInt = Field(..., alias="maxSendable")
-    metadata: PayRequestMetadata
-
-    @validator("max_sendable")
-    def max_less_than_min(cls, value, values, **kwargs):  # noqa
-        if "min_sendable" in values and value < values["min_sendable"]:
-            raise ValueError("`max_sendable` cannot be less than `min_sendable`.")
-        return value
-
-    @property
-    def min_sats(self) -> int:
-        return int(math.ceil(self.min_sendable / 1000))
-
-    @property
-    def max_sats(self) -> int:
-        return int(math.floor(self.max_sendable / 1000))
-
-
-class MessageAction(BaseModel):
-    tag: Literal["message"] = "message"
-    message: str = Field(min_length=1, max_length=144)
-
-
-class UrlAction(BaseModel):
-    tag: Literal["url"] = "url"
-    url: HttpUrl
-    description: str
-
-
-class LnurlPayRouteHop(BaseModel):
-    node_id: str = Field(..., alias="nodeId")
-    channel_update: str = Field(..., alias="channelUpdate")
-
-
-class LnurlPayActionResponse(BaseModel):
-    pr: str
-    success_action: Optional[Union[MessageAction, UrlAction]] = Field(None, alias="successAction")
-    routes: List[List[LnurlPayRouteHop]] = []
-    
-
-class LnurlErrorResponse(BaseModel):
-    status: Literal["ERROR"] = "ERROR"
-    reason: str
-
-    @property
-    def error_msg(self) -> str:
-        return self.reason
-
-    @property
-    def ok(self) -> bool:
-        return False
-
-
-class LnurlSuccessResponse(BaseModel):
-    status: Literal["OK"] = "OK"
-
-class LnurlWithdrawResponse(BaseModel):
-    tag: Literal["withdrawRequest"] = "withdrawRequest"
-    callback: HttpUrl
-    k1: str
-    min_withdrawable: PositiveInt = Field(..., alias="minWithdrawable")
-    max_withdrawable: PositiveInt = Field(..., alias="maxWithdrawable")
-    default_description: str = Field("", alias="defaultDescription")
-
-    @validator("max_withdrawable")
-    def max_less_than_min(cls, value, values, **kwargs):  # noqa
-        if "min_withdrawable" in values and value < values["min_withdrawable"]:
-            raise ValueError("`max_withdrawable` cannot be less than `min_withdrawable`.")
+from fastapi.datastructures import URL
+from functools import lru_cache, reduce
+from operator import xor
+import base64
+import json
+import math
+from typing import List, Literal, Union, Optional
+from pydantic import BaseModel, Field, validator, PositiveInt, HttpUrl
+
+# bech32 codec for lnurl strings, same output as the reference
+# bech32_encode(convertbits(...)) implementation but working on whole
+# byte strings: base32 for the 8 <-> 5 bit regrouping, lookup tables for
+# the checksum generator and a cached checksum state for the url prefix,
+# which is the same for every link except the trailing k1
+CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+B32 = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+B32_TO_VALUE = bytes.maketrans(B32, bytes(range(32)))
+B32_TO_CHAR = bytes.maketrans(B32, CHARSET.upper().encode())
+CHAR_TO_VALUE = bytes(CHARSET.find(chr(c)) % 256 for c in range(256))
+CHAR_TO_DIGIT = str.maketrans(CHARSET, "0123456789abcdefghijklmnopqrstuv")
+GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+POLYMOD_TABLE = tuple(
+    reduce(xor, (GENERATOR[i] for i in range(5) if (top >> i) & 1), 0) for top in range(32)
+)
+HRP = "lnurl"
+
+
+def polymod_step(chk: int, value: int) -> int:
+    return POLYMOD_TABLE[chk >> 25] ^ ((chk & 0x1ffffff) << 5) ^ value
+
+
+# the checksum is linear, two steps at once only depend on the top 10 bits
+POLYMOD_TABLE2 = tuple(polymod_step(polymod_step(top << 20, 0), 0) for top in range(1024))
+
+
+def polymod(values: bytes, chk: int = 1) -> int:
+    if len(values) % 2:
+        chk = polymod_step(chk, values[0])
+        values = values[1:]
+    for high, low in zip(values[::2], values[1::2]):
+        chk = POLYMOD_TABLE2[chk >> 20] ^ ((chk & 0xfffff) << 10) ^ (high << 5) ^ low
+    return chk
+
+
+def hrp_expand(hrp: str) -> bytes:
+    return bytes([ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp])
+
+
+@lru_cache(maxsize=64)
+def prefix_state(head: bytes) -> tuple[bytes, int]:
+    """
+    Encoded characters and checksum state after `head`, len(head) % 5 == 0
+    """
+    raw = base64.b32encode(head)
+    return raw.translate(B32_TO_CHAR), polymod(raw.translate(B32_TO_VALUE), polymod(hrp_expand(HRP)))
+
+
+def decode(lnurl: str) -> str:
+    assert lnurl.isascii() and lnurl.isprintable() and " " not in lnurl
+    assert lnurl.lower() == lnurl or lnurl.upper() == lnurl
+    lnurl = lnurl.lower()
+    pos = lnurl.rfind("1")
+    assert 0 < pos <= 83 and pos + 7 <= len(lnurl)
+    hrp, chars = lnurl[:pos], lnurl[pos + 1:]
+    values = chars.encode().translate(CHAR_TO_VALUE)
+    assert 255 not in values
+    assert polymod(values, polymod(hrp_expand(hrp))) == 1
+    chars = chars[:-6]
+    assert chars
+    # regroup 5 -> 8 bits, leftover padding must be short and zero
+    bits = len(chars) * 5
+    pad = bits % 8
+    number = int(chars.translate(CHAR_TO_DIGIT), 32)
+    assert pad < 5 and not number & ((1 << pad) - 1)
+    return (number >> pad).to_bytes(bits // 8, "big").decode()
+
+
+def encode(url: Union[str, URL]) -> str:
+    data = str(url).encode()
+    # cache the part before the last path or query value, in whole 5 byte groups
+    split = max(data.rfind(b"="), data.rfind(b"/")) + 1
+    split -= split % 5
+    head_chars, chk = prefix_state(data[:split])
+    raw = base64.b32encode(data[split:]).rstrip(b"=")
+    chk = polymod(raw.translate(B32_TO_VALUE) + bytes(6), chk) ^ 1
+    checksum = bytes(CHARSET[(chk >> 5 * (5 - i)) & 31].upper().encode()[0] for i in range(6))
+    return "LNURL1" + (head_chars + raw.translate(B32_TO_CHAR) + checksum).decode()
+
+
+class CreateLnurlResponse(BaseModel):
+    lnurl: str
+    lnurlw: str
+
+
+class LnurlSuccessResponse(BaseModel):
+    status: Literal["OK"] = "OK"
+
+
+class LnurlErrorResponse(BaseModel):
+    status: Literal["ERROR"] = "ERROR"
+    reason: str
+
+    @property
+    def error_msg(self) -> str:
+        return self.reason
+
+    @property
+    def ok(self) -> bool:
+        return False
+
+
+class PayRequestMetadata(BaseModel):
+    text_plain: str
+    text_long_desc: Optional[str] = None
+    image_png_base64: Optional[str] = None
+    image_jpeg_base64: Optional[str] = None
+
+    def create_json(self):
+        return json.dumps([[k, v] for k, v in self.model_dump().items() if v is not None])
+    
+
+class LnurlPayResponse(BaseModel):
+    tag: Literal["payRequest"] = "payRequest"
+    callback: HttpUrl
+    min_sendable: PositiveInt = Field(..., alias="minSendable")
+    max_sendable: PositiveInt = Field(..., alias="maxSendable")
+    metadata: PayRequestMetadata
+
+    @validator("max_sendable")
+    def max_less_than_min(cls, value, values, **kwargs):  # noqa
+        if "min_sendable" in values and value < values["min_sendable"]:
+            raise ValueError("`max_sendable` cannot be less than `min_sendable`.")
+        return value
+
+    @property
+    def min_sats(self) -> int:
+        return int(math.ceil(self.min_sendable / 1000))
+
+    @property
+    def max_sats(self) -> int:
+        return int(math.floor(self.max_sendable / 1000))
+
+
+class MessageAction(BaseModel):
+    tag: Literal["message"] = "message"
+    message: str = Field(min_length=1, max_length=144)
+
+
+class UrlAction(BaseModel):
+    tag: Literal["url"] = "url"
+    url: HttpUrl
+    description: str
+
+
+class LnurlPayRouteHop(BaseModel):
+    node_id: str = Field(..., alias="nodeId")
+    channel_update: str = Field(..., alias="channelUpdate")
+
+
+class LnurlPayActionResponse(BaseModel):
+    pr: str
+    success_action: Optional[Union[MessageAction, UrlAction]] = Field(None, alias="successAction")
+    routes: List[List[LnurlPayRouteHop]] = []
+    
+
+class LnurlErrorResponse(BaseModel):
+    status: Literal["ERROR"] = "ERROR"
+    reason: str
+
+    @property
+    def error_msg(self) -> str:
+        return self.reason
+
+    @property
+    def ok(self) -> bool:
+        return False
+
+
+class LnurlSuccessResponse(BaseModel):
+    status: Literal["OK"] = "OK"
+
+class LnurlWithdrawResponse(BaseModel):
+    tag: Literal["withdrawRequest"] = "withdrawRequest"
+    callback: HttpUrl
+    k1: str
+    min_withdrawable: PositiveInt = Field(..., alias="minWithdrawable")
+    max_withdrawable: PositiveInt = Field(..., alias="maxWithdrawable")
+    default_description: str = Field("", alias="defaultDescription")
+
+    @validator("max_withdrawable")
+    def max_less_than_min(cls, value, values, **kwargs):  # noqa
+        if "min_withdrawable" in values and value < values["min_withdrawable"]:
+            raise ValueError("`max_withdrawable` cannot be less than `min_withdrawable`.")
         return value
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Structured JSON logging kept off the event loop.
+Records are rate limited and redacted in the calling thread, then handed
+over a queue to a QueueListener thread that does the JSON formatting and I/O.
+
+LOG_LEVEL       root level, default INFO
+LOG_LEVELS      per module levels, e.g. "crud=WARNING,node=DEBUG,httpx=WARNING"
+LOG_FILE        write to this file instead of stderr
+LOG_RATE_LIMIT  max records per call site per LOG_RATE_INTERVAL seconds
+"""
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import logging
+import queue
+import json
+import time
+import re
+import os
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 20))
+LOG_RATE_INTERVAL = float(os.getenv("LOG_RATE_INTERVAL", 60))
+
+PACKAGE = __name__.rpartition(".")[0]
+
+# preimages (hex or base64) following a *preimage key, and bolt11 invoices
+PREIMAGE_RE = re.compile(r"(preimage\W{0,4})([0-9a-fA-F]{64}|[A-Za-z0-9+/]{43}=)", re.IGNORECASE)
+BOLT11_RE = re.compile(r"\b(ln(?:bc|tb|bcrt|sb|mock)[0-9]*[munp]?)1[0-9a-z]{20,}\b", re.IGNORECASE)
+
+# attributes every LogRecord has, anything else came in through `extra`
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+
+def redact(text: str) -> str:
+    text = PREIMAGE_RE.sub(r"\1<redacted>", text)
+    return BOLT11_RE.sub(r"\1...<redacted>", text)
+
+
+class RedactingQueueHandler(QueueHandler):
+    """
+    Strip preimages and bolt11 strings from the message, traceback
+    and extra fields before the record leaves the calling thread
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.msg = redact(record.msg)
+        for key, value in vars(record).items():
+            if key in RECORD_ATTRS:
+                continue
+            if "preimage" in key.lower():
+                setattr(record, key, "<redacted>")
+            elif isinstance(value, str):
+                setattr(record, key, redact(value))
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most `limit` records per call site through every `interval` seconds.
+    Errors are never dropped, the next record after a window reports how many were.
+    """
+    def __init__(self, limit: int = LOG_RATE_LIMIT, interval: float = LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        # (logger, lineno) -> [window start, count, suppressed]
+        self.sites: dict[tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        site = self.sites.get((record.name, record.lineno))
+        if site is None or now - site[0] >= self.interval:
+            suppressed = site[2] if site is not None else 0
+            self.sites[(record.name, record.lineno)] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        if site[1] >= self.limit:
+            site[2] += 1
+            return False
+        site[1] += 1
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS:
+                data[key] = value
+        return json.dumps(data, default=str)
+
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.FileHandler(LOG_FILE, encoding="utf-8") if LOG_FILE else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = RedactingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for item in filter(None, LOG_LEVELS.split(",")):
+        name, _, level = item.partition("=")
+        name = name.strip()
+        # short names refer to modules of this package
+        if PACKAGE and os.path.exists(os.path.join(os.path.dirname(__file__), name + ".py")):
+            name = f"{PACKAGE}.{name}"
+        logging.getLogger(name).setLevel(level.strip().upper())
+
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
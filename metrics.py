@@ -0,0 +1,237 @@
+"""
+Prometheus text format metrics served on /metrics.
+Everything is a no-op unless METRICS_ENABLED=1, `instrument` then
+returns classes untouched so disabled metrics cost nothing on hot paths.
+"""
+from redis import Redis
+from .tracing import start_span
+from typing import Callable
+import functools
+import inspect
+import bisect
+import time
+import os
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        REGISTRY.register(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{self.format_labels(key)} {value}" for key, value in self.values.items()]
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.functions: dict[tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        self.values[self.key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def set_function(self, func: Callable[[], float], **labels):
+        """
+        Evaluate `func` at scrape time, e.g. for queue sizes
+        """
+        self.functions[self.key(labels)] = func
+
+    def samples(self) -> list[str]:
+        for key, func in self.functions.items():
+            try:
+                self.values[key] = func()
+            except Exception:
+                continue
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # label key -> [bucket counts..., sum, count]
+        self.series: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self.format_labels(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self.format_labels(key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"duplicate metric {metric.name}")
+        self.metrics[metric.name] = metric
+
+    def expose(self) -> str:
+        return "\n".join(metric.expose() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_SECONDS = Histogram("lnurl_http_request_seconds", "HTTP request latency by route", ("route", "method", "status"))
+DB_SECONDS = Histogram("lnurl_db_call_seconds", "PSQLClient method latency", ("method",))
+LND_SECONDS = Histogram("lnurl_lnd_call_seconds", "LndRestNode method latency", ("method",))
+LND_POOL_WAIT_SECONDS = Histogram("lnurl_lnd_pool_wait_seconds", "Wait for a pooled LND connection", ("pool",))
+REDIS_SECONDS = Histogram("lnurl_redis_command_seconds", "Redis command latency", ("command",))
+CALL_ERRORS = Counter("lnurl_call_errors_total", "Instrumented calls that raised", ("component", "method"))
+
+STREAM_EVENTS = Counter("lnurl_stream_events_total", "LND stream events received", ("stream",))
+STREAM_LAG_SECONDS = Gauge("lnurl_stream_lag_seconds", "Delay between LND event time and processing", ("stream",))
+QUEUE_DEPTH = Gauge("lnurl_queue_depth", "Items waiting in in-process queues", ("queue",))
+LANE_LAG_SECONDS = Gauge("lnurl_lane_lag_seconds", "Age of the oldest event in a settlement lane", ("stream", "lane"))
+LANE_ERRORS = Counter("lnurl_lane_errors_total", "Failed settlement lane handler attempts", ("stream",))
+LANE_DEAD_LETTERS = Counter("lnurl_lane_dead_letters_total", "Settlement lane items given up after all retries", ("stream",))
+TASK_UP = Gauge("lnurl_background_task_up", "1 while a background task is running", ("task",))
+TASK_RESTARTS = Counter("lnurl_background_task_restarts_total", "Background task crashes", ("task",))
+STARTUP_SECONDS = Gauge("lnurl_startup_seconds", "Time from importing the app until it first reported ready")
+
+WITHDRAW_STATUS = Counter("lnurl_withdraw_status_total", "Withdraw request status transitions", ("status",))
+DEPOSIT_STATUS = Counter("lnurl_deposit_status_total", "Deposit request status transitions", ("status",))
+
+
+def timed(histogram: Histogram, component: str, name: str):
+    """
+    Decorator timing an async function into `histogram` labelled method=name
+    """
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                CALL_ERRORS.inc(component=component, method=name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, method=name)
+        return wrapper
+    return decorator
+
+
+def instrument(histogram: Histogram, component: str):
+    """
+    Class decorator timing every public coroutine method, so methods
+    added later are instrumented without further changes
+    """
+    def decorator(cls):
+        if not METRICS_ENABLED:
+            return cls
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.iscoroutinefunction(func):
+                continue
+            setattr(cls, name, timed(histogram, component, name)(func))
+        return cls
+    return decorator
+
+
+async def http_middleware(request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe(
+            time.perf_counter() - started,
+            route=route.path if route is not None else "unmatched",
+            method=request.method,
+            status=status,
+        )
+
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client timing and tracing every command
+    """
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            with start_span(f"redis.{args[0]}"):
+                return super().execute_command(*args, **options)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - started, command=args[0])
+
+
+def expose() -> str:
+    return REGISTRY.expose()
@@ -1,304 +1,802 @@
-from pydantic import BaseModel
-from typing import Optional
-import codecs
-import asyncio
-import base64
-import hashlib
-import json
-from typing import AsyncGenerator, Dict, Optional
-import httpx
-from .base import (
-    PaymentResponse,
-    PaymentStatus,
-    StatusResponse,
-    LNDInvoice,
-)
-from typing import Optional
-import os
-
-
-MACAROON_PATH = os.getenv("MACAROON_PATH")
-CERT_PATH = os.getenv("CERT_PATH")
-LND_HOST = os.getenv("LND_HOST")
-
-def fee_reserve(amount_msat: int) -> int:
-    reserve_min = 30000
-    reserve_percent = 5
-    return max(int(reserve_min), int(amount_msat * reserve_percent / 100.0))
-
-
-class LndRestNode:
-    """https://api.lightning.community/rest/index.html#lnd-rest-api-reference"""
-
-    def __init__(self):
-        endpoint = LND_HOST
-        cert = CERT_PATH
-        macaroon = self.load_macaroon()
-
-        if not endpoint:
-            raise Exception("cannot initialize lndrest: no endpoint")
-
-        if not macaroon:
-            raise Exception("cannot initialize lndrest: no macaroon")
-
-        if not cert:
-            print('No cert')
-
-        endpoint = endpoint[:-1] if endpoint.endswith("/") else endpoint
-        self.endpoint = endpoint
-        self.macaroon = macaroon
-
-        self.cert = cert or True
-        self.auth = {"Grpc-Metadata-macaroon": self.macaroon}
-        self.client = httpx.AsyncClient(
-            base_url=self.endpoint, headers=self.auth, verify=self.cert
-        )
-
-    def load_macaroon(self) -> bytes:
-        macaroon = codecs.encode(open(MACAROON_PATH, 'rb').read(), 'hex')
-        return macaroon
-
-    async def cleanup(self):
-        try:
-            await self.client.aclose()
-        except RuntimeError as e:
-            pass
-
-    async def status(self) -> StatusResponse:
-        """
-        Get channel balance
-        """
-        try:
-            r = await self.client.get("/v1/balance/channels")
-            r.raise_for_status()
-        except (httpx.ConnectError, httpx.RequestError) as exc:
-            return StatusResponse(f"Unable to connect to {self.endpoint}. {exc}", 0)
-
-        try:
-            data = r.json()
-            if r.is_error:
-                raise Exception
-        except Exception:
-            return StatusResponse(r.text[:200], 0)
-        return StatusResponse(None, int(data["balance"]) * 1000)
-
-    async def create_invoice(
-        self,
-        amount: int,
-        memo: Optional[str] = None,
-        description_hash: Optional[bytes] = None,
-        unhashed_description: Optional[bytes] = None,
-        **kwargs,
-    ) -> LNDInvoice | None:
-        """
-        """
-        data: Dict = {"value": amount, "private": True, "memo": memo or ""}
-        if kwargs.get("expiry"):
-            data["expiry"] = kwargs["expiry"]
-        if description_hash:
-            data["description_hash"] = base64.b64encode(description_hash).decode(
-                "ascii"
-            )
-        elif unhashed_description:
-            data["description_hash"] = base64.b64encode(
-                hashlib.sha256(unhashed_description).digest()
-            ).decode("ascii")
-
-        r = await self.client.post(url="/v1/invoices", json=data)
-
-        if r.is_error:
-            return None
-        
-        data = r.json()
-        payment_hash = base64.b64decode(data["r_hash"]).hex()
-
-        return LNDInvoice(
-            payment_hash=payment_hash,
-            bolt11=data["payment_request"],
-            preimage=data["r_preimage"],
-            destination=data["payment_addr"],
-            num_satoshis=data["value"],
-            timestamp=data["creation_date"],
-            expiry=data["expiry"],
-            description=data["memo"],
-            description_hash=data["description_hash"],
-            fallback_addr=data["fallback_addr"],
-            cltv_expiry=data["cltv_expiry"],
-            route_hints=data["route_hints"],
-            payment_addr=data["payment_addr"],
-            features=data["features"]
-        )
-
-    async def pay_invoice(self, bolt11: str, fee_limit_msat: int) -> PaymentResponse:
-        # set the fee limit for the payment
-        lnrpcFeeLimit = dict()
-        lnrpcFeeLimit["fixed"] = f"{fee_limit_msat}"
-
-        r = await self.client.post(
-            url="/v1/channels/transactions",
-            json={"payment_request": bolt11, "fee_limit": lnrpcFeeLimit},
-            timeout=20,
-        )
-        if r.is_error or r.json().get("payment_error"):
-            error_message = r.json().get("payment_error") or r.text
-            return PaymentResponse(False, None, None, None, error_message)
-
-        data = r.json()
-        payment_hash = base64.b64decode(data["payment_hash"]).hex()
-        fee_msat = int(data["payment_route"]["total_fees_msat"])
-        preimage = base64.b64decode(data["payment_preimage"]).hex()
-
-        return PaymentResponse(True, payment_hash, fee_msat, preimage, None)
-
-
-    async def get_invoice_status(self, payment_hash: str) -> PaymentStatus:
-        r = await self.client.get(url=f"/v1/invoice/{payment_hash}")
-
-        if r.is_error or not r.json().get("settled"):
-            # this must also work when payment_hash is not a hex recognizable by lnd
-            # it will return an error and no "settled" attribute on the object
-            return PaymentStatus(None)
-        
-        return PaymentStatus(True)
-
-    async def get_payment_status(self, payment_hash: str) -> PaymentStatus:
-        """
-        This routine checks the payment status using routerpc.TrackPaymentV2.
-        """
-        # convert checking_id from hex to base64 and some LND magic
-        try:
-            payment_hash = base64.urlsafe_b64encode(bytes.fromhex(payment_hash)).decode(
-                "ascii"
-            )
-        except ValueError:
-            return PaymentStatus(None)
-
-        url = f"/v2/router/track/{payment_hash}"
-
-        # check payment.status:
-        # https://api.lightning.community/?python=#paymentpaymentstatus
-        statuses = {
-            "UNKNOWN": None,
-            "IN_FLIGHT": None,
-            "SUCCEEDED": True,
-            "FAILED": False,
-        }
-
-        async with self.client.stream("GET", url, timeout=None) as r:
-            async for json_line in r.aiter_lines():
-                try:
-                    line = json.loads(json_line)
-                    if line.get("error"):
-                        return PaymentStatus(None)
-                    payment = line.get("result")
-                    if payment is not None and payment.get("status"):
-                        return PaymentStatus(
-                            paid=statuses[payment["status"]],
-                            fee_msat=payment.get("fee_msat"),
-                            preimage=payment.get("payment_preimage"),
-                        )
-                    else:
-                        return PaymentStatus(None)
-                except Exception:
-                    continue
-
-        return PaymentStatus(None)
-
-    async def paid_invoices_stream(self) -> AsyncGenerator[LNDInvoice, None]:
-        while True:
-            try:
-                url = "/v1/invoices/subscribe"
-                async with self.client.stream("GET", url, timeout=None) as r:
-                    async for line in r.aiter_lines():
-                        try:
-                            data = json.loads(line)["result"]
-                        except Exception:
-                            continue
-                        payment_hash = base64.b64decode(data["r_hash"]).hex()
-                        data["decoded_hash"] = payment_hash
-                        invoice = LNDInvoice(
-                            payment_hash=payment_hash,
-                            bolt11=data["payment_request"],
-                            preimage=data["r_preimage"],
-                            state=data["state"],
-                            destination=data["payment_addr"],
-                            num_satoshis=data["value"],
-                            timestamp=data["creation_date"],
-                            expiry=data["expiry"],
-                            description=data["memo"],
-                            description_hash=data["description_hash"],
-                            fallback_addr=data["fallback_addr"],
-                            cltv_expiry=data["cltv_expiry"],
-                            route_hints=data["route_hints"],
-                            payment_addr=data["payment_addr"],
-                            features=data["features"]
-                        )
-                        yield invoice
-            except Exception as exc:
-                await asyncio.sleep(5)
-
-    async def invoices_stream(self) -> AsyncGenerator[str, None]:
-        while True:
-            try:
-                url = "/v1/invoices/subscribe"
-                async with self.client.stream("GET", url, timeout=None) as r:
-                    async for line in r.aiter_lines():
-                        try:
-                            print('Received invoice response ', line)
-                            inv = json.loads(line)["result"]
-                        except Exception:
-                            continue
-                        payment_hash = base64.b64decode(inv["r_hash"]).hex()
-                        inv["decoded_hash"] = payment_hash
-                        yield inv
-            except Exception as exc:
-                await asyncio.sleep(5)
-
-    async def decode_invoice(self, pay_req: str) -> LNDInvoice | None:
-        url = "v1/payreq/"+pay_req
-        r = await self.client.get(url)
-        if r.is_error:
-            error_message = r.json().get("payment_error") or r.text
-            print(error_message)
-            return None
-        try:
-            data = r.json()
-            invoice = LNDInvoice(**data)
-            invoice.bolt11 = pay_req
-            invoice.state = "ACCEPTED"
-        except Exception as e:
-            return None
-        return invoice
-
-
-    async def get_peer_ids(self) -> list[str]:
-        response = await self.client.get("/v1/peers")
-        if response.status_code == 200:
-            return [p["pub_key"] for p in response.json()["peers"]]
-        else:
-            return None
-        
-
-    async def track_payments(self):
-        print('node starts tracking paymnets')
-        url = "/v2/router/payments"
-        async with self.client.stream("GET", url, timeout=None) as r:
-            async for json_line in r.aiter_lines():
-                try:
-                    line = json.loads(json_line)
-                    if line.get("error"):
-                        continue
-                    payment = line.get("result")
-                    if payment is not None and payment.get("status", False):
-                        yield PaymentStatus(
-                            payment_hash=payment["payment_hash"],
-                            payment_preimage=payment.get("payment_preimage"),
-                            value_sat=payment.get("value_sat"),
-                            status=payment["status"],
-                            fee_sat=payment.get("fee_sat"),
-                        )
-                    else:
-                        print("Payment status error: ", line)
-                except Exception as e:
-                    continue
-    
\ No newline at end of file
+from pydantic import BaseModel
+from typing import Optional
+import codecs
+import asyncio
+import base64
+import hashlib
+import json
+from typing import AsyncGenerator, Callable, Dict, Optional
+import httpx
+from .base import (
+    PaymentResponse,
+    PaymentStatus,
+    StatusResponse,
+    LNDInvoice,
+)
+from .helpers import AdmissionGate, CircuitBreaker, ServiceUnavailableError
+from .metrics import instrument, LND_SECONDS, LND_POOL_WAIT_SECONDS, STREAM_EVENTS, STREAM_LAG_SECONDS
+from .tracing import trace_methods
+from .recording import stream_lines
+from typing import Optional
+from collections import deque
+from contextvars import ContextVar
+import functools
+import logging
+import math
+import time
+import os
+
+
+MACAROON_PATH = os.getenv("MACAROON_PATH")
+CERT_PATH = os.getenv("CERT_PATH")
+LND_HOST = os.getenv("LND_HOST")
+LND_NODE_NAME = os.getenv("LND_NODE_NAME", "default")
+# several nodes, json list of {"name", "host", "macaroon", "cert"}, overrides the above
+LND_NODES = os.getenv("LND_NODES")
+
+logger = logging.getLogger(__name__)
+
+# connection pools, see LndRestNode.__init__
+LND_HTTP2 = os.getenv("LND_HTTP2", "0") == "1"   # needs the `h2` package
+LND_UNARY_CONNECTIONS = int(os.getenv("LND_UNARY_CONNECTIONS", 20))
+LND_PAYMENT_CONNECTIONS = int(os.getenv("LND_PAYMENT_CONNECTIONS", 10))
+LND_STREAM_CONNECTIONS = int(os.getenv("LND_STREAM_CONNECTIONS", 4))
+LND_KEEPALIVE_EXPIRY = float(os.getenv("LND_KEEPALIVE_EXPIRY", 30))
+
+# unary call protection, see guarded
+LND_MAX_CONCURRENT = int(os.getenv("LND_MAX_CONCURRENT", LND_UNARY_CONNECTIONS))
+LND_ADMISSION_WAIT = float(os.getenv("LND_ADMISSION_WAIT", 0.5))
+LND_SLOW_CALL = float(os.getenv("LND_SLOW_CALL", 2.0))
+LND_BREAKER_RESET = float(os.getenv("LND_BREAKER_RESET", 15))
+
+# seconds a local payout reservation survives a liquidity refresh,
+# covers payouts not yet visible as pending htlcs
+LIQUIDITY_RESERVATION_GRACE = float(os.getenv("LIQUIDITY_RESERVATION_GRACE", 5))
+# seconds after which a snapshot no refresh could replace counts as unknown
+LIQUIDITY_MAX_AGE = float(os.getenv("LIQUIDITY_MAX_AGE", 120))
+
+# payout fee limits, see FeeEstimator
+FEE_ROUTE_TTL = float(os.getenv("FEE_ROUTE_TTL", 300))
+FEE_LIMIT_MIN_SAT = int(os.getenv("FEE_LIMIT_MIN_SAT", 10))
+FEE_LIMIT_MAX_SAT = int(os.getenv("FEE_LIMIT_MAX_SAT", 10000))
+
+def fee_reserve(amount_msat: int) -> int:
+    reserve_min = 30000
+    reserve_percent = 5
+    return max(int(reserve_min), int(amount_msat * reserve_percent / 100.0))
+
+
+# set by the unary client's response hook when LND answers 5xx, read by guarded
+server_error: ContextVar[bool] = ContextVar("lnd_server_error", default=False)
+
+
+async def flag_server_error(response: httpx.Response):
+    if response.status_code >= 500:
+        server_error.set(True)
+
+
+def guarded(func):
+    """
+    Run a unary LND call through the node admission gate and circuit breaker.
+    Exceptions, 5xx replies and slow calls count as failures, also when the
+    method turns the reply into None. Transport errors and calls while the
+    breaker is open raise ServiceUnavailableError.
+    """
+    @functools.wraps(func)
+    async def wrapper(self: "LndRestNode", *args, **kwargs):
+        async with self.gate.enter():
+            if not self.breaker.allow():
+                raise ServiceUnavailableError(f"{self.endpoint} unavailable")
+            started = time.perf_counter()
+            ok = True
+            token = server_error.set(False)
+            try:
+                result = await func(self, *args, **kwargs)
+                ok = not server_error.get()
+                return result
+            except httpx.TransportError as exc:
+                ok = False
+                raise ServiceUnavailableError(f"{self.endpoint} unavailable") from exc
+            except Exception:
+                ok = False
+                raise
+            finally:
+                server_error.reset(token)
+                duration = time.perf_counter() - started
+                self.breaker.record(ok, duration)
+                # a failure weighs like a slow call, so failing nodes rank last
+                sample = duration if ok else max(duration, LND_SLOW_CALL)
+                self.latency += (sample - self.latency) * 0.2
+    return wrapper
+
+
+class PoolWaitStats:
+    """
+    Time requests spend waiting for a pooled connection.
+    Measured from send until the connection is picked (new tcp connect
+    or request headers written on a reused connection).
+    """
+    ACQUIRED = ("connect_tcp.started", "send_request_headers.started")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        LND_POOL_WAIT_SECONDS.observe(seconds, pool=self.name)
+
+    async def on_request(self, request: httpx.Request):
+        started = time.perf_counter()
+        acquired = False
+
+        async def trace(event_name: str, info: dict):
+            nonlocal acquired
+            if not acquired and event_name.endswith(self.ACQUIRED):
+                acquired = True
+                self.observe(time.perf_counter() - started)
+
+        request.extensions["trace"] = trace
+
+
+class LiquiditySnapshot:
+    """
+    Channel liquidity as of the last background refresh.
+    Payouts dispatched since then are reserved locally, so admission
+    checks never need a node round-trip. A snapshot older than `max_age`
+    is unknown again, callers then don't clamp on it.
+    """
+    def __init__(self, max_age: float = LIQUIDITY_MAX_AGE):
+        self.max_age = max_age
+        self.channels: list[dict] = []
+        self.local_sat = 0          # sum of local balances, active channels
+        self.remote_sat = 0         # sum of remote balances, active channels
+        self.max_sendable_sat = 0   # largest single channel spendable amount
+        self.max_receivable_sat = 0
+        self.pending_htlcs = 0
+        self.ts_refreshed: Optional[float] = None
+        self.stale = asyncio.Event()
+        # payment_hash -> (amount, reserved at)
+        self.reserved: dict[str, tuple[int, float]] = {}
+        self.reserved_total = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.ts_refreshed is not None and time.time() - self.ts_refreshed < self.max_age
+
+    def spendable(self) -> Optional[int]:
+        """
+        Largest payout we expect to route right now, None while unknown
+        """
+        if not self.ready:
+            return None
+        return max(0, self.max_sendable_sat - self.reserved_total)
+
+    def reserve(self, payment_hash: str, amount: int):
+        self.release(payment_hash)
+        self.reserved[payment_hash] = (amount, time.time())
+        self.reserved_total += amount
+
+    def release(self, payment_hash: str):
+        amount, _ = self.reserved.pop(payment_hash, (0, 0))
+        self.reserved_total -= amount
+
+    def invalidate(self):
+        self.stale.set()
+
+    def update(self, channels: list[dict], started: float):
+        active = [c for c in channels if c.get("active")]
+        spendable = [
+            int(c.get("local_balance", 0)) - int(c.get("local_chan_reserve_sat", 0))
+            for c in active
+        ]
+        receivable = [
+            int(c.get("remote_balance", 0)) - int(c.get("remote_chan_reserve_sat", 0))
+            for c in active
+        ]
+        self.channels = channels
+        self.local_sat = sum(int(c.get("local_balance", 0)) for c in active)
+        self.remote_sat = sum(int(c.get("remote_balance", 0)) for c in active)
+        self.max_sendable_sat = max(spendable, default=0)
+        self.max_receivable_sat = max(receivable, default=0)
+        self.pending_htlcs = sum(len(c.get("pending_htlcs", [])) for c in channels)
+
+        # older reservations are in-flight htlcs by now, part of the balances above
+        cutoff = started - LIQUIDITY_RESERVATION_GRACE
+        for payment_hash, (_, reserved_at) in list(self.reserved.items()):
+            if reserved_at < cutoff:
+                self.release(payment_hash)
+        self.ts_refreshed = started
+        self.stale.clear()
+
+
+class FeeEstimator:
+    """
+    Per-payment fee limits for payouts.
+    Route fees are probed with /v1/graph/routes and cached per destination
+    pubkey for `ttl` seconds, recent successful payments to the destination
+    raise the estimate, failures widen it for the next payout.
+    """
+    def __init__(self, node: "LndRestNode", ttl: float = FEE_ROUTE_TTL, margin: float = 1.5,
+                 min_fee: int = FEE_LIMIT_MIN_SAT, max_fee: int = FEE_LIMIT_MAX_SAT, history: int = 20):
+        self.node = node
+        self.ttl = ttl
+        self.margin = margin
+        self.min_fee = min_fee
+        self.max_fee = max_fee
+        self.history = history
+        # destination -> (route fee ppm, probed at)
+        self.routes: dict[str, tuple[float, float]] = {}
+        # destination -> fee ppm of recent successful payouts
+        self.observed: dict[str, deque[float]] = {}
+        # destination -> multiplier after failed payouts
+        self.boost: dict[str, float] = {}
+        # payment_hash -> (destination, amount) for payouts in flight
+        self.pending: dict[str, tuple[str, int]] = {}
+
+    async def route_fee_ppm(self, destination: str, amount: int) -> Optional[float]:
+        now = time.monotonic()
+        cached = self.routes.get(destination)
+        if cached is not None and now - cached[1] < self.ttl:
+            return cached[0]
+        try:
+            fee_msat = await self.node.query_route_fee(destination, amount)
+        except ServiceUnavailableError:
+            return None
+        if fee_msat is None:
+            return None
+        self.evict(now)
+        ppm = fee_msat * 1000 / amount
+        self.routes[destination] = (ppm, now)
+        return ppm
+
+    def evict(self, now: float):
+        expired = [k for k, (_, ts) in self.routes.items() if now - ts >= self.ttl]
+        for k in expired:
+            self.routes.pop(k)
+
+    async def fee_limit(self, invoice: LNDInvoice) -> int:
+        """
+        Fee limit in sat for paying `invoice`
+        """
+        amount = invoice.num_satoshis
+        ppm = await self.route_fee_ppm(invoice.destination, amount)
+        observed = self.observed.get(invoice.destination)
+        if observed:
+            ppm = max(ppm or 0, max(observed))
+        if ppm is None:
+            # nothing known about the destination
+            limit = fee_reserve(amount * 1000) // 1000
+        else:
+            boost = self.boost.get(invoice.destination, 1)
+            limit = math.ceil(amount * ppm * self.margin * boost / 1_000_000)
+        return min(max(limit, self.min_fee), self.max_fee)
+
+    def track(self, payment_hash: str, destination: str, amount: int):
+        self.pending[payment_hash] = (destination, amount)
+
+    def observe(self, status: PaymentStatus):
+        destination, amount = self.pending.pop(status.payment_hash, (None, 0))
+        if destination is None or not amount:
+            return
+        if status.status == "SUCCEEDED":
+            ppm = int(status.fee_sat or 0) * 1_000_000 / amount
+            self.observed.setdefault(destination, deque(maxlen=self.history)).append(ppm)
+            self.boost.pop(destination, None)
+        elif status.status == "FAILED":
+            # route changed or limit too tight, probe again and allow more next time
+            self.routes.pop(destination, None)
+            self.boost[destination] = min(self.boost.get(destination, 1) * 2, 8)
+
+
+@trace_methods("lnd")
+@instrument(LND_SECONDS, "lnd")
+class LndRestNode:
+    """https://api.lightning.community/rest/index.html#lnd-rest-api-reference"""
+
+    def __init__(self, name: str = LND_NODE_NAME, endpoint: Optional[str] = LND_HOST,
+                 macaroon_path: Optional[str] = MACAROON_PATH, cert: Optional[str] = CERT_PATH):
+        macaroon = self.load_macaroon(macaroon_path)
+
+        if not endpoint:
+            raise Exception("cannot initialize lndrest: no endpoint")
+
+        if not macaroon:
+            raise Exception("cannot initialize lndrest: no macaroon")
+
+        if not cert:
+            logger.warning("no cert, using system CA bundle")
+
+        endpoint = endpoint[:-1] if endpoint.endswith("/") else endpoint
+        self.name = name
+        self.endpoint = endpoint
+        self.macaroon = macaroon
+
+        self.cert = cert or True
+        self.auth = {"Grpc-Metadata-macaroon": self.macaroon}
+        self.breaker = CircuitBreaker(slow_call=LND_SLOW_CALL, reset_timeout=LND_BREAKER_RESET)
+        self.gate = AdmissionGate(LND_MAX_CONCURRENT, LND_ADMISSION_WAIT)
+        self.liquidity = LiquiditySnapshot()
+        self.fees = FeeEstimator(self)
+        # moving average of unary calls in seconds, failures count as LND_SLOW_CALL,
+        # starts pessimistic so an untried node does not outrank a proven one
+        self.latency = LND_SLOW_CALL
+        self.pool_wait = {name: PoolWaitStats(name) for name in ("unary", "payment", "stream")}
+
+        # request/response calls: decode, create invoice, balances
+        self.client = self._create_client(
+            "unary",
+            httpx.Limits(
+                max_connections=LND_UNARY_CONNECTIONS,
+                max_keepalive_connections=LND_UNARY_CONNECTIONS,
+                keepalive_expiry=LND_KEEPALIVE_EXPIRY,
+            ),
+            httpx.Timeout(10.0, connect=5.0, pool=2.0),
+        )
+        # blocking payouts, kept apart so they cannot starve decodes
+        self.payment_client = self._create_client(
+            "payment",
+            httpx.Limits(
+                max_connections=LND_PAYMENT_CONNECTIONS,
+                max_keepalive_connections=LND_PAYMENT_CONNECTIONS,
+                keepalive_expiry=LND_KEEPALIVE_EXPIRY,
+            ),
+            httpx.Timeout(60.0, connect=5.0, pool=30.0),
+        )
+        # long-lived subscriptions, one connection each
+        self.stream_client = self._create_client(
+            "stream",
+            httpx.Limits(
+                max_connections=LND_STREAM_CONNECTIONS,
+                max_keepalive_connections=0,
+            ),
+            httpx.Timeout(None, connect=5.0),
+        )
+        self._invoice_subscribers: list[asyncio.Queue] = []
+        self._invoice_task: Optional[asyncio.Task] = None
+
+    def load_macaroon(self, path: str) -> bytes:
+        macaroon = codecs.encode(open(path, 'rb').read(), 'hex')
+        return macaroon
+
+    def _create_client(self, name: str, limits: httpx.Limits, timeout: httpx.Timeout) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=self.endpoint,
+            headers=self.auth,
+            verify=self.cert,
+            limits=limits,
+            timeout=timeout,
+            http2=LND_HTTP2,
+            event_hooks={"request": [self.pool_wait[name].on_request], "response": [flag_server_error]},
+        )
+
+    async def cleanup(self):
+        for client in (self.client, self.payment_client, self.stream_client):
+            try:
+                await client.aclose()
+            except RuntimeError as e:
+                pass
+
+    @guarded
+    async def status(self) -> StatusResponse:
+        """
+        Get channel balance, an unreachable node raises ServiceUnavailableError
+        """
+        r = await self.client.get("/v1/balance/channels", timeout=5)
+        try:
+            data = r.json()
+            if r.is_error:
+                raise Exception
+        except Exception:
+            return StatusResponse(r.text[:200], 0)
+        return StatusResponse(None, int(data["balance"]) * 1000)
+
+    @guarded
+    async def create_invoice(
+        self,
+        amount: int,
+        memo: Optional[str] = None,
+        description_hash: Optional[bytes] = None,
+        unhashed_description: Optional[bytes] = None,
+        **kwargs,
+    ) -> LNDInvoice | None:
+        """
+        """
+        data: Dict = {"value": amount, "private": True, "memo": memo or ""}
+        if kwargs.get("expiry"):
+            data["expiry"] = kwargs["expiry"]
+        if description_hash:
+            data["description_hash"] = base64.b64encode(description_hash).decode(
+                "ascii"
+            )
+        elif unhashed_description:
+            data["description_hash"] = base64.b64encode(
+                hashlib.sha256(unhashed_description).digest()
+            ).decode("ascii")
+
+        r = await self.client.post(url="/v1/invoices", json=data, timeout=10)
+
+        if r.is_error:
+            return None
+        
+        data = r.json()
+        payment_hash = base64.b64decode(data["r_hash"]).hex()
+
+        return LNDInvoice(
+            payment_hash=payment_hash,
+            bolt11=data["payment_request"],
+            preimage=data["r_preimage"],
+            destination=data["payment_addr"],
+            num_satoshis=data["value"],
+            timestamp=data["creation_date"],
+            expiry=data["expiry"],
+            description=data["memo"],
+            description_hash=data["description_hash"],
+            fallback_addr=data["fallback_addr"],
+            cltv_expiry=data["cltv_expiry"],
+            route_hints=data["route_hints"],
+            payment_addr=data["payment_addr"],
+            features=data["features"]
+        )
+
+    async def pay(self, invoice: LNDInvoice) -> PaymentResponse:
+        """
+        Pay a decoded invoice with an estimated fee limit
+        """
+        fee_limit = await self.fees.fee_limit(invoice)
+        self.fees.track(invoice.payment_hash, invoice.destination, invoice.num_satoshis)
+        return await self.pay_invoice(invoice.bolt11, fee_limit)
+
+    async def pay_invoice(self, bolt11: str, fee_limit_sat: int) -> PaymentResponse:
+        # set the fee limit for the payment
+        lnrpcFeeLimit = dict()
+        lnrpcFeeLimit["fixed"] = f"{fee_limit_sat}"
+
+        r = await self.payment_client.post(
+            url="/v1/channels/transactions",
+            json={"payment_request": bolt11, "fee_limit": lnrpcFeeLimit},
+        )
+        if r.is_error or r.json().get("payment_error"):
+            error_message = r.json().get("payment_error") or r.text
+            return PaymentResponse(False, None, None, None, error_message)
+
+        data = r.json()
+        payment_hash = base64.b64decode(data["payment_hash"]).hex()
+        fee_msat = int(data["payment_route"]["total_fees_msat"])
+        preimage = base64.b64decode(data["payment_preimage"]).hex()
+
+        return PaymentResponse(True, payment_hash, fee_msat, preimage, None)
+
+
+    @guarded
+    async def get_invoice_status(self, payment_hash: str) -> PaymentStatus:
+        r = await self.client.get(url=f"/v1/invoice/{payment_hash}", timeout=5)
+
+        if r.is_error or not r.json().get("settled"):
+            # this must also work when payment_hash is not a hex recognizable by lnd
+            # it will return an error and no "settled" attribute on the object
+            return PaymentStatus(None)
+        
+        return PaymentStatus(True)
+
+    async def get_payment_status(self, payment_hash: str) -> PaymentStatus:
+        """
+        This routine checks the payment status using routerpc.TrackPaymentV2.
+        """
+        # convert checking_id from hex to base64 and some LND magic
+        try:
+            payment_hash = base64.urlsafe_b64encode(bytes.fromhex(payment_hash)).decode(
+                "ascii"
+            )
+        except ValueError:
+            return PaymentStatus(None)
+
+        url = f"/v2/router/track/{payment_hash}"
+
+        # check payment.status:
+        # https://api.lightning.community/?python=#paymentpaymentstatus
+        statuses = {
+            "UNKNOWN": None,
+            "IN_FLIGHT": None,
+            "SUCCEEDED": True,
+            "FAILED": False,
+        }
+
+        async with self.stream_client.stream("GET", url) as r:
+            async for json_line in r.aiter_lines():
+                try:
+                    line = json.loads(json_line)
+                    if line.get("error"):
+                        return PaymentStatus(None)
+                    payment = line.get("result")
+                    if payment is not None and payment.get("status"):
+                        return PaymentStatus(
+                            paid=statuses[payment["status"]],
+                            fee_msat=payment.get("fee_msat"),
+                            preimage=payment.get("payment_preimage"),
+                        )
+                    else:
+                        return PaymentStatus(None)
+                except Exception:
+                    continue
+
+        return PaymentStatus(None)
+
+    async def _invoice_subscription(self):
+        """
+        Single /v1/invoices/subscribe reader shared by all invoice consumers.
+        Only SETTLED updates are fanned out, everything else is dropped
+        before any decoding.
+        """
+        while True:
+            try:
+                url = "/v1/invoices/subscribe"
+                async with self.stream_client.stream("GET", url) as r:
+                    async for line in stream_lines(r, self.name, "invoices"):
+                        # cheap substring check before parsing the line
+                        if "SETTLED" not in line:
+                            continue
+                        try:
+                            data = json.loads(line)["result"]
+                        except Exception:
+                            continue
+                        if data.get("state") != "SETTLED":
+                            continue
+                        data["decoded_hash"] = base64.b64decode(data["r_hash"]).hex()
+                        STREAM_EVENTS.inc(stream="invoices")
+                        if data.get("settle_date"):
+                            STREAM_LAG_SECONDS.set(time.time() - int(data["settle_date"]), stream="invoices")
+                        for queue in self._invoice_subscribers:
+                            queue.put_nowait(data)
+            except Exception as exc:
+                await asyncio.sleep(5)
+
+    async def _subscribe_invoices(self) -> AsyncGenerator[dict, None]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._invoice_subscribers.append(queue)
+        if self._invoice_task is None or self._invoice_task.done():
+            self._invoice_task = asyncio.create_task(self._invoice_subscription())
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._invoice_subscribers.remove(queue)
+            if not self._invoice_subscribers:
+                self._invoice_task.cancel()
+                self._invoice_task = None
+
+    async def paid_invoices_stream(
+        self, accept: Optional[Callable[[str], bool]] = None
+    ) -> AsyncGenerator[LNDInvoice, None]:
+        """
+        Settled invoices. `accept` filters on the hex payment hash
+        before the LNDInvoice model is built.
+        """
+        async for data in self._subscribe_invoices():
+            payment_hash = data["decoded_hash"]
+            if accept is not None and not accept(payment_hash):
+                continue
+            yield LNDInvoice(
+                payment_hash=payment_hash,
+                bolt11=data["payment_request"],
+                preimage=data["r_preimage"],
+                state=data["state"],
+                destination=data["payment_addr"],
+                num_satoshis=data["value"],
+                timestamp=data["creation_date"],
+                expiry=data["expiry"],
+                description=data["memo"],
+                description_hash=data["description_hash"],
+                fallback_addr=data["fallback_addr"],
+                cltv_expiry=data["cltv_expiry"],
+                route_hints=data["route_hints"],
+                payment_addr=data["payment_addr"],
+                features=data["features"]
+            )
+
+    async def invoices_stream(
+        self, accept: Optional[Callable[[str], bool]] = None
+    ) -> AsyncGenerator[dict, None]:
+        """
+        Settled invoices as raw dicts, same shared subscription
+        """
+        async for data in self._subscribe_invoices():
+            if accept is not None and not accept(data["decoded_hash"]):
+                continue
+            yield data
+
+    @guarded
+    async def decode_invoice(self, pay_req: str) -> LNDInvoice | None:
+        url = "v1/payreq/"+pay_req
+        r = await self.client.get(url, timeout=5)
+        if r.is_error:
+            error_message = r.json().get("payment_error") or r.text
+            logger.info("invoice decode failed", extra={"error": error_message[:200]})
+            return None
+        try:
+            data = r.json()
+            invoice = LNDInvoice(**data)
+            invoice.bolt11 = pay_req
+            invoice.state = "ACCEPTED"
+        except Exception as e:
+            return None
+        return invoice
+
+
+    @guarded
+    async def get_peer_ids(self) -> list[str]:
+        response = await self.client.get("/v1/peers", timeout=5)
+        if response.status_code == 200:
+            return [p["pub_key"] for p in response.json()["peers"]]
+        else:
+            return None
+        
+
+    @guarded
+    async def get_channels(self) -> list[dict]:
+        r = await self.client.get("/v1/channels", timeout=5)
+        r.raise_for_status()
+        return r.json().get("channels", [])
+
+    @guarded
+    async def query_route_fee(self, pub_key: str, amount: int) -> Optional[int]:
+        """
+        Total fees in msat of the best route to `pub_key` for `amount` sat
+        """
+        r = await self.client.get(f"/v1/graph/routes/{pub_key}/{amount}", timeout=5)
+        if r.is_error:
+            return None
+        routes = r.json().get("routes") or []
+        if not routes:
+            return None
+        return int(routes[0].get("total_fees_msat", 0))
+
+    async def refresh_liquidity(self):
+        started = time.time()
+        channels = await self.get_channels()
+        self.liquidity.update(channels, started)
+
+    async def channel_events(self) -> AsyncGenerator[str, None]:
+        """
+        Channel event types from /v1/channels/subscribe, reconnecting
+        whenever LND closes or drops the stream
+        """
+        url = "/v1/channels/subscribe"
+        while True:
+            try:
+                async with self.stream_client.stream("GET", url) as r:
+                    async for line in stream_lines(r, self.name, "channels"):
+                        try:
+                            event = json.loads(line)["result"]
+                        except Exception:
+                            continue
+                        yield event.get("type")
+                logger.warning("channel stream ended, reconnecting", extra={"node": self.name})
+            except Exception as exc:
+                logger.warning("channel stream failed, reconnecting", extra={"node": self.name, "error": str(exc)})
+            # missed events while away, refresh once back
+            self.liquidity.invalidate()
+            await asyncio.sleep(5)
+
+    async def track_payments(self):
+        """
+        Payment updates from /v2/router/payments, reconnecting whenever LND
+        closes or drops the stream so the consumer never ends
+        """
+        url = "/v2/router/payments"
+        while True:
+            logger.info("tracking payments")
+            try:
+                async with self.stream_client.stream("GET", url) as r:
+                    async for json_line in stream_lines(r, self.name, "payments"):
+                        try:
+                            line = json.loads(json_line)
+                            if line.get("error"):
+                                continue
+                            payment = line.get("result")
+                            if payment is not None and payment.get("status", False):
+                                STREAM_EVENTS.inc(stream="payments")
+                                yield PaymentStatus(
+                                    payment_hash=payment["payment_hash"],
+                                    payment_preimage=payment.get("payment_preimage"),
+                                    value_sat=payment.get("value_sat"),
+                                    status=payment["status"],
+                                    fee_sat=payment.get("fee_sat"),
+                                )
+                            else:
+                                logger.warning("payment update without status", extra={"line": str(line)[:500]})
+                        except Exception as e:
+                            continue
+                logger.warning("payment stream ended, reconnecting", extra={"node": self.name})
+            except Exception as exc:
+                logger.warning("payment stream failed, reconnecting", extra={"node": self.name, "error": str(exc)})
+            await asyncio.sleep(5)
+    
+
+class LndNodePool:
+    """
+    Several LND nodes behind one interface. Unary calls go to the healthiest,
+    fastest node and fail over to the next one, payouts to the node with the
+    most outbound liquidity, deposit invoices to the most inbound liquidity.
+    Streams and liquidity refreshes run per node, see tasks.py.
+    """
+    def __init__(self, nodes: list[LndRestNode]):
+        self.nodes = {node.name: node for node in nodes}
+
+    @classmethod
+    def from_env(cls) -> "LndNodePool":
+        if not LND_NODES:
+            return cls([LndRestNode()])
+        return cls([
+            LndRestNode(c["name"], c["host"], c["macaroon"], c.get("cert"))
+            for c in json.loads(LND_NODES)
+        ])
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get(self, name: str) -> Optional[LndRestNode]:
+        return self.nodes.get(name)
+
+    def ranked(self) -> list[LndRestNode]:
+        """
+        Nodes accepting calls, fastest and least busy first
+        """
+        healthy = [node for node in self if node.breaker.available()]
+        return sorted(healthy, key=lambda node: node.latency * (1 + node.gate.active / node.gate.limit))
+
+    async def call(self, method: str, *args, **kwargs):
+        error = ServiceUnavailableError("no lnd node available")
+        for node in self.ranked():
+            try:
+                return await getattr(node, method)(*args, **kwargs)
+            except ServiceUnavailableError as exc:
+                error = exc
+        raise error
+
+    async def decode_invoice(self, pay_req: str) -> LNDInvoice | None:
+        return await self.call("decode_invoice", pay_req)
+
+    def spendable(self) -> Optional[int]:
+        """
+        Largest payout any node can route, None while unknown
+        """
+        values = [node.liquidity.spendable() for node in self.ranked()]
+        if not values or None in values:
+            return None
+        return max(values)
+
+    def for_payout(self, amount: int) -> Optional[LndRestNode]:
+        """
+        Node with the most outbound liquidity able to send `amount`
+        """
+        nodes = self.ranked()
+        able = [node for node in nodes if (node.liquidity.spendable() or 0) >= amount]
+        if able:
+            return max(able, key=lambda node: node.liquidity.spendable())
+        unknown = [node for node in nodes if node.liquidity.spendable() is None]
+        return unknown[0] if unknown else None
+
+    def for_deposit(self) -> LndRestNode:
+        """
+        Node with the most inbound liquidity
+        """
+        nodes = self.ranked() or list(self)
+        return max(nodes, key=lambda node: node.liquidity.max_receivable_sat if node.liquidity.ready else -1)
+
+    async def cleanup(self):
+        await asyncio.gather(*(node.cleanup() for node in self))
+
+    async def check(self) -> bool:
+        """
+        At least one node answers, also opens a connection to each of them
+        """
+        statuses = await asyncio.gather(*(node.status() for node in self), return_exceptions=True)
+        return any(isinstance(status, StatusResponse) and status.error_message is None for status in statuses)
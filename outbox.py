@@ -0,0 +1,102 @@
+"""
+Deliver side effects of settlement from the outbox table.
+
+withdraw_redeem_request, finalize_payment, failed_payment and
+deposit_finalize add one outbox event per status change in their own
+transaction, so an effect is never lost when the process dies after commit,
+and never sent for a rolled back change. A repeated settlement changes no
+status and adds no event, also after the first one was delivered. The relay task claims due events
+for OUTBOX_LEASE seconds, so every worker can run it, and for each event:
+
+  * refreshes the Redis session balance of the user and releases the
+    `::session` lock taken by the withdraw callback
+  * POSTs the event to WEBHOOK_URL when set, with an Idempotency-Key
+    header since delivery is at least once
+
+Failed events are retried with exponential backoff, later events of the
+same user wait for them.
+"""
+from redis import Redis, ConnectionPool
+from typing import Optional
+import asyncio
+import logging
+import httpx
+import os
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", 5))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", 100))
+OUTBOX_MAX_BACKOFF = int(os.getenv("OUTBOX_MAX_BACKOFF", 300))
+# seconds a relay holds claimed events, longer than a batch takes to deliver
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", 60))
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after(attempts: int) -> int:
+    return min(2 ** attempts, OUTBOX_MAX_BACKOFF)
+
+
+def refresh_session(redis_conn: Redis, event: dict):
+    """
+    Only existing sessions are updated, a missing one means the user is logged out
+    """
+    key = f"{event['payload']['userid']}::session"
+    if not redis_conn.exists(key):
+        return
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hset(key, "balance", event["balance"])
+    if event["payload"]["status"] == "QUEUED":
+        pipe.hset(key, "status", "active")
+    pipe.execute()
+
+
+class OutboxRelay:
+
+    def __init__(self, redis_pool: ConnectionPool, redis_client=Redis, webhook_url: str = WEBHOOK_URL):
+        self.redis_pool = redis_pool
+        self.redis_client = redis_client
+        self.webhook_url = webhook_url
+        self.client: Optional[httpx.AsyncClient] = None
+        if webhook_url:
+            self.client = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT)
+
+    async def deliver(self, event: dict) -> bool:
+        try:
+            redis_conn = self.redis_client(connection_pool=self.redis_pool)
+            await asyncio.to_thread(refresh_session, redis_conn, event)
+            if self.client is not None:
+                response = await self.client.post(
+                    self.webhook_url, json=event["payload"], headers={"Idempotency-Key": event["event_key"]}
+                )
+                response.raise_for_status()
+        except Exception as exc:
+            logger.warning("outbox delivery failed", extra={
+                "event_key": event["event_key"], "attempts": event["attempts"], "error": str(exc),
+            })
+            return False
+        return True
+
+    async def dispatch(self, events: list[dict]) -> set[int]:
+        """
+        Ids of the delivered events, one user's events are delivered in order
+        """
+        by_user: dict[str, list[dict]] = {}
+        for event in events:
+            by_user.setdefault(event["payload"]["userid"], []).append(event)
+
+        async def deliver_all(user_events: list[dict]) -> list[int]:
+            delivered = []
+            for event in user_events:
+                if not await self.deliver(event):
+                    # later events of the user wait for this one
+                    break
+                delivered.append(event["id"])
+            return delivered
+
+        results = await asyncio.gather(*(deliver_all(user_events) for user_events in by_user.values()))
+        return {id for ids in results for id in ids}
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
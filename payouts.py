@@ -0,0 +1,129 @@
+"""
+Bulk payouts for operations (rewards, refunds) without the LNURL round trip.
+
+Invoices are decoded concurrently, the whole batch is debited and queued with
+one set-based statement (PSQLClient.create_bulk_payments) and payments are
+dispatched with bounded parallelism. Results are yielded as they complete so
+the caller can stream them; payments keep running if the caller goes away.
+Enabled by setting PAYOUT_TOKEN, requests send it in X-Payout-Token.
+"""
+from fastapi import Header, HTTPException
+from typing import AsyncGenerator
+from .base import PayoutItem, PayoutResult, LNDInvoice
+from .crud import PSQLClient
+from .node import LndRestNode, LndNodePool
+from .helpers import ServiceUnavailableError
+from .tracing import remember_payment
+import asyncio
+import logging
+import secrets
+import time
+import os
+
+PAYOUT_TOKEN = os.getenv("PAYOUT_TOKEN", "")
+PAYOUT_CONCURRENCY = int(os.getenv("PAYOUT_CONCURRENCY", 8))
+PAYOUT_MAX_ITEMS = int(os.getenv("PAYOUT_MAX_ITEMS", 1000))
+
+REJECT_REASONS = {
+    "DUPLICATE": "Invoice already paid or queued",
+    "INSUFFICIENT_BALANCE": "Insufficient balance",
+}
+
+logger = logging.getLogger(__name__)
+
+
+async def require_token(x_payout_token: str = Header("")):
+    if not PAYOUT_TOKEN or not secrets.compare_digest(x_payout_token.encode(), PAYOUT_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+async def decode(nodes: LndNodePool, semaphore: asyncio.Semaphore, item: PayoutItem) -> LNDInvoice | str:
+    """
+    Decoded invoice or the reason it can't be paid
+    """
+    async with semaphore:
+        try:
+            invoice = await nodes.decode_invoice(item.bolt11)
+        except ServiceUnavailableError:
+            return "Service temporarily unavailable"
+    if invoice is None:
+        return "Invoice decode error"
+    if invoice.num_satoshis <= 0:
+        return "Amountless invoice"
+    if int(invoice.timestamp) + int(invoice.expiry) < time.time():
+        return "Invoice expired"
+    return invoice
+
+
+async def pay(node: LndRestNode, semaphore: asyncio.Semaphore, index: int, userid: str, invoice: LNDInvoice) -> PayoutResult:
+    async with semaphore:
+        try:
+            response = await node.pay(invoice)
+        except Exception as e:
+            # status is settled by the payment stream, report it as unknown here
+            logger.warning("bulk payout dispatch failed", extra={"payment_hash": invoice.payment_hash, "error": str(e)})
+            return PayoutResult(index=index, userid=userid, status="PAYMENT_FAILED",
+                                payment_hash=invoice.payment_hash, reason="Dispatch error, check payment status")
+    if not response.ok:
+        return PayoutResult(index=index, userid=userid, status="PAYMENT_FAILED",
+                            payment_hash=invoice.payment_hash, reason=response.error_message)
+    return PayoutResult(index=index, userid=userid, status="PAID", payment_hash=invoice.payment_hash,
+                        fee_sat=response.fee_msat // 1000)
+
+
+async def bulk_payout(
+    nodes: LndNodePool,
+    psql: PSQLClient,
+    items: list[PayoutItem],
+    tasks: set[asyncio.Task],
+) -> AsyncGenerator[PayoutResult, None]:
+    semaphore = asyncio.Semaphore(PAYOUT_CONCURRENCY)
+    decoded = await asyncio.gather(*(decode(nodes, semaphore, item) for item in items))
+
+    # liquidity is reserved on the chosen node right away so later items see it
+    batch: list[tuple[int, str, LNDInvoice, LndRestNode]] = []
+    seen = set()
+    for index, (item, invoice) in enumerate(zip(items, decoded)):
+        reason = invoice if isinstance(invoice, str) else None
+        node = None
+        if reason is None and invoice.payment_hash in seen:
+            reason = "Duplicate invoice in batch"
+        elif reason is None:
+            node = nodes.for_payout(invoice.num_satoshis)
+            if node is None:
+                reason = "Amount exceeds available liquidity"
+        if reason is not None:
+            yield PayoutResult(index=index, userid=item.userid, status="REJECTED",
+                               payment_hash=getattr(invoice, "payment_hash", None), reason=reason)
+            continue
+        seen.add(invoice.payment_hash)
+        node.liquidity.reserve(invoice.payment_hash, invoice.num_satoshis)
+        batch.append((index, item.userid, invoice, node))
+    if not batch:
+        return
+
+    try:
+        statuses = await psql.create_bulk_payments([(userid, invoice, node.name) for _, userid, invoice, node in batch])
+    except BaseException:
+        for _, _, invoice, node in batch:
+            node.liquidity.release(invoice.payment_hash)
+        raise
+
+    results: asyncio.Queue[PayoutResult] = asyncio.Queue()
+    dispatched = 0
+    for index, userid, invoice, node in batch:
+        status = statuses.get(invoice.payment_hash)
+        if status != "QUEUED":
+            node.liquidity.release(invoice.payment_hash)
+            yield PayoutResult(index=index, userid=userid, status="REJECTED", payment_hash=invoice.payment_hash,
+                               reason=REJECT_REASONS.get(status, "Rejected"))
+            continue
+        remember_payment(invoice.payment_hash)
+        task = asyncio.create_task(pay(node, semaphore, index, userid, invoice), name=f"pay_invoice:{invoice.payment_hash}")
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda t: t.cancelled() or results.put_nowait(t.result()))
+        dispatched += 1
+
+    for _ in range(dispatched):
+        yield await results.get()
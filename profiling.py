@@ -0,0 +1,168 @@
+"""
+Opt-in profiling for live workers, served under /debug.
+Enabled with PROFILING_ENABLED=1 and PROFILING_TOKEN set, requests must send
+the token in the X-Profiling-Token header.
+
+/debug/profile  sample the event loop thread for `seconds`, folded stacks
+/debug/tasks    asyncio task snapshot, json or folded stacks
+/debug/loop     event loop lag statistics
+
+Stacks are in the collapsed "frame;frame;frame count" format understood by
+flamegraph.pl, speedscope and inferno. The LoopMonitor watchdog logs the
+loop thread stack whenever the loop is blocked for longer than
+LOOP_BLOCK_THRESHOLD seconds, e.g. by synchronous redis calls.
+"""
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from collections import Counter
+from typing import Optional
+from .metrics import Gauge
+import threading
+import secrets
+import asyncio
+import logging
+import time
+import sys
+import os
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1" and bool(os.getenv("PROFILING_TOKEN"))
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", 0.25))
+
+LOOP_LAG_SECONDS = Gauge("lnurl_event_loop_lag_seconds", "Event loop scheduling delay")
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def folded_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample_thread(thread_id: int, seconds: float, interval: float) -> Counter:
+    """
+    Sample the stack of `thread_id`, runs in a worker thread
+    """
+    samples: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[folded_stack(frame)] += 1
+        time.sleep(interval)
+    return samples
+
+
+def task_snapshot() -> list[dict]:
+    tasks = []
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        tasks.append({
+            "name": task.get_name(),
+            "coro": getattr(coro, "__qualname__", repr(coro)),
+            "done": task.done(),
+            "stack": [frame_name(frame) for frame in task.get_stack()],
+        })
+    return tasks
+
+
+class LoopMonitor:
+    """
+    Measure event loop lag with a heartbeat coroutine, a watchdog thread
+    logs the loop thread stack when the heartbeat stalls
+    """
+    def __init__(self, interval: float = 0.1, threshold: float = LOOP_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.blocked = 0
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.running = True
+        self.task = asyncio.create_task(self.heartbeat(), name="loop-monitor")
+        threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected)
+            self.last_beat = time.monotonic()
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.set(lag)
+
+    def watchdog(self):
+        reported = False
+        while self.running:
+            time.sleep(self.threshold / 2)
+            stalled = time.monotonic() - self.last_beat - self.interval
+            if stalled < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            self.blocked += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            logger.warning(
+                "event loop blocked for %.3fs",
+                stalled,
+                extra={"stack": folded_stack(frame) if frame is not None else None},
+            )
+
+    def stats(self) -> dict:
+        return {
+            "max_lag": self.max_lag,
+            "blocked": self.blocked,
+            "since_last_beat": time.monotonic() - self.last_beat,
+        }
+
+
+monitor = LoopMonitor()
+
+
+async def require_token(x_profiling_token: str = Header("")):
+    if not secrets.compare_digest(x_profiling_token, PROFILING_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+router = APIRouter(prefix="/debug", dependencies=[Depends(require_token)], include_in_schema=False)
+
+
+@router.get("/profile")
+async def cpu_profile(seconds: float = Query(10, gt=0, le=120), interval: float = Query(0.005, ge=0.001, le=1)):
+    samples = await asyncio.to_thread(sample_thread, threading.get_ident(), seconds, interval)
+    body = "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+    return PlainTextResponse(body)
+
+
+@router.get("/tasks")
+async def tasks(format: str = Query("json", pattern="^(json|folded)$")):
+    snapshot = task_snapshot()
+    if format == "json":
+        return snapshot
+    counts = Counter(";".join(task["stack"]) or task["coro"] for task in snapshot)
+    return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in counts.most_common()))
+
+
+@router.get("/loop")
+async def loop_stats():
+    return monitor.stats()
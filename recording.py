@@ -0,0 +1,111 @@
+"""
+Capture LND stream lines and HTTP traffic for offline replay, see bench/replay.py.
+
+RECORD_DIR  write recordings here, one JSONL file per process, off when unset
+
+Each line is one compact JSON record with a wall clock timestamp `t`:
+
+  {"t": ..., "kind": "lnd", "node": ..., "stream": "payments", "line": ...}
+  {"t": ..., "kind": "http", "method": ..., "path": ..., "query": ..., "headers": {...},
+   "body": ..., "status": ..., "seconds": ...}
+
+Lines are kept verbatim so the replay goes through the same parsing.
+Recordings hold bearer tokens, k1 secrets and preimages, treat them like
+database dumps. Records are queued and written by a thread, the event loop
+never touches the file.
+"""
+from typing import AsyncIterator, Optional
+import threading
+import logging
+import queue
+import json
+import time
+import os
+
+RECORD_DIR = os.getenv("RECORD_DIR", "")
+RECORDING_ENABLED = RECORD_DIR != ""
+
+# request headers needed to replay a call
+RECORD_HEADERS = ("authorization", "content-type", "x-payout-token")
+
+logger = logging.getLogger(__name__)
+
+
+class Recording:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="recording", daemon=True)
+        self.thread.start()
+
+    def write(self, record: dict):
+        self.queue.put(record)
+
+    def run(self):
+        with open(self.path, "a", buffering=1 << 16) as f:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    return
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+_recording: Optional[Recording] = None
+
+
+def start_recording():
+    global _recording
+    if not RECORDING_ENABLED or _recording is not None:
+        return
+    os.makedirs(RECORD_DIR, exist_ok=True)
+    path = os.path.join(RECORD_DIR, f"recording-{int(time.time())}-{os.getpid()}.jsonl")
+    _recording = Recording(path)
+    logger.info("recording traffic", extra={"path": path})
+
+
+def stop_recording():
+    global _recording
+    if _recording is not None:
+        _recording.close()
+        _recording = None
+
+
+async def tap(lines: AsyncIterator[str], node: str, stream: str) -> AsyncIterator[str]:
+    async for line in lines:
+        if _recording is not None:
+            _recording.write({"t": time.time(), "kind": "lnd", "node": node, "stream": stream, "line": line})
+        yield line
+
+
+def stream_lines(response, node: str, stream: str) -> AsyncIterator[str]:
+    """
+    Lines of a streaming LND response, recorded when capture is on
+    """
+    if _recording is None:
+        return response.aiter_lines()
+    return tap(response.aiter_lines(), node, stream)
+
+
+async def http_middleware(request, call_next):
+    if _recording is None:
+        return await call_next(request)
+    started = time.time()
+    body = await request.body() if request.method != "GET" else b""
+    response = await call_next(request)
+    _recording.write({
+        "t": started,
+        "kind": "http",
+        "method": request.method,
+        "path": request.url.path,
+        "query": request.url.query,
+        "headers": {name: request.headers[name] for name in RECORD_HEADERS if name in request.headers},
+        "body": body.decode(errors="replace"),
+        "status": response.status_code,
+        "seconds": time.time() - started,
+    })
+    return response
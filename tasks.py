@@ -1,52 +1,193 @@
-import asyncio
-from typing import List
-from .node import LndRestNode
-from .crud import PSQLClient
-import logging
-
-logging.basicConfig(filename='app.log', encoding='utf-8', level=logging.DEBUG, format='%(asctime)s %(message)s')
-
-tasks: List[asyncio.Task] = []
-
-async def process_payment_notifications(node: LndRestNode, psql: PSQLClient):
-    async for status in node.track_payments():
-        if status.status == "SUCCEEDED":
-            await psql.finalize_payment(status)
-        elif status.status == "FAILED":
-            await psql.failed_payment(status)
-
-async def process_invoice_notifications(node: LndRestNode, psql: PSQLClient): 
-    async for invoice in node.paid_invoices_stream():
-        if invoice.state == "SETTLED":
-            await psql.deposit_finalize(invoice)
-    
-
-def create_task(coro):
-    task = asyncio.create_task(coro)
-    tasks.append(task)
-    return task
-
-
-def create_permanent_task(func, *args):
-    return create_task(catch_everything_and_restart(func, *args))
-
-
-def cancel_all_tasks():
-    for task in tasks:
-        try:
-            task.cancel()
-        except Exception as exc:
-            logging.warning(f"error while cancelling task: {str(exc)}")
-
-
-async def catch_everything_and_restart(func, *args):
-    try:
-        await func(*args)
-    except (asyncio.CancelledError, KeyboardInterrupt):
-        print('STOPPING background services...')
-        raise  # because we must pass this up
-    except Exception as exc:
-        logging.error("caught exception in background task:", exc)
-        logging.error("Restarting in 5 seconds...")
-        await asyncio.sleep(5)
-        await catch_everything_and_restart(func, *args)
\ No newline at end of file
+import asyncio
+from typing import List, Optional
+from .node import LndRestNode, LndNodePool
+from .crud import PSQLClient
+from .base import LNDInvoice
+from .helpers import Lanes, PaymentHashIndex
+from .events import StatusBroker
+from .outbox import OUTBOX_LEASE, OutboxRelay, retry_after
+from .metrics import TASK_UP, TASK_RESTARTS
+from .tracing import start_span, payment_links
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+tasks: List[asyncio.Task] = []
+
+async def process_payment_notifications(node: LndRestNode, psql: PSQLClient, lanes: int = 8, lane_size: int = 100):
+    """
+    Settle final payment updates in `lanes` parallel workers,
+    updates of one payment_hash stay in order
+    """
+    async def settle(status):
+        links = payment_links(status.payment_hash)
+        with start_span("settle_payment", {"payment_hash": status.payment_hash, "status": status.status}, links):
+            if status.status == "SUCCEEDED":
+                await psql.finalize_payment(status)
+            else:
+                await psql.failed_payment(status)
+        node.liquidity.release(status.payment_hash)
+        node.fees.observe(status)
+
+    async def dead_letter(status, error):
+        await psql.add_dead_letter(workers.name, status._asdict(), repr(error))
+
+    async def final_updates():
+        async for status in node.track_payments():
+            if status.status in ("SUCCEEDED", "FAILED"):
+                yield status
+
+    workers = Lanes(f"payments:{node.name}", settle, lanes, lane_size, dead_letter=dead_letter)
+    await workers.run(final_updates(), key=lambda status: status.payment_hash)
+
+async def process_invoice_notifications(
+    node: LndRestNode, psql: PSQLClient, index: PaymentHashIndex, lanes: int = 8, lane_size: int = 100
+):
+    """
+    Settle paid invoices in `lanes` parallel workers keyed by payment_hash
+    """
+    async def settle(invoice):
+        with start_span("settle_deposit", {"payment_hash": invoice.payment_hash}):
+            await psql.deposit_finalize(invoice)
+        index.discard(invoice.payment_hash)
+
+    async def dead_letter(invoice, error):
+        await psql.add_dead_letter(workers.name, invoice.model_dump(mode="json"), repr(error))
+
+    async def settled():
+        async for invoice in node.paid_invoices_stream(accept=index.accepts):
+            if invoice.state == "SETTLED":
+                yield invoice
+
+    workers = Lanes(f"invoices:{node.name}", settle, lanes, lane_size, dead_letter=dead_letter)
+    await workers.run(settled(), key=lambda invoice: invoice.payment_hash)
+
+async def refresh_deposit_index(psql: PSQLClient, index: PaymentHashIndex, interval: int = 60):
+    while True:
+        started = datetime.utcnow().timestamp()
+        index.replace(await psql.get_open_deposit_hashes(), started)
+        await asyncio.sleep(interval)
+    
+async def refresh_liquidity(node: LndRestNode, interval: int = 30):
+    """
+    Refresh the node liquidity snapshot every `interval` seconds,
+    or right away when a channel event invalidates it
+    """
+    async def watch_channels():
+        async for _ in node.channel_events():
+            node.liquidity.invalidate()
+
+    # lives and dies with this task, channel_events reconnects by itself
+    watcher = asyncio.create_task(watch_channels())
+    try:
+        while True:
+            await node.refresh_liquidity()
+            try:
+                await asyncio.wait_for(node.liquidity.stale.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watcher.cancel()
+
+async def replenish_deposit_pool(
+    nodes: LndNodePool,
+    psql: PSQLClient,
+    amounts: list[int],
+    size: int,
+    expiry: int,
+    min_validity: int,
+    description: bytes,
+    low: asyncio.Event,
+    interval: int = 30,
+):
+    """
+    Keep `size` unclaimed invoices per amount in deposit_invoices,
+    recycling the ones with less than `min_validity` seconds left.
+    Runs every `interval` seconds or when a claim sets `low`
+    """
+    while True:
+        low.clear()
+        min_expiry = int(datetime.utcnow().timestamp()) + min_validity
+        pruned = await psql.prune_deposit_pool(min_expiry)
+        available = await psql.get_deposit_pool_counts(min_expiry)
+        missing = [amount for amount in amounts for _ in range(size - available.get(amount, 0))]
+        if missing:
+            targets = [(amount, nodes.for_deposit()) for amount in missing]
+            created = await asyncio.gather(
+                *(node.create_invoice(amount, unhashed_description=description, expiry=expiry) for amount, node in targets),
+                return_exceptions=True,
+            )
+            invoices = [
+                (invoice, node.name) for invoice, (_, node) in zip(created, targets) if isinstance(invoice, LNDInvoice)
+            ]
+            if invoices:
+                await psql.deposit_pool_add(invoices)
+            logger.info("deposit pool replenished", extra={"created": len(invoices), "missing": len(missing), "pruned": pruned})
+        try:
+            await asyncio.wait_for(low.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def relay_outbox(psql: PSQLClient, relay: OutboxRelay, wake: asyncio.Event, batch: int, interval: int = 5):
+    """
+    Deliver due outbox events, back to back while batches come full,
+    otherwise when a status event sets `wake` or every `interval` seconds
+    """
+    while True:
+        wake.clear()
+        if await psql.drain_outbox(batch, relay.dispatch, retry_after, OUTBOX_LEASE) >= batch:
+            continue
+        try:
+            await asyncio.wait_for(wake.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def check_replicas(psql: PSQLClient, interval: int = 5):
+    while True:
+        await psql.check_replicas()
+        await asyncio.sleep(interval)
+
+async def listen_status_events(psql: PSQLClient, broker: StatusBroker):
+    await broker.listen(psql.conninfo)
+
+
+def create_task(coro):
+    task = asyncio.create_task(coro)
+    tasks.append(task)
+    return task
+
+
+def create_permanent_task(func, *args, name: Optional[str] = None):
+    """
+    Run func(*args) forever, `name` labels its metrics and defaults to the
+    function name, give per-node tasks their own
+    """
+    return create_task(catch_everything_and_restart(func, *args, name=name))
+
+
+def cancel_all_tasks():
+    for task in tasks:
+        try:
+            task.cancel()
+        except Exception as exc:
+            logger.warning("error while cancelling task: %s", exc)
+
+
+async def catch_everything_and_restart(func, *args, name: Optional[str] = None):
+    name = name or func.__name__
+    while True:
+        try:
+            TASK_UP.set(1, task=name)
+            await func(*args)
+            # permanent tasks loop forever, returning means something like a closed stream
+            raise RuntimeError(f"{name} returned")
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            TASK_UP.set(0, task=name)
+            logger.info("stopping background task %s", name)
+            raise  # because we must pass this up
+        except Exception:
+            TASK_UP.set(0, task=name)
+            TASK_RESTARTS.inc(task=name)
+            logger.exception("background task %s crashed, restarting in 5 seconds", name)
+            await asyncio.sleep(5)
\ No newline at end of file
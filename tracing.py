@@ -0,0 +1,213 @@
+"""
+Lightweight tracing across HTTP, Postgres, Redis and LND calls.
+Spans are sampled at the root (TRACE_SAMPLE_RATIO), children follow the
+parent decision and unsampled spans are shared no-op objects. Finished
+spans are written as OTLP-style JSON lines by a background thread, to
+stderr (TRACE_EXPORT=console) or to a file path.
+Everything is a no-op unless TRACING_ENABLED=1.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict
+from typing import Optional
+import functools
+import inspect
+import logging
+import secrets
+import random
+import queue
+import json
+import time
+import sys
+import os
+import threading
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0") == "1"
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", 0.01))
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "console")
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "links", "start", "end", "status")
+
+    sampled = True
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: dict, links: list):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.links = links
+        self.start = time.time_ns()
+        self.end = 0
+        self.status = "OK"
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def update_name(self, name: str):
+        self.name = name
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end,
+            "attributes": self.attributes,
+            "links": [{"traceId": t, "spanId": s} for t, s in self.links],
+            "status": self.status,
+        }
+
+
+class NonRecordingSpan:
+    """
+    Stand-in for unsampled spans, children of it are not recorded either
+    """
+    sampled = False
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def update_name(self, name: str):
+        pass
+
+
+NOOP_SPAN = NonRecordingSpan()
+
+_current: ContextVar[Optional[Span | NonRecordingSpan]] = ContextVar("current_span", default=None)
+
+
+class SpanExporter:
+    """
+    Write finished spans from a background thread, never blocks the event loop
+    """
+    def __init__(self, target: str):
+        self.target = target
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: Optional[threading.Thread] = None
+
+    def export(self, span: Span):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="span-exporter", daemon=True)
+            self.thread.start()
+        self.queue.put(span)
+
+    def run(self):
+        out = sys.stderr if self.target == "console" else open(self.target, "a", encoding="utf-8")
+        while True:
+            spans = [self.queue.get()]
+            while not self.queue.empty() and len(spans) < 512:
+                spans.append(self.queue.get())
+            try:
+                out.write("".join(json.dumps(s.to_dict(), default=str) + "\n" for s in spans))
+                out.flush()
+            except Exception:
+                logging.getLogger(__name__).exception("span export failed")
+
+
+EXPORTER = SpanExporter(TRACE_EXPORT)
+
+# payment_hash -> (trace_id, span_id) of the request that started the payment
+_payment_contexts: OrderedDict[str, tuple[str, str]] = OrderedDict()
+MAX_PAYMENT_CONTEXTS = 10000
+
+
+@contextmanager
+def start_span(name: str, attributes: Optional[dict] = None, links: Optional[list[tuple[str, str]]] = None):
+    if not TRACING_ENABLED:
+        yield NOOP_SPAN
+        return
+    parent = _current.get()
+    if parent is None:
+        # root span, linked spans inherit the sampling of what they link to
+        sampled = bool(links) or random.random() < TRACE_SAMPLE_RATIO
+        if not sampled:
+            token = _current.set(NOOP_SPAN)
+            try:
+                yield NOOP_SPAN
+            finally:
+                _current.reset(token)
+            return
+        span = Span(name, secrets.token_hex(16), None, attributes or {}, links or [])
+    elif not parent.sampled:
+        yield NOOP_SPAN
+        return
+    else:
+        span = Span(name, parent.trace_id, parent.span_id, attributes or {}, links or [])
+
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.status = "ERROR"
+        span.attributes["exception"] = repr(exc)
+        raise
+    finally:
+        _current.reset(token)
+        span.end = time.time_ns()
+        EXPORTER.export(span)
+
+
+def current_span() -> Span | NonRecordingSpan:
+    return _current.get() or NOOP_SPAN
+
+
+def remember_payment(payment_hash: str):
+    """
+    Keep the current span context so the later settlement can link back to it
+    """
+    span = _current.get()
+    if span is None or not span.sampled:
+        return
+    _payment_contexts[payment_hash] = (span.trace_id, span.span_id)
+    if len(_payment_contexts) > MAX_PAYMENT_CONTEXTS:
+        _payment_contexts.popitem(last=False)
+
+
+def payment_links(payment_hash: str) -> list[tuple[str, str]]:
+    context = _payment_contexts.pop(payment_hash, None)
+    return [context] if context is not None else []
+
+
+def traced(component: str, name: str):
+    """
+    Decorator running an async function inside a `component.name` span
+    """
+    def decorator(func):
+        if not TRACING_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with start_span(f"{component}.{name}"):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_methods(component: str):
+    """
+    Class decorator tracing every public coroutine method
+    """
+    def decorator(cls):
+        if not TRACING_ENABLED:
+            return cls
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.iscoroutinefunction(func):
+                continue
+            setattr(cls, name, traced(component, name)(func))
+        return cls
+    return decorator
+
+
+async def http_middleware(request, call_next):
+    with start_span(f"HTTP {request.method}", {"http.method": request.method}) as span:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        span.update_name(f"HTTP {request.method} {route.path if route is not None else 'unmatched'}")
+        span.set_attribute("http.status_code", response.status_code)
+        return response